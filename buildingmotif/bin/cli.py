@@ -6,7 +6,8 @@ from os import getenv
 from pathlib import Path
 
 from buildingmotif import BuildingMOTIF
-from buildingmotif.dataclasses import Library
+from buildingmotif.dataclasses import Library, ShapeCollection
+from buildingmotif.dataclasses.model import validate_models
 
 cli = argparse.ArgumentParser(
     prog="buildingmotif", description="CLI Interface for common BuildingMOTIF tasks"
@@ -127,6 +128,77 @@ def get_default_libraries_yml(_args):
     print("libraries.default.yml created in the current directory")
 
 
+@subcommand(
+    arg(
+        "-d",
+        "--db",
+        help="Database URI of the BuildingMOTIF installation. "
+        'Defaults to $DB_URI and then contents of "config.py"',
+    ),
+    arg(
+        "-m",
+        "--models",
+        help="Ids of the models to validate. Defaults to all models",
+        type=int,
+        nargs="+",
+    ),
+    arg(
+        "-s",
+        "--shape-collections",
+        help="Ids of the shape collections to validate against",
+        type=int,
+        nargs="+",
+        default=[],
+    ),
+    arg(
+        "-l",
+        "--libraries",
+        help="Names of libraries whose shapes to validate against",
+        nargs="+",
+        default=[],
+    ),
+    arg(
+        "-w",
+        "--workers",
+        help="Number of worker processes. Defaults to the number of CPUs",
+        type=int,
+    ),
+    arg(
+        "-o",
+        "--output",
+        help="Directory in which to write the validation report of each model",
+    ),
+)
+def validate(args):
+    """
+    Validates models in the BuildingMOTIF instance against the given shape
+    collections and libraries in parallel
+    """
+    db_uri = get_db_uri(args)
+    bm = BuildingMOTIF(db_uri)
+    shape_collections = [ShapeCollection.load(id) for id in args.shape_collections]
+    for name in args.libraries:
+        shape_collections.append(Library.load(name=name).get_shape_collection())
+    if not shape_collections:
+        print("No shape collections or libraries to validate against")
+        subcommands[args.func].print_help()
+        sys.exit(1)
+    model_ids = args.models or [
+        db_model.id for db_model in bm.table_connection.get_all_db_models()
+    ]
+
+    results = validate_models(model_ids, shape_collections, workers=args.workers)
+    output = Path(args.output) if args.output else None
+    if output is not None:
+        output.mkdir(parents=True, exist_ok=True)
+    for model_id, ctx in results.items():
+        print(f"{ctx.model.name} ({model_id}): {'valid' if ctx.valid else 'invalid'}")
+        if output is not None:
+            ctx.report.serialize(output / f"model_{model_id}.ttl", format="turtle")
+    if not all(ctx.valid for ctx in results.values()):
+        sys.exit(1)
+
+
 @subcommand(
     arg(
         "-b",
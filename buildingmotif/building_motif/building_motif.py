@@ -24,7 +24,12 @@ from buildingmotif.namespaces import bind_prefixes
 class BuildingMOTIF(metaclass=Singleton):
     """Manages BuildingMOTIF data classes."""
 
-    def __init__(self, db_uri: str, log_level=logging.WARNING) -> None:
+    def __init__(
+        self,
+        db_uri: str,
+        log_level=logging.WARNING,
+        max_cached_triples: int = 1000000,
+    ) -> None:
         """Class constructor.
 
         :param db_uri: database URI
@@ -32,6 +37,10 @@ class BuildingMOTIF(metaclass=Singleton):
         :param log_level: logging level of detail
         :type log_level: int
         :default log_level: INFO
+        :param max_cached_triples: number of triples which may be kept in the
+            in-memory graph cache; 0 disables the cache
+        :type max_cached_triples: int
+        :default max_cached_triples: 1000000
         """
         self.db_uri = db_uri
         self.engine = create_engine(
@@ -51,7 +60,8 @@ class BuildingMOTIF(metaclass=Singleton):
 
         self.table_connection = TableConnection(self.engine, self)
         self.graph_connection = GraphConnection(
-            BuildingMotifEngine(self.engine, self.Session)
+            BuildingMotifEngine(self.engine, self.Session),
+            max_cached_triples=max_cached_triples,
         )
 
         g = Graph()
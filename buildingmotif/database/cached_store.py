@@ -0,0 +1,179 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from rdflib.graph import Graph, QuotedGraph
+from rdflib.store import Store
+from rdflib.term import Node
+from rdflib_sqlalchemy.store import SQLAlchemy
+
+
+class CachedSQLAlchemy(SQLAlchemy):
+    """An rdflib-sqlalchemy store with an in-memory read-through cache.
+
+    The first read of a graph materializes all of its triples into an
+    in-memory graph; later reads of that graph are answered from memory
+    instead of issuing a SQL query per triple pattern. Writes go to the
+    database and are applied to any materialized copy. Least recently used
+    graphs are evicted once the cache holds more than `max_cached_triples`
+    triples. The lengths of graphs which are not materialized are counted
+    in the database once and kept until the graph is written to.
+    """
+
+    def __init__(self, *args, max_cached_triples: int = 1000000, **kwargs) -> None:
+        """Class constructor. All other arguments are passed to the
+        rdflib-sqlalchemy store.
+
+        :param max_cached_triples: the number of triples which may be held in
+            memory; 0 disables the cache, defaults to 1000000
+        :type max_cached_triples: int, optional
+        """
+        super().__init__(*args, **kwargs)
+        self.max_cached_triples = max_cached_triples
+        self._cache: "OrderedDict[Node, Graph]" = OrderedDict()
+        # the number of triples held by the materialized copies
+        self._cached_triples = 0
+        # the lengths of graphs which are not materialized
+        self._counts: Dict[Node, int] = {}
+        # graphs found to be larger than the budget, so that they are not
+        # counted again on every read
+        self._uncacheable: Set[Node] = set()
+
+    def invalidate(self, identifier: Optional[Node] = None) -> None:
+        """Drop the materialized copy of a graph, or of all graphs.
+
+        :param identifier: identifier of the graph to drop, defaults to None
+            (all graphs)
+        :type identifier: Optional[Node], optional
+        """
+        if identifier is None:
+            self._cache.clear()
+            self._cached_triples = 0
+            self._uncacheable.clear()
+            self._counts.clear()
+        else:
+            dropped = self._cache.pop(identifier, None)
+            if dropped is not None:
+                self._cached_triples -= len(dropped)
+            self._uncacheable.discard(identifier)
+            self._counts.pop(identifier, None)
+
+    def _cacheable(self, context) -> bool:
+        """Returns True if the given context may be cached."""
+        return (
+            self.max_cached_triples > 0
+            and isinstance(context, Graph)
+            and not isinstance(context, QuotedGraph)
+        )
+
+    def _count(self, context) -> int:
+        """Returns the length of a cacheable context which is not
+        materialized, counting its triples in the database if the count is
+        not known."""
+        count = self._counts.get(context.identifier)
+        if count is None:
+            count = super().__len__(context)
+            self._counts[context.identifier] = count
+        return count
+
+    def _cached(self, context, materialize: bool = True) -> Optional[Graph]:
+        """Returns the in-memory copy of the given context, materializing it
+        if necessary. Returns None if the context cannot be cached.
+        """
+        if not self._cacheable(context):
+            return None
+        identifier = context.identifier
+        cached = self._cache.get(identifier)
+        if cached is not None:
+            self._cache.move_to_end(identifier)
+            return cached
+        if not materialize or identifier in self._uncacheable:
+            return None
+        if self._count(context) > self.max_cached_triples:
+            self._uncacheable.add(identifier)
+            return None
+
+        cached = Graph()
+        cached.addN(
+            (s, p, o, cached)
+            for (s, p, o), _ in super().triples((None, None, None), context)
+        )
+        self._cache[identifier] = cached
+        self._counts.pop(identifier, None)
+        self._cached_triples += len(cached)
+        self._evict()
+        return cached
+
+    def _evict(self) -> None:
+        """Evict least recently used graphs until the cache fits the budget."""
+        while self._cached_triples > self.max_cached_triples and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_triples -= len(evicted)
+
+    def _written(self, context) -> None:
+        """Forgets the length of a graph which was written to."""
+        if isinstance(context, Graph):
+            self._counts.pop(context.identifier, None)
+
+    def _add_cached(self, cached: Graph, triple) -> None:
+        """Adds a triple to a materialized copy."""
+        if triple not in cached:
+            cached.add(triple)
+            self._cached_triples += 1
+
+    def _remove_cached(self, cached: Graph, triple) -> None:
+        """Removes the triples matching a pattern from a materialized copy."""
+        before = len(cached)
+        cached.remove(triple)
+        self._cached_triples -= before - len(cached)
+
+    def __len__(self, context=None):
+        cached = self._cached(context, materialize=False)
+        if cached is not None:
+            return len(cached)
+        if not self._cacheable(context):
+            return super().__len__(context)
+        return self._count(context)
+
+    def triples(self, triple, context=None):
+        cached = self._cached(context)
+        if cached is None:
+            yield from super().triples(triple, context)
+            return
+        for match in cached.triples(triple):
+            yield match, iter([context])
+
+    def triples_choices(self, triple, context=None):
+        if self._cached(context) is None:
+            yield from super().triples_choices(triple, context)
+            return
+        # the generic implementation answers each choice with self.triples
+        yield from Store.triples_choices(self, triple, context)
+
+    def add(self, triple, context=None, quoted=False):
+        super().add(triple, context, quoted)
+        self._written(context)
+        cached = self._cached(context, materialize=False)
+        if cached is not None:
+            self._add_cached(cached, triple)
+
+    def addN(self, quads):
+        quads = list(quads)
+        super().addN(quads)
+        for s, p, o, context in quads:
+            self._written(context)
+            cached = self._cached(context, materialize=False)
+            if cached is not None:
+                self._add_cached(cached, (s, p, o))
+
+    def remove(self, triple, context):
+        super().remove(triple, context)
+        if context is None:
+            # the pattern was removed from every graph
+            self._counts.clear()
+            for cached in self._cache.values():
+                self._remove_cached(cached, triple)
+            return
+        self._written(context)
+        cached = self._cached(context, materialize=False)
+        if cached is not None:
+            self._remove_cached(cached, triple)
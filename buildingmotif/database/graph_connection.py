@@ -1,9 +1,25 @@
 import logging
+import time
+import uuid
+from dataclasses import dataclass
+from io import StringIO
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
 
-from rdflib.graph import Graph, Store, URIRef, plugin
-from rdflib.namespace import NamespaceManager
+from rdflib.graph import Graph, URIRef
+from rdflib.namespace import RDF, NamespaceManager
+from rdflib.store import TripleAddedEvent
+from rdflib.term import Literal
+from rdflib_sqlalchemy.termutils import (
+    statement_to_term_combination,
+    type_to_term_combination,
+)
+from sqlalchemy import Table, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from buildingmotif.database.cached_store import CachedSQLAlchemy
+from buildingmotif.utils import Triple, invalidate_graph_versions
 
 if TYPE_CHECKING:
     from buildingmotif.building_motif.building_motif import BuildingMotifEngine
@@ -11,6 +27,20 @@ if TYPE_CHECKING:
 PROJECT_DIR = Path(__file__).resolve().parent
 
 
+@dataclass
+class BulkLoadStats:
+    """Summary of a call to :py:meth:`GraphConnection.bulk_load`."""
+
+    triples: int
+    seconds: float
+
+    @property
+    def triples_per_second(self) -> float:
+        if self.seconds <= 0:
+            return float(self.triples)
+        return self.triples / self.seconds
+
+
 class GraphConnection:
     """Manages graph connection."""
 
@@ -18,6 +48,7 @@ class GraphConnection:
         self,
         engine: "BuildingMotifEngine",
         db_identifier: Optional[str] = "buildingmotif_store",
+        max_cached_triples: int = 1000000,
     ) -> None:
         """Constructor for the database and datastore.
 
@@ -25,12 +56,21 @@ class GraphConnection:
         :type engine: Engine
         :param db_identifier: defaults to "buildingmotif_store"
         :type db_identifier: Optional[str], optional
+        :param max_cached_triples: number of triples which may be kept in the
+            in-memory graph cache; 0 disables the cache, defaults to 1000000
+        :type max_cached_triples: int, optional
         """
         self.logger = logging.getLogger(__name__)
 
-        self.store = plugin.get("SQLAlchemy", Store)(
-            identifier=db_identifier, engine=engine
+        self.store = CachedSQLAlchemy(
+            identifier=db_identifier,
+            engine=engine,
+            max_cached_triples=max_cached_triples,
         )
+        # other sessions may have changed the graphs once a transaction ends,
+        # and a rollback discards writes which were applied to the cache
+        event.listen(engine.Session, "after_commit", self._invalidate_cache)
+        event.listen(engine.Session, "after_rollback", self._invalidate_cache)
 
         # avoids the warnings raised by the issue in https://github.com/RDFLib/rdflib/issues/1880
         # Eventually will require rdflib-sqlalchemy to support the 'override' keyword
@@ -42,6 +82,12 @@ class GraphConnection:
         self.logger.debug("Creating tables for graph storage")
         self.store.create_all()
 
+    def _invalidate_cache(self, _session) -> None:
+        self.store.invalidate()
+        # hashes of the graphs, and the values cached by them, are memoized
+        # on graph versions which only count this process's changes
+        invalidate_graph_versions(self.store)
+
     def create_graph(self, identifier: str, graph: Graph) -> Graph:
         """Create a graph in the database.
 
@@ -56,11 +102,163 @@ class GraphConnection:
             f"Creating graph: '{identifier}' in database with: {len(graph)} triples"
         )
         g = Graph(self.store, identifier=identifier)
-        new_triples = [(s, o, p, g) for (s, o, p) in graph]
-        g.addN(new_triples)
+        self.bulk_load(identifier, graph, log_level=logging.DEBUG)
 
         return g
 
+    def bulk_load(
+        self,
+        identifier: str,
+        triples: Iterable[Triple],
+        chunk_size: int = 50000,
+        log_level: int = logging.INFO,
+    ) -> BulkLoadStats:
+        """Add a large number of triples to the graph with the given identifier.
+
+        Triples are consumed lazily and written in chunks of multi-row
+        inserts; on PostgreSQL each chunk is streamed with ``COPY FROM STDIN``
+        into an unindexed staging table and merged into the statement tables
+        with a single ``INSERT ... ON CONFLICT DO NOTHING``, so index
+        maintenance happens once per chunk rather than once per triple.
+        Triples which are already in the graph are ignored. All chunks are
+        written in the current transaction.
+
+        :param identifier: identifier of graph
+        :type identifier: str
+        :param triples: triples to add; may be a graph or any iterable
+        :type triples: Iterable[Triple]
+        :param chunk_size: number of triples written per round trip, defaults
+            to 50000
+        :type chunk_size: int, optional
+        :param log_level: level at which the load statistics are logged,
+            defaults to logging.INFO
+        :type log_level: int, optional
+        :return: the number of triples written and how long it took
+        :rtype: BulkLoadStats
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be positive, not {chunk_size}")
+        g = Graph(self.store, identifier=identifier)
+        dispatch = self.store.dispatcher.dispatch
+        start = time.perf_counter()
+        count = 0
+        # statement table -> rows
+        pending: Dict[Table, List[Dict[str, Any]]] = {}
+        with self.store.engine.begin() as connection:
+            for triple in triples:
+                dispatch(TripleAddedEvent(triple=triple, context=g))
+                table, row = self._statement_row(triple, g)
+                pending.setdefault(table, []).append(row)
+                count += 1
+                if count % chunk_size == 0:
+                    self._write_chunk(connection, pending)
+                    pending = {}
+            self._write_chunk(connection, pending)
+        # the rows were written without going through the store
+        self.store.invalidate(g.identifier)
+        stats = BulkLoadStats(count, time.perf_counter() - start)
+        self.logger.log(
+            log_level,
+            f"Loaded {stats.triples} triples into '{identifier}' in "
+            f"{stats.seconds:.2f}s ({stats.triples_per_second:.0f} triples/sec)",
+        )
+        return stats
+
+    def _statement_row(self, triple: Triple, g: Graph) -> Tuple[Table, Dict[str, Any]]:
+        """Returns the statement table of the store which holds the triple and
+        the row for it, laid out as the store's own inserts lay it out."""
+        s, p, o = triple
+        tables = self.store.tables
+        if p == RDF.type:
+            return tables["type_statements"], {
+                "member": s,
+                "klass": o,
+                "context": g.identifier,
+                "termComb": int(type_to_term_combination(s, o, g)),
+            }
+        row = {
+            "subject": s,
+            "predicate": p,
+            "object": o,
+            "context": g.identifier,
+            "termComb": int(statement_to_term_combination(s, p, o, g)),
+        }
+        if isinstance(o, Literal):
+            row["objLanguage"] = o.language
+            row["objDatatype"] = o.datatype
+            return tables["literal_statements"], row
+        return tables["asserted_statements"], row
+
+    def _insert_ignoring_conflicts(self, table: Table):
+        """Returns an insert statement for the table which skips rows that
+        are already in it."""
+        dialect = self.store.engine.name
+        if dialect == "postgresql":
+            return postgresql.insert(table).on_conflict_do_nothing()
+        statement = table.insert()
+        if dialect == "sqlite":
+            return statement.prefix_with("OR IGNORE")
+        if dialect == "mysql":
+            return statement.prefix_with("IGNORE")
+        return statement
+
+    def _write_chunk(
+        self, connection, pending: Dict[Table, List[Dict[str, Any]]]
+    ) -> None:
+        """Write one chunk of pending rows for each statement table."""
+        for table, rows in pending.items():
+            if self.store.engine.name == "postgresql" and self._copy_rows(
+                connection, table, rows
+            ):
+                continue
+            connection.execute(self._insert_ignoring_conflicts(table), rows)
+
+    def _copy_rows(self, connection, table: Table, rows: List[Dict[str, Any]]) -> bool:
+        """Stream rows into a PostgreSQL table with COPY. Returns False if the
+        database driver does not support COPY.
+        """
+        # BuildingMotifEngine.begin() yields a session rather than a connection
+        if isinstance(connection, Session):
+            connection = connection.connection()
+        # the DBAPI connection, through SQLAlchemy's connection pool proxy
+        cursor = connection.connection.cursor()
+        if not hasattr(cursor, "copy_expert"):
+            return False
+        keys = list(rows[0].keys())
+        columns = [table.c[key] for key in keys]
+        processors = [
+            column.type.bind_processor(connection.dialect) for column in columns
+        ]
+        buffer = StringIO()
+        for row in rows:
+            fields = (
+                process(row[key]) if process else row[key]
+                for key, process in zip(keys, processors)
+            )
+            buffer.write(",".join(map(_copy_field, fields)))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        column_list = ", ".join(f'"{column.name}"' for column in columns)
+        staging = f"staging_{uuid.uuid4().hex}"
+        try:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE "{staging}" AS '
+                f'SELECT {column_list} FROM "{table.name}" WITH NO DATA'
+            )
+            cursor.copy_expert(
+                f'COPY "{staging}" ({column_list}) FROM STDIN WITH (FORMAT csv)',
+                buffer,
+            )
+            cursor.execute(
+                f'INSERT INTO "{table.name}" ({column_list}) '
+                f'SELECT {column_list} FROM "{staging}" ON CONFLICT DO NOTHING'
+            )
+            cursor.execute(f'DROP TABLE "{staging}"')
+        finally:
+            cursor.close()
+        return True
+
     def get_all_graph_identifiers(self) -> List[str]:
         """Get all graph identifiers.
 
@@ -93,3 +291,15 @@ class GraphConnection:
         self.logger.debug(f"Deleting graph: '{identifier}'")
         g = Graph(self.store, identifier=identifier)
         self.store.remove((None, None, None), g)
+        self.store.invalidate(g.identifier)
+
+
+def _copy_field(value: Any) -> str:
+    """Formats a value as a field of COPY's CSV format. NULL is an unquoted
+    empty field, so every string is quoted to keep empty strings apart from
+    NULL."""
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
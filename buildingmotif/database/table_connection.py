@@ -1,14 +1,17 @@
 import logging
 import uuid
 from functools import lru_cache
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from sqlalchemy import event
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Session
 
 from buildingmotif.database.tables import (
     DBLibrary,
     DBModel,
+    DBOntologyClosure,
     DBShapeCollection,
     DBTemplate,
     DepsAssociation,
@@ -29,6 +32,36 @@ class TableConnection:
         self.logger = logging.getLogger(__name__)
         self.bm = bm
 
+        # bumped whenever templates or the dependencies between them change;
+        # used to invalidate caches derived from the template dependency graph
+        self._template_dependency_version = 0
+        # cache for Template.inline_dependencies, keyed by template id
+        self.template_inline_cache: Dict[int, Any] = {}
+        event.listen(bm.session_factory, "after_flush", self._on_flush)
+        event.listen(bm.session_factory, "after_rollback", self._on_rollback)
+
+    @property
+    def template_dependency_version(self) -> int:
+        """A counter which changes whenever templates or their dependencies
+        are added, removed or changed.
+
+        :return: the current version of the template dependency graph
+        :rtype: int
+        """
+        return self._template_dependency_version
+
+    def _invalidate_template_dependencies(self) -> None:
+        self._template_dependency_version += 1
+        self.template_inline_cache.clear()
+
+    def _on_flush(self, session: Session, _flush_context) -> None:
+        changed = session.new | session.dirty | session.deleted
+        if any(isinstance(obj, (DBTemplate, DepsAssociation)) for obj in changed):
+            self._invalidate_template_dependencies()
+
+    def _on_rollback(self, _session: Session) -> None:
+        self._invalidate_template_dependencies()
+
     # model functions
 
     def create_db_model(self, name: str, description: str = "") -> DBModel:
@@ -177,6 +210,72 @@ class TableConnection:
 
         self.bm.session.delete(db_shape_collection)
 
+    # ontology closure functions
+
+    def create_db_ontology_closure(
+        self, content_hash: str, closure: Dict[str, Any]
+    ) -> DBOntologyClosure:
+        """Create database ontology closure.
+
+        :param content_hash: hash of the contents of the ontology
+        :type content_hash: str
+        :param closure: the serialized closure
+        :type closure: Dict[str, Any]
+        :return: DBOntologyClosure
+        :rtype: DBOntologyClosure
+        """
+        self.logger.debug(f"Creating ontology closure: '{content_hash}'")
+        db_closure = DBOntologyClosure(content_hash=content_hash, closure=closure)
+
+        self.bm.session.add(db_closure)
+        self.bm.session.flush()
+
+        return db_closure
+
+    def get_db_ontology_closure(self, content_hash: str) -> Optional[DBOntologyClosure]:
+        """Get database ontology closure by the hash of the ontology.
+
+        :param content_hash: hash of the contents of the ontology
+        :type content_hash: str
+        :return: DBOntologyClosure, or None if there is none for the hash
+        :rtype: Optional[DBOntologyClosure]
+        """
+        return (
+            self.bm.session.query(DBOntologyClosure)
+            .filter(DBOntologyClosure.content_hash == content_hash)
+            .one_or_none()
+        )
+
+    def delete_db_ontology_closure(self, content_hash: str) -> None:
+        """Delete the database ontology closure of the ontology with the given
+        hash, if there is one.
+
+        :param content_hash: hash of the ontology
+        :type content_hash: str
+        """
+        db_closure = self.get_db_ontology_closure(content_hash)
+        if db_closure is not None:
+            self.logger.debug(f"Deleting ontology closure: '{content_hash}'")
+            self.bm.session.delete(db_closure)
+
+    def delete_db_ontology_closures(self, keep: Set[str]) -> int:
+        """Delete the database ontology closures whose hash is not in `keep`.
+
+        :param keep: hashes of the ontologies whose closures are kept
+        :type keep: Set[str]
+        :return: the number of deleted closures
+        :rtype: int
+        """
+        stale = (
+            self.bm.session.query(DBOntologyClosure)
+            .filter(DBOntologyClosure.content_hash.notin_(keep))
+            .all()
+        )
+        for db_closure in stale:
+            self.logger.debug(f"Deleting ontology closure: '{db_closure.content_hash}'")
+            self.bm.session.delete(db_closure)
+        return len(stale)
+
     # library functions
 
     def create_db_library(self, name: str) -> DBLibrary:
@@ -376,6 +475,7 @@ class TableConnection:
             self.bm.session.query(DBTemplate).filter(DBTemplate.id == id).one()
         )
         db_template.optional_args = optional_args
+        self._invalidate_template_dependencies()
 
     def add_template_dependency_preliminary(
         self, template_id: int, dependency_id: int, args: Dict[str, str]
@@ -421,6 +521,7 @@ class TableConnection:
 
         self.bm.session.add(relationship)
         self.bm.session.flush()
+        self._invalidate_template_dependencies()
 
     def check_all_template_dependencies(self):
         """
@@ -510,6 +611,7 @@ class TableConnection:
             .one()
         )
         self.bm.session.delete(relationship)
+        self._invalidate_template_dependencies()
 
     def update_db_template_library(self, id: int, library_id: int) -> None:
         """Update database template library.
@@ -535,3 +637,4 @@ class TableConnection:
         self.logger.debug(f"Deleting template: '{db_template.name}'")
 
         self.bm.session.delete(db_template)
+        self._invalidate_template_dependencies()
@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Any, Dict, List
 
 from sqlalchemy import Column, ForeignKey, Integer, String, Text, UniqueConstraint
 from sqlalchemy.orm import Mapped, declarative_base, relationship
@@ -37,6 +37,17 @@ class DBShapeCollection(Base):
     graph_id: Mapped[str] = Column(String())
 
 
+class DBOntologyClosure(Base):
+    """Precomputed lookups into the class and property hierarchies of an
+    ontology, identified by a hash of the contents of the ontology.
+    """
+
+    __tablename__ = "ontology_closure"
+    id: Mapped[int] = Column(Integer, primary_key=True)
+    content_hash: Mapped[str] = Column(String(), nullable=False, unique=True)
+    closure: Mapped[Dict[str, Any]] = Column(JSONType)  # type: ignore
+
+
 class DBLibrary(Base):
     """A Library is a distributable collection of Templates and Shapes."""
 
@@ -1,8 +1,9 @@
 import logging
 import pathlib
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 import pygit2
 import pyshacl
@@ -16,14 +17,31 @@ from rdflib.util import guess_format
 
 from buildingmotif import get_building_motif
 from buildingmotif.database.tables import DBLibrary, DBTemplate
+from buildingmotif.dataclasses.model import Model
 from buildingmotif.dataclasses.shape_collection import ShapeCollection
 from buildingmotif.dataclasses.template import Template
+from buildingmotif.ontology_closure import (
+    OntologyClosure,
+    hierarchy_graph,
+    hierarchy_hash,
+)
 from buildingmotif.schemas import validate_libraries_yaml
 from buildingmotif.template_compilation import compile_template_spec
+from buildingmotif.template_matcher import BuildingIndex
+from buildingmotif.template_matcher import Mapping as TemplateMapping
+from buildingmotif.template_matcher import (
+    TemplateMatcher,
+    TemplatePattern,
+    remaining_template,
+)
 from buildingmotif.utils import (
+    Triple,
+    combine_graphs,
     get_ontology_files,
     get_template_parts_from_shape,
+    graph_from_triples,
     skip_uri,
+    worker_count,
 )
 
 if TYPE_CHECKING:
@@ -258,6 +276,7 @@ class Library:
             allow_warnings=True,
         )
 
+        previous_closure = cls._closure_key(ontology_name)
         lib = cls.create(ontology_name, overwrite=overwrite)
 
         class_candidates = set(ontology.subjects(rdflib.RDF.type, rdflib.OWL.Class))
@@ -284,6 +303,7 @@ class Library:
         assert shape_col_id is not None  # should always pass
         shape_col = ShapeCollection.load(shape_col_id)
         shape_col.add_graph(ontology)
+        lib._persist_closure(previous_closure)
 
         return lib
 
@@ -333,6 +353,7 @@ class Library:
                 )
                 return Library.load(name=directory.name)
 
+        previous_closure = cls._closure_key(directory.name)
         lib = cls.create(directory.name, overwrite=overwrite)
 
         # setup caches for reading templates
@@ -346,6 +367,7 @@ class Library:
         lib._resolve_template_dependencies(template_id_lookup, dependency_cache)
         # load shape collections from all ontology files in the directory
         lib._load_shapes_from_directory(directory)
+        lib._persist_closure(previous_closure)
 
         return lib
 
@@ -367,6 +389,32 @@ class Library:
         for description in libraries:
             _resolve_library_definition(description)
 
+    @staticmethod
+    def _closure_key(library_name: str) -> Optional[str]:
+        """Returns the hierarchy hash of the shapes of the library with the
+        given name, or None if there is no such library."""
+        bm = get_building_motif()
+        try:
+            db_library = bm.table_connection.get_db_library_by_name(library_name)
+        except sqlalchemy.exc.NoResultFound:
+            return None
+        return hierarchy_hash(
+            bm.graph_connection.get_graph(db_library.shape_collection.graph_id)
+        )
+
+    def _persist_closure(self, previous: Optional[str]) -> None:
+        """Precomputes the class hierarchy used by template matching and
+        stores it in the database, in place of the hierarchy of the library's
+        shapes before it was reloaded.
+
+        :param previous: the hierarchy hash of the library's earlier shapes
+            (see :py:meth:`_closure_key`)
+        :type previous: Optional[str]
+        """
+        closure = OntologyClosure.load(self.get_shape_collection().graph, persist=True)
+        if previous is not None and previous != closure.hierarchy_hash:
+            OntologyClosure.discard(previous)
+
     @staticmethod
     def _library_exists(library_name: str) -> bool:
         """Checks whether a library with the given name exists in the database."""
@@ -527,6 +575,177 @@ class Library:
             raise ValueError(f"Template {name} not in library {self._name}")
         return Template.load(dbt.id)
 
+    def find_subgraphs(
+        self,
+        model: Model,
+        *ontologies: rdflib.Graph,
+        workers: Optional[int] = None,
+        timeout: Optional[float] = None,
+        top_k: Optional[int] = None,
+    ) -> Dict[str, List[Tuple[TemplateMapping, rdflib.Graph, Optional[Template]]]]:
+        """Finds the subgraphs of the model that are partially or entirely
+        covered by each template of this library. See
+        :py:meth:`Template.find_subgraphs`.
+
+        The ontology and its closure are prepared once for all templates, as
+        is the index of the model graph. With more than one worker, each
+        worker process receives the model graph and the closure when it starts
+        and indexes the model once for all of the templates it matches.
+
+        :param model: the model to match the templates against
+        :type model: Model
+        :param ontologies: the ontology graphs to match with; defaults to the
+            shape collections of the libraries the templates depend on
+        :type ontologies: rdflib.Graph
+        :param workers: number of worker processes, defaults to the number of
+            CPUs. If 1, the templates are matched in this process.
+        :type workers: Optional[int], optional
+        :param timeout: seconds to spend on each template; the most complete
+            matches found before then are kept (see
+            :py:class:`TemplateMatcher`). Defaults to None, which does not
+            limit the time.
+        :type timeout: Optional[float], optional
+        :param top_k: the number of matches to keep for each template,
+            defaults to None, which keeps all of them
+        :type top_k: Optional[int], optional
+        :return: the matches of each template with at least one match, as
+            (mapping, subgraph, remaining template) tuples with the most
+            complete matches first. Templates are ordered by their most
+            complete match.
+        :rtype: Dict[str, List[Tuple[Mapping, rdflib.Graph, Optional[Template]]]]
+        """
+        workers = worker_count(workers)
+        if timeout is not None and timeout <= 0:
+            raise ValueError(f"timeout must be positive, not {timeout}")
+        if top_k is not None and top_k < 1:
+            raise ValueError(f"top_k must be positive, not {top_k}")
+
+        templates = self.get_templates()
+        if len(ontologies) == 0:
+            libraries: Dict[int, Library] = {}
+            for template in templates:
+                for library in template.library_dependencies():
+                    libraries.setdefault(library.id, library)
+            ontologies = tuple(
+                library.get_shape_collection().graph for library in libraries.values()
+            )
+        ontology = combine_graphs(*ontologies)
+        closure = OntologyClosure.load(*ontologies)
+
+        matches: Dict[str, List[Tuple[TemplateMapping, rdflib.Graph]]] = {}
+        if workers == 1:
+            index = BuildingIndex.build(model.graph, closure)
+            for template in templates:
+                matches[template.name] = _match_template(
+                    template, model.graph, ontology, closure, index, timeout, top_k
+                )
+        else:
+            # graphs are sent as lists of triples rather than serialized so
+            # that the blank nodes in the matches are the model's
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_match_worker,
+                initargs=(
+                    list(model.graph),
+                    list(hierarchy_graph(*ontologies)),
+                    closure,
+                ),
+            ) as executor:
+                futures = {
+                    template.name: executor.submit(
+                        _match_in_worker,
+                        template.name,
+                        list(template.body),
+                        template.parameters,
+                        timeout,
+                        top_k,
+                    )
+                    for template in templates
+                }
+                for name, future in futures.items():
+                    matches[name] = [
+                        (mapping, graph_from_triples(triples))
+                        for mapping, triples in future.result()
+                    ]
+
+        results: Dict[
+            str, List[Tuple[TemplateMapping, rdflib.Graph, Optional[Template]]]
+        ] = {}
+        for template in templates:
+            if not matches[template.name]:
+                continue
+            results[template.name] = [
+                (mapping, sg, remaining_template(template, mapping))
+                for mapping, sg in matches[template.name]
+            ]
+        ranked = sorted(results.items(), key=lambda item: -len(item[1][0][0]))
+        return dict(ranked)
+
+
+def _match_template(
+    template: Union[Template, TemplatePattern],
+    building: rdflib.Graph,
+    ontology: rdflib.Graph,
+    closure: OntologyClosure,
+    index: BuildingIndex,
+    timeout: Optional[float],
+    top_k: Optional[int],
+) -> List[Tuple[TemplateMapping, rdflib.Graph]]:
+    """Returns the most complete matches of a template, up to top_k of them
+    and until the timeout passes."""
+    matcher = TemplateMatcher(
+        building,
+        template,
+        ontology,
+        ontology_closure=closure,
+        building_index=index,
+        timeout=timeout,
+    )
+    matches: List[Tuple[TemplateMapping, rdflib.Graph]] = []
+    for mapping, sg in matcher.building_mapping_subgraphs_iter():
+        matches.append((mapping, sg))
+        if top_k is not None and len(matches) >= top_k:
+            break
+    if matcher.stats.timed_out:
+        logging.info(f"Stopped matching template {template.name} after {timeout}s")
+    return matches
+
+
+# the model and ontology used by a matching worker process; see
+# Library.find_subgraphs
+_worker_match_context: Optional[
+    Tuple[rdflib.Graph, rdflib.Graph, OntologyClosure, BuildingIndex]
+] = None
+
+
+def _init_match_worker(
+    building: List[Triple], ontology: List[Triple], closure: OntologyClosure
+) -> None:
+    global _worker_match_context
+    building_graph = graph_from_triples(building)
+    _worker_match_context = (
+        building_graph,
+        graph_from_triples(ontology),
+        closure,
+        BuildingIndex.build(building_graph, closure),
+    )
+
+
+def _match_in_worker(
+    name: str,
+    body: List[Triple],
+    parameters: Set[str],
+    timeout: Optional[float],
+    top_k: Optional[int],
+) -> List[Tuple[TemplateMapping, List[Triple]]]:
+    assert _worker_match_context is not None
+    building, ontology, closure, index = _worker_match_context
+    template = TemplatePattern(name, graph_from_triples(body), parameters)
+    matches = _match_template(
+        template, building, ontology, closure, index, timeout, top_k
+    )
+    return [(mapping, list(sg)) for mapping, sg in matches]
+
 
 def _resolve_library_definition(desc: Dict[str, Any]):
     """
@@ -1,5 +1,8 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Dict, List, Optional
+from itertools import chain, islice
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional, Set, Tuple
 
 import pyshacl
 import rdflib
@@ -7,9 +10,24 @@ import rfc3987
 
 from buildingmotif import get_building_motif
 from buildingmotif.dataclasses.shape_collection import ShapeCollection
-from buildingmotif.dataclasses.validation import ValidationContext
+from buildingmotif.dataclasses.validation import (
+    ValidationContext,
+    ValidationShapes,
+    merge_validation_reports,
+    split_validation_report,
+)
 from buildingmotif.namespaces import A
-from buildingmotif.utils import Triple, copy_graph, rewrite_shape_graph
+from buildingmotif.rule_engine import PreparedOntology
+from buildingmotif.utils import (
+    OverlayGraph,
+    Triple,
+    get_affected_focus_nodes,
+    get_focus_node_subgraph,
+    graph_changes_position,
+    graph_changes_since,
+    graph_from_triples,
+    worker_count,
+)
 
 if TYPE_CHECKING:
     from buildingmotif import BuildingMOTIF
@@ -128,16 +146,26 @@ class Model:
         for triple in triples:
             self.graph.add(triple)
 
-    def add_graph(self, graph: rdflib.Graph) -> None:
+    def add_graph(self, graph: rdflib.Graph, bulk: bool = False) -> None:
         """Add the given graph to the model.
 
         :param graph: the graph to add to the model
         :type graph: rdflib.Graph
+        :param bulk: if True, write the triples with
+            :py:meth:`GraphConnection.bulk_load`, which is much faster for
+            large graphs, defaults to False
+        :type bulk: bool, optional
         """
+        if bulk:
+            self._bm.graph_connection.bulk_load(self.graph.identifier, graph)
+            return
         self.graph += graph
 
     def validate(
-        self, shape_collections: Optional[List[ShapeCollection]] = None
+        self,
+        shape_collections: Optional[List[ShapeCollection]] = None,
+        previous: Optional[ValidationContext] = None,
+        incremental: bool = False,
     ) -> "ValidationContext":
         """Validates this model against the given list of ShapeCollections.
         If no list is provided, the model will be validated against the model's "manifest".
@@ -146,10 +174,28 @@ class Model:
 
         Loads all of the ShapeCollections into a single graph.
 
+        If the result of a previous validation of this model against the same
+        ShapeCollections is provided, and that validation was run with
+        `incremental` set, only the focus nodes which may be affected by the
+        triples added or removed since then are validated again, and the
+        results are merged into the previous report. The changes are those
+        this process made through the model's graph (see
+        :py:func:`utils.graph_changes_since`); changes made by other processes
+        are not seen. This falls back to validating the whole model if the
+        changes are not known or if the shapes can depend on arbitrary parts
+        of the model (see :py:func:`utils.get_shape_dependencies`).
+
         :param shape_collections: a list of ShapeCollections against which the
             graph should be validated. If an empty list or None is provided, the
             model will be validated against the model's manifest.
         :type shape_collections: List[ShapeCollection]
+        :param previous: the result of a previous validation of this model,
+            defaults to None
+        :type previous: Optional[ValidationContext], optional
+        :param incremental: if True, the changes made to the model from now on
+            are recorded so that the returned context can be passed as
+            `previous` to a later validation, defaults to False
+        :type incremental: bool, optional
         :return: An object containing useful properties/methods to deal with
             the validation results
         :rtype: ValidationContext
@@ -157,25 +203,24 @@ class Model:
         # TODO: determine the return types; At least a bool for valid/invalid,
         # but also want a report. Is this the base pySHACL report? Or a useful
         # transformation, like a list of deltas for potential fixes?
-        shapeg = rdflib.Graph()
         if shape_collections is None or len(shape_collections) == 0:
             shape_collections = [self.get_manifest()]
-        # aggregate shape graphs
-        for sc in shape_collections:
-            # inline sh:node for interpretability
-            shapeg += sc.graph
-        shapeg = rewrite_shape_graph(shapeg)
+        shapes = ValidationShapes.load(shape_collections)
+        position = graph_changes_position(self.graph) if incremental else None
+        if (
+            previous is not None
+            and previous.model.id == self.id
+            and previous._changes_position is not None
+            and previous._shapes_version == shapes.version
+        ):
+            context = self._validate_incremental(
+                shape_collections, shapes, previous, position
+            )
+            if context is not None:
+                return context
         # TODO: do we want to preserve the materialized triples added to data_graph via reasoning?
-        data_graph = copy_graph(self.graph)
-        valid, report_g, report_str = pyshacl.validate(
-            data_graph,
-            shacl_graph=shapeg,
-            ont_graph=shapeg,
-            advanced=True,
-            js=True,
-            allow_warnings=True,
-            # inplace=True,
-        )
+        # (the shapes validate an overlay of the model, which leaves it unchanged)
+        valid, report_g, report_str = shapes.validate(self.graph)
         assert isinstance(report_g, rdflib.Graph)
         return ValidationContext(
             shape_collections,
@@ -183,6 +228,53 @@ class Model:
             report_g,
             report_str,
             self,
+            _changes_position=position,
+            _shapes_version=shapes.version,
+        )
+
+    def _validate_incremental(
+        self,
+        shape_collections: List[ShapeCollection],
+        shapes: ValidationShapes,
+        previous: ValidationContext,
+        position: Optional[Hashable],
+    ) -> Optional[ValidationContext]:
+        """Validates the focus nodes affected by the changes to the model
+        since a previous validation. Returns None if the changes are not known
+        or the shapes do not allow an incremental validation.
+        """
+        if shapes.dependencies is None:
+            return None
+        forward, inverse = shapes.dependencies
+        changes = graph_changes_since(self.graph, previous._changes_position)
+        if changes is None:
+            return None
+
+        touched: Set[rdflib.term.Node] = set()
+        for s, p, o in changes:
+            # a removed pattern touches nodes which are not known
+            if s is None or (o is None and p != A):
+                return None
+            touched.add(s)
+            # adding an instance of a class does not affect the other instances
+            if p != A and not isinstance(o, rdflib.Literal):
+                touched.add(o)
+
+        focus_nodes = get_affected_focus_nodes(self.graph, touched, forward, inverse)
+        subgraph = get_focus_node_subgraph(self.graph, focus_nodes, forward, inverse)
+        _, report_g, _ = shapes.validate(subgraph)
+        assert isinstance(report_g, rdflib.Graph)
+        valid, report, report_str = merge_validation_reports(
+            previous.report, report_g, focus_nodes
+        )
+        return ValidationContext(
+            shape_collections,
+            valid,
+            report,
+            report_str,
+            self,
+            _changes_position=position,
+            _shapes_version=shapes.version,
         )
 
     def compile(self, shape_collections: List["ShapeCollection"]):
@@ -195,63 +287,41 @@ class Model:
             ShapeCollections
         :rtype: Graph
         """
-        ontology_graph = rdflib.Graph()
-        for shape_collection in shape_collections:
-            ontology_graph += shape_collection.graph
-
-        ontology_graph = ontology_graph.skolemize()
-
-        model_graph = copy_graph(self.graph).skolemize()
-
-        # We use a fixed-point computation approach to 'compiling' RDF models.
-        # We accomlish this by keeping track of the size of the graph before and after
-        # the inference step. If the size of the graph changes, then we know that the
-        # inference has had some effect. We do this at most 3 times to avoid looping
-        # forever.
-        pre_compile_length = len(model_graph)  # type: ignore
-        pyshacl.validate(
-            data_graph=model_graph,
-            shacl_graph=ontology_graph,
-            ont_graph=ontology_graph,
-            advanced=True,
-            inplace=True,
-            js=True,
-            allow_warnings=True,
+        ontology = PreparedOntology.load(shape_collections)
+        model_graph = self.graph.skolemize()
+        compiled, rounds = ontology.compile(model_graph)
+        logging.info(
+            f"Compiled model {self.name} in {len(rounds)} rounds: "
+            f"inferred {sum(r.triples_added for r in rounds)} triples in "
+            f"{sum(r.seconds for r in rounds):.3f}s"
         )
-        post_compile_length = len(model_graph)  # type: ignore
-
-        attempts = 3
-        while attempts > 0 and post_compile_length != pre_compile_length:
-            pre_compile_length = len(model_graph)  # type: ignore
-            pyshacl.validate(
-                data_graph=model_graph,
-                shacl_graph=ontology_graph,
-                ont_graph=ontology_graph,
-                advanced=True,
-                inplace=True,
-                js=True,
-                allow_warnings=True,
-            )
-            post_compile_length = len(model_graph)  # type: ignore
-            attempts -= 1
-        model_graph -= ontology_graph
-        return model_graph.de_skolemize()
+        return compiled.de_skolemize()
 
     def test_model_against_shapes(
         self,
         shape_collections: List["ShapeCollection"],
         shapes_to_test: List[rdflib.URIRef],
         target_class: rdflib.URIRef,
+        single_pass: bool = False,
     ) -> Dict[rdflib.URIRef, "ValidationContext"]:
         """Validates the model against a list of shapes and generates a
         validation report for each.
 
+        By default, the model is validated once per shape. In single-pass
+        mode, the targets are tagged with all shapes at once and the model is
+        validated once; the report is then split by the source shape of each
+        result. This is much faster for many shapes, but a shape can observe
+        the tags of the other shapes, e.g. through `sh:class`.
+
         :param shape_collections: list of ShapeCollections needed to run shapes
         :type shape_collection: List[ShapeCollection]
         :param shapes_to_test: list of shape URIs to validate the model against
         :type shapes_to_test: List[URIRef]
         :param target_class: the class upon which to run the selected shapes
         :type target_class: URIRef
+        :param single_pass: validate against all shapes at once, defaults to
+            False
+        :type single_pass: bool, optional
         :return: a dictionary that relates each shape to test URIRef to a
                  ValidationContext
         :rtype: Dict[URIRef, ValidationContext]
@@ -260,25 +330,59 @@ class Model:
         for shape_collection in shape_collections:
             ontology_graph += shape_collection.graph
 
-        model_graph = copy_graph(self.graph)
-
-        results = {}
-
-        for shape_uri in shapes_to_test:
-            targets = model_graph.triples((None, A, target_class))
-            temp_model_graph = copy_graph(model_graph)
-            for s, _, _ in targets:
-                temp_model_graph.add((s, A, shape_uri))
-
-            temp_model_graph += ontology_graph.cbd(shape_uri)
-
-            valid, report_g, report_str = pyshacl.validate(
-                data_graph=temp_model_graph,
+        model_graph = OverlayGraph(self.graph)
+        targets = list(model_graph.subjects(A, target_class))
+
+        if single_pass:
+            # maps each shape which can be the source of a result to the
+            # tested shapes it belongs to
+            source_shapes: Dict[rdflib.term.Node, Set[rdflib.term.Node]] = {}
+            for shape_uri in shapes_to_test:
+                shape_graph = ontology_graph.cbd(shape_uri)
+                for node in shape_graph.subjects():
+                    source_shapes.setdefault(node, set()).add(shape_uri)
+                model_graph += shape_graph
+                for s in targets:
+                    model_graph.add((s, A, shape_uri))
+            _, report_g, _ = pyshacl.validate(
+                data_graph=model_graph,
                 ont_graph=ontology_graph,
                 allow_warnings=True,
                 advanced=True,
                 js=True,
             )
+            reports = split_validation_report(report_g, source_shapes)
+            return {
+                shape_uri: ValidationContext(
+                    shape_collections, *reports[shape_uri], self
+                )
+                for shape_uri in shapes_to_test
+            }
+
+        results = {}
+        for shape_uri in shapes_to_test:
+            # pySHACL validates a copy of the data graph, so the shape and
+            # the tags can be added to the overlay and removed afterwards
+            added = [
+                triple
+                for triple in chain(
+                    ((s, A, shape_uri) for s in targets), ontology_graph.cbd(shape_uri)
+                )
+                if triple not in model_graph
+            ]
+            for triple in added:
+                model_graph.add(triple)
+            try:
+                valid, report_g, report_str = pyshacl.validate(
+                    data_graph=model_graph,
+                    ont_graph=ontology_graph,
+                    allow_warnings=True,
+                    advanced=True,
+                    js=True,
+                )
+            finally:
+                for triple in added:
+                    model_graph.remove(triple)
             results[shape_uri] = ValidationContext(
                 shape_collections,
                 valid,
@@ -296,3 +400,104 @@ class Model:
         :rtype: ShapeCollection
         """
         return ShapeCollection.load(self._manifest_id)
+
+
+# the shapes used by a validation worker process; see validate_models
+_worker_shapes: Optional[ValidationShapes] = None
+
+
+# graphs are sent to and from the workers as lists of triples rather than
+# serialized, so blank nodes keep their labels and the report still refers
+# to the focus nodes and property shapes of the graphs in this process
+def _init_validation_worker(shape_graph: List[Triple]) -> None:
+    global _worker_shapes
+    _worker_shapes = ValidationShapes(None, graph_from_triples(shape_graph))
+
+
+def _validate_in_worker(data_graph: List[Triple]) -> Tuple[bool, List[Triple], str]:
+    assert _worker_shapes is not None
+    valid, report_g, report_str = _worker_shapes.validate(
+        graph_from_triples(data_graph)
+    )
+    return valid, list(report_g), report_str
+
+
+def validate_models(
+    model_ids: List[int],
+    shape_collections: List[ShapeCollection],
+    workers: Optional[int] = None,
+    incremental: bool = False,
+) -> Dict[int, ValidationContext]:
+    """Validates many models against the same list of ShapeCollections in
+    parallel.
+
+    The shape graph is prepared once and sent to each worker process when
+    it starts. Model graphs are read from the database by this process and
+    handed to the workers one at a time, so each worker only holds a single
+    model in memory.
+
+    :param model_ids: ids of the models to validate
+    :type model_ids: List[int]
+    :param shape_collections: the ShapeCollections to validate against
+    :type shape_collections: List[ShapeCollection]
+    :param workers: number of worker processes, defaults to the number of
+        CPUs. If 1, the models are validated in this process.
+    :type workers: Optional[int], optional
+    :param incremental: record the changes made to each model from now on so
+        that its ValidationContext can be passed as `previous` to
+        :py:meth:`Model.validate`, defaults to False
+    :type incremental: bool, optional
+    :return: the validation results, keyed by model id
+    :rtype: Dict[int, ValidationContext]
+    """
+    workers = worker_count(workers)
+    shapes = ValidationShapes.load(shape_collections)
+    results: Dict[int, ValidationContext] = {}
+
+    if workers == 1:
+        for model_id in model_ids:
+            model = Model.load(model_id)
+            position = graph_changes_position(model.graph) if incremental else None
+            valid, report_g, report_str = shapes.validate(model.graph)
+            results[model_id] = ValidationContext(
+                shape_collections,
+                valid,
+                report_g,
+                report_str,
+                model,
+                _changes_position=position,
+                _shapes_version=shapes.version,
+            )
+        return results
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_validation_worker,
+        initargs=(list(shapes.graph),),
+    ) as executor:
+        pending: Dict[Future, Tuple[Model, Optional[Hashable]]] = {}
+        remaining = iter(model_ids)
+        while True:
+            # keep every worker busy without reading all models up front
+            for model_id in islice(remaining, 2 * workers - len(pending)):
+                model = Model.load(model_id)
+                # taken before the model is read, for incremental validation
+                position = graph_changes_position(model.graph) if incremental else None
+                future = executor.submit(_validate_in_worker, list(model.graph))
+                pending[future] = (model, position)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                model, position = pending.pop(future)
+                valid, report, report_str = future.result()
+                results[model.id] = ValidationContext(
+                    shape_collections,
+                    valid,
+                    graph_from_triples(report),
+                    report_str,
+                    model,
+                    _changes_position=position,
+                    _shapes_version=shapes.version,
+                )
+    return results
@@ -4,10 +4,11 @@ from pathlib import Path
 from typing import TYPE_CHECKING, List, Optional, Set
 
 import rdflib
-from rdflib import RDF, RDFS, URIRef
+from rdflib import RDF, URIRef
 
 from buildingmotif import get_building_motif
-from buildingmotif.namespaces import BMOTIF, OWL
+from buildingmotif.namespaces import BMOTIF, OWL, SH
+from buildingmotif.ontology_closure import OntologyClosure
 from buildingmotif.utils import Triple, copy_graph
 
 if TYPE_CHECKING:
@@ -128,13 +129,9 @@ class ShapeCollection:
         :return: list of included definition types
         :rtype: List[URIRef]
         """
-        children = ontology.subjects(RDFS.subClassOf, definition_type)
-
-        results = [definition_type]
-        for child in children:
-            results += cls._get_subclasses_of_definition_type(child)
-
-        return results
+        children = OntologyClosure.load(ontology).children(definition_type)
+        # sorted so that the order does not change from run to run
+        return [definition_type] + sorted(c for c in children if c != definition_type)
 
     @classmethod
     def _get_included_domains(cls, domain: URIRef) -> List[URIRef]:
@@ -201,25 +198,27 @@ class ShapeCollection:
             class
         :rtype: List[URIRef]
         """
-        # merge the contexts together w/ our graph if they are provided, else
-        # just use the existing shape collection graph
+        # the class structure comes from our graph and the contexts, if any
+        graphs = [self.graph]
         if contexts is not None:
-            context = sum(map(lambda x: x.graph, contexts), rdflib.Graph())
-            graph = self.graph + context
-        else:
-            graph = self.graph
-        rows = graph.query(
-            f"""
-            PREFIX sh: <http://www.w3.org/ns/shacl#>
-            SELECT ?shape WHERE {{
-            ?shape a sh:NodeShape .
-            {rdf_type.n3()} rdfs:subClassOf* ?class .
-            {{ ?shape sh:targetClass ?class }}
-            UNION
-            {{ ?shape sh:class ?class }}
-        }}"""
-        )
-        return [row[0] for row in rows]  # type: ignore
+            graphs.extend(context.graph for context in contexts)
+        closure = OntologyClosure.load(*graphs)
+
+        def in_any_graph(triple: Triple) -> bool:
+            return any(triple in graph for graph in graphs)
+
+        shapes: List[URIRef] = []
+        for cls in closure.parents(rdf_type):
+            for predicate in (SH.targetClass, SH["class"]):
+                candidates = set()
+                for graph in graphs:
+                    candidates.update(graph.subjects(predicate, cls))
+                shapes.extend(
+                    shape  # type: ignore
+                    for shape in candidates
+                    if in_any_graph((shape, RDF.type, SH.NodeShape))
+                )
+        return shapes
 
 
 def _resolve_imports(
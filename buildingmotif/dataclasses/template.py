@@ -3,26 +3,41 @@ import logging
 import warnings
 from collections import Counter
 from copy import copy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from io import BytesIO, StringIO
-from itertools import chain
+from itertools import repeat
 from os import PathLike
 from secrets import token_hex
-from typing import TYPE_CHECKING, Dict, Generator, List, Optional, Set, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Generator,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import rdflib
-from rdflib.term import Node
+from rdflib.term import BNode, Node
 
 from buildingmotif import get_building_motif
 from buildingmotif.dataclasses.model import Model
 from buildingmotif.namespaces import bind_prefixes
+from buildingmotif.ontology_closure import OntologyClosure
 from buildingmotif.template_matcher import Mapping, TemplateMatcher
 from buildingmotif.utils import (
     PARAM,
+    BlankNodeRenamer,
+    Triple,
     combine_graphs,
-    copy_graph,
-    remove_triples_with_node,
-    replace_nodes,
+    graph_hash,
 )
 
 if TYPE_CHECKING:
@@ -39,6 +54,14 @@ class Template:
     body: rdflib.Graph
     optional_args: List[str]
     _bm: "BuildingMOTIF"
+    # (version, plan) of the most recent call to compile()
+    _compiled: Optional[Tuple[Hashable, "CompiledTemplate"]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # (version, renamer) of the most recent call to in_memory_copy()
+    _renamer: Optional[Tuple[Hashable, BlankNodeRenamer]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @classmethod
     def load(cls, id: int) -> "Template":
@@ -70,11 +93,19 @@ class Template:
         return Template(
             _id=-1,
             _name=self._name,
-            body=copy_graph(self.body, preserve_blank_nodes=False),
+            body=self._body_renamer().copy(),
             optional_args=self.optional_args[:],
             _bm=self._bm,
         )
 
+    def _body_renamer(self) -> BlankNodeRenamer:
+        """Returns a renamer for the body of this template, which is reused
+        until the body changes."""
+        version = graph_hash(self.body)
+        if self._renamer is None or self._renamer[0] != version:
+            self._renamer = (version, BlankNodeRenamer(self.body))
+        return self._renamer[1]
+
     @property
     def id(self):
         return self._id
@@ -163,10 +194,7 @@ class Template:
         :return: set of parameters *without* dependencies
         :rtype: Set[str]
         """
-        # handle local parameters first
-        nodes = chain.from_iterable(self.body.triples((None, None, None)))
-        params = {str(p)[len(PARAM) :] for p in nodes if str(p).startswith(PARAM)}
-        return params
+        return set(self.compile().parameters)
 
     @property
     def dependency_parameters(self) -> Set[str]:
@@ -223,11 +251,10 @@ class Template:
         :return: a template with globally unique parameters
         :rtype: Template
         """
-        templ = self.in_memory_copy()
         suffix = f"{token_hex(4)}-inlined"
         # the lookup table of old to new parameter names
-        to_replace = {}
-        for param in templ.parameters:
+        to_replace: Dict[Node, Node] = {}
+        for param in self.parameters:
             # skip if (a) we want to preserve the param or (b) it is already inlined
             if (preserve_args and param in preserve_args) or (
                 param.endswith("-inlined")
@@ -235,8 +262,14 @@ class Template:
                 continue
             param = PARAM[param]
             to_replace[param] = rdflib.URIRef(f"{param}-{suffix}")
-        replace_nodes(templ.body, to_replace)
-        return templ
+        # parameters are renamed while the body is copied
+        return Template(
+            _id=-1,
+            _name=self._name,
+            body=self._body_renamer().copy(replace=to_replace),
+            optional_args=self.optional_args[:],
+            _bm=self._bm,
+        )
 
     def inline_dependencies(self) -> "Template":
         """Copies this template with all dependencies recursively inlined.
@@ -246,16 +279,60 @@ class Template:
         :return: copy of this template with all dependencies inlined
         :rtype: Template
         """
+        return self._inline_dependencies()[0].in_memory_copy()
+
+    def _inline_dependencies(
+        self,
+    ) -> Tuple["Template", Tuple[Tuple[rdflib.Graph, Hashable], ...]]:
+        """Inlines the dependencies of this template, memoizing the result.
+
+        The cached result is reused as long as the template dependency graph
+        is unchanged and none of the bodies which were inlined have been
+        edited. The returned template is shared with the cache and must not
+        be modified.
+
+        :return: the inlined template and the (body, version) pairs of every
+            template that was inlined into it
+        :rtype: Tuple[Template, Tuple[Tuple[rdflib.Graph, Hashable], ...]]
+        """
+        table_connection = self._bm.table_connection
+        dependency_version = table_connection.template_dependency_version
+        optional_args = tuple(self.optional_args)
+        cached = table_connection.template_inline_cache.get(self._id)
+        if (
+            cached is not None
+            and cached[0] == dependency_version
+            and cached[1] == optional_args
+            and all(graph_hash(g) == version for g, version in cached[2])
+        ):
+            return cached[3], cached[2]
+
+        templ, bodies = self._compute_inline_dependencies()
+        # templates which only exist in memory have no stable identity
+        if self._id >= 0:
+            table_connection.template_inline_cache[self._id] = (
+                dependency_version,
+                optional_args,
+                bodies,
+                templ,
+            )
+        return templ, bodies
+
+    def _compute_inline_dependencies(
+        self,
+    ) -> Tuple["Template", Tuple[Tuple[rdflib.Graph, Hashable], ...]]:
         templ = self.in_memory_copy()
+        bodies = [(self.body, graph_hash(self.body))]
         # if this template has no dependencies, then return unaltered
         if not self.get_dependencies():
-            return templ
+            return templ, tuple(bodies)
 
         # start with this template's parameters; this recurses into each
         # dependency to inline dependencies
         for dep in self.get_dependencies():
             # get the inlined version of the dependency
-            deptempl = dep.template.inline_dependencies()
+            inlined, dep_bodies = dep.template._inline_dependencies()
+            bodies.extend(dep_bodies)
 
             # replace dependency parameters with the names they inherit
             # through the provided bindings
@@ -267,27 +344,25 @@ class Template:
             # to exist
             name_prefix = dep.args.get("name")
             # for each parameter in the dependency...
-            for param in deptempl.parameters:
+            for param in inlined.parameters:
                 # if it does *not* have a mapping in the dependency, then
                 # prefix the parameter with the value of the 'name' binding
                 # to scope it properly
                 if param not in dep.args and param != "name":
                     rename_params[param] = f"{name_prefix}-{param}"
 
-            # replace the parameters in the dependency template
-            replace_nodes(
-                deptempl.body, {PARAM[k]: PARAM[v] for k, v in rename_params.items()}
-            )
+            # the parameters of the dependency after renaming
+            dep_params = {rename_params.get(p, p) for p in inlined.parameters}
 
             templ_optional_args = set(templ.optional_args)
             # figure out which of deptempl's parameters are encoded as 'optional' by the
             # parent (depending) template
-            deptempl_opt_args = deptempl.parameters.intersection(templ.optional_args)
+            deptempl_opt_args = dep_params.intersection(templ.optional_args)
             # if the 'name' of the deptempl is optional, then all the arguments inside deptempl
             # become optional
             if rename_params["name"] in deptempl_opt_args:
                 # mark all of deptempl's parameters as optional
-                templ_optional_args.update(deptempl.parameters)
+                templ_optional_args.update(dep_params)
             else:
                 # otherwise, only add the parameters that are explicitly
                 # marked as optional *and* appear in this dependency
@@ -295,16 +370,20 @@ class Template:
             # ensure that the optional_args includes all params marked as
             # optional by the dependency
             templ_optional_args.update(
-                [rename_params[n] for n in deptempl.optional_args]
+                [rename_params[n] for n in inlined.optional_args]
             )
 
             # convert our set of optional params to a list and assign to the parent template
             templ.optional_args = list(templ_optional_args)
 
-            # append the inlined template into the parent's body
-            templ.body += deptempl.body
+            # copy the inlined template into the parent's body, replacing
+            # the parameters of the dependency template on the way
+            inlined._body_renamer().copy(
+                into=templ.body,
+                replace={PARAM[k]: PARAM[v] for k, v in rename_params.items()},
+            )
 
-        return templ
+        return templ, tuple(bodies)
 
     def evaluate(
         self,
@@ -340,39 +419,179 @@ class Template:
             parameters were provided
         :rtype: Union[Template, rdflib.Graph]
         """
-        templ = self.in_memory_copy()
-        # put all of the parameter names into the PARAM namespace so they can be
-        # directly subsituted in the template body
-        uri_bindings: Dict[Node, Node] = {PARAM[k]: v for k, v in bindings.items()}
-        # replace the param:<name> URIs in the template body with the bindings
-        # provided in the call to evaluate()
-        replace_nodes(templ.body, uri_bindings)
+        compiled = self.compile()
+        unbound_params = compiled.parameters.difference(bindings.keys())
         leftover_params = (
-            templ.parameters.difference(bindings.keys())
+            unbound_params
             if not require_optional_args
-            else (templ.parameters.union(self.optional_args)).difference(
-                bindings.keys()
-            )
+            else (unbound_params.union(self.optional_args)).difference(bindings.keys())
         )
         # true if all parameters are now bound or only optional args are unbound
-        if len(templ.parameters) == 0 or (
-            not require_optional_args and templ.parameters == set(self.optional_args)
+        if len(unbound_params) == 0 or (
+            not require_optional_args and unbound_params == compiled.optional_args
         ):
-            bind_prefixes(templ.body)
+            graph = rdflib.Graph()
+            for prefix, namespace in compiled.namespaces:
+                graph.bind(prefix, namespace)
+            bind_prefixes(graph)
             if namespaces:
                 for prefix, namespace in namespaces.items():
-                    templ.body.bind(prefix, namespace)
-            if not require_optional_args:
-                # remove all triples that touch unbound optional_args
-                unbound_optional_args = set(templ.optional_args) - set(bindings.keys())
-                for arg in unbound_optional_args:
-                    remove_triples_with_node(templ.body, PARAM[arg])
-            return templ.body
+                    graph.bind(prefix, namespace)
+            # triples that touch unbound optional_args are left out
+            graph.addN((s, p, o, graph) for (s, p, o) in compiled.fill(bindings))
+            return graph
         if len(leftover_params) > 0 and warn_unused:
             warnings.warn(
                 f"Parameters \"{', '.join(leftover_params)}\" were not provided during evaluation"
             )
-        return templ
+        body = rdflib.Graph()
+        for prefix, namespace in compiled.namespaces:
+            body.bind(prefix, namespace)
+        body.addN(
+            (s, p, o, body) for (s, p, o) in compiled.fill(bindings, keep_unbound=True)
+        )
+        return Template(
+            _id=-1,
+            _name=self._name,
+            body=body,
+            optional_args=self.optional_args[:],
+            _bm=self._bm,
+        )
+
+    def evaluate_many(
+        self,
+        bindings_iter: Iterable[Dict[str, Node]],
+        into: Optional[rdflib.Graph] = None,
+        namespaces: Optional[Dict[str, rdflib.Namespace]] = None,
+    ) -> rdflib.Graph:
+        """Evaluate the template once for each of the provided bindings and
+        add all of the resulting triples to a single graph.
+
+        Every binding must bind all non-optional parameters of the template.
+        Triples that touch unbound optional parameters are left out.
+
+        :param bindings_iter: iterable of {name: RDF term} maps to substitute
+        :type bindings_iter: Iterable[Dict[str, Node]]
+        :param into: the graph to add the triples to; if None, a new graph with
+            the template's namespaces bound is created, defaults to None
+        :type into: Optional[rdflib.Graph], optional
+        :param namespaces: namespace bindings to add to the graph,
+            defaults to None
+        :type namespaces: Optional[Dict[str, rdflib.Namespace]], optional
+        :raises ValueError: if a binding leaves a non-optional parameter unbound
+        :return: the graph containing the triples of all evaluations
+        :rtype: rdflib.Graph
+        """
+        if into is None:
+            into = rdflib.Graph()
+            for prefix, namespace in self.compile().namespaces:
+                into.bind(prefix, namespace)
+            bind_prefixes(into)
+        if namespaces:
+            for prefix, namespace in namespaces.items():
+                into.bind(prefix, namespace)
+        graph = into
+        for batch in self.evaluate_batches(bindings_iter):
+            graph.addN((s, p, o, graph) for (s, p, o) in batch)
+        return graph
+
+    def evaluate_batches(
+        self, bindings_iter: Iterable[Dict[str, Node]], batch_size: int = 10000
+    ) -> Generator[List[Triple], None, None]:
+        """Evaluate the template once for each of the provided bindings,
+        yielding the resulting triples in batches.
+
+        Every binding must bind all non-optional parameters of the template.
+        Triples that touch unbound optional parameters are left out.
+
+        :param bindings_iter: iterable of {name: RDF term} maps to substitute
+        :type bindings_iter: Iterable[Dict[str, Node]]
+        :param batch_size: approximate number of triples per batch,
+            defaults to 10000
+        :type batch_size: int, optional
+        :raises ValueError: if a binding leaves a non-optional parameter unbound
+        :yield: lists of triples
+        :rtype: Generator[List[Triple], None, None]
+        """
+        compiled = self.compile()
+        required = compiled.parameters - compiled.optional_args
+        batch: List[Triple] = []
+        for bindings in bindings_iter:
+            missing = required.difference(
+                k for k, v in bindings.items() if v is not None
+            )
+            if missing:
+                raise ValueError(
+                    f"Parameters \"{', '.join(missing)}\" of template {self.name} were "
+                    "not provided during evaluation"
+                )
+            batch.extend(compiled.fill(bindings))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def evaluate_columns(
+        self,
+        columns: Dict[str, Sequence[Optional[Node]]],
+        into: Optional[rdflib.Graph] = None,
+        namespaces: Optional[Dict[str, rdflib.Namespace]] = None,
+    ) -> rdflib.Graph:
+        """Evaluate the template once for each row of the provided columns and
+        add all of the resulting triples to a single graph.
+
+        This is equivalent to calling :py:meth:`evaluate_many` with one binding
+        per row, but each triple of the template is filled for all rows at
+        once. A value of None in a column leaves the parameter unbound for
+        that row.
+
+        :param columns: map of parameter name to the RDF terms to substitute,
+            one per row; all columns must have the same length
+        :type columns: Dict[str, Sequence[Optional[Node]]]
+        :param into: the graph to add the triples to; if None, a new graph with
+            the template's namespaces bound is created, defaults to None
+        :type into: Optional[rdflib.Graph], optional
+        :param namespaces: namespace bindings to add to the graph,
+            defaults to None
+        :type namespaces: Optional[Dict[str, rdflib.Namespace]], optional
+        :raises ValueError: if the columns have different lengths or a row
+            leaves a non-optional parameter unbound
+        :return: the graph containing the triples of all evaluations
+        :rtype: rdflib.Graph
+        """
+        compiled = self.compile()
+        if into is None:
+            into = rdflib.Graph()
+            for prefix, namespace in compiled.namespaces:
+                into.bind(prefix, namespace)
+            bind_prefixes(into)
+        if namespaces:
+            for prefix, namespace in namespaces.items():
+                into.bind(prefix, namespace)
+        graph = into
+        graph.addN((s, p, o, graph) for (s, p, o) in compiled.fill_columns(columns))
+        return graph
+
+    def compile(self, inline: bool = False) -> "CompiledTemplate":
+        """Compile this template into an evaluation plan.
+
+        The plan is cached on the template and is rebuilt whenever the body
+        or the optional arguments of the template change.
+
+        :param inline: compile the template with all dependencies inlined
+            (see :py:meth:`inline_dependencies`), defaults to False
+        :type inline: bool, optional
+        :return: the compiled template
+        :rtype: CompiledTemplate
+        """
+        if inline:
+            # the inlined template is memoized, and so is its plan
+            return self._inline_dependencies()[0].compile()
+        version = (graph_hash(self.body), tuple(self.optional_args))
+        if self._compiled is None or self._compiled[0] != version:
+            self._compiled = (version, CompiledTemplate.from_template(self))
+        return self._compiled[1]
 
     def fill(
         self, ns: rdflib.Namespace, include_optional: bool = False
@@ -435,13 +654,14 @@ class Template:
         # if ontology is not specified, pull in all shapes related to this template's library
         # and all of its dependencies
         if len(ontologies) == 0:
-            ontology = rdflib.Graph()
-            for lib in self.library_dependencies():
-                ontology += lib.get_shape_collection().graph
-        else:
-            ontology = combine_graphs(*ontologies)
+            ontologies = tuple(
+                lib.get_shape_collection().graph for lib in self.library_dependencies()
+            )
+        ontology = combine_graphs(*ontologies)
+        # the closure is looked up from the parts, whose hashes are memoized
+        closure = OntologyClosure.load(*ontologies)
 
-        matcher = TemplateMatcher(model.graph, self, ontology)
+        matcher = TemplateMatcher(model.graph, self, ontology, ontology_closure=closure)
         for mapping, sg in matcher.building_mapping_subgraphs_iter():
             yield mapping, sg, matcher.remaining_template(mapping)
 
@@ -529,6 +749,179 @@ class Template:
         return f
 
 
+# kinds of slots in a CompiledTemplate triple
+_CONSTANT = 0
+_PARAMETER = 1
+_BLANK_NODE = 2
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """A precomputed evaluation plan for the body of a :py:class:`Template`.
+
+    Each triple of the body is stored as a tuple of slots. A slot is either a
+    constant term, a parameter (filled from the bindings) or a blank node
+    (renamed on every evaluation so that blank nodes stay unique to each
+    result). Evaluating the plan does not copy or scan the template body.
+    """
+
+    name: str
+    # each slot is a (kind, value) pair; see _CONSTANT, _PARAMETER, _BLANK_NODE
+    triples: Tuple[Tuple[Tuple[int, Any], ...], ...]
+    parameters: FrozenSet[str]
+    optional_args: FrozenSet[str]
+    namespaces: Tuple[Tuple[str, str], ...]
+    # plans with the triples of unbound optional args removed, keyed by the
+    # set of optional args which *are* bound
+    _pruned: Dict[FrozenSet[str], Tuple[Tuple[Tuple[int, Any], ...], ...]] = field(
+        default_factory=dict, repr=False, compare=False
+    )
+
+    @classmethod
+    def from_template(cls, template: Template) -> "CompiledTemplate":
+        """Builds the evaluation plan for the given template.
+
+        :param template: the template to compile
+        :type template: Template
+        :return: the compiled template
+        :rtype: CompiledTemplate
+        """
+        slots: Dict[Node, Tuple[int, Any]] = {}
+        parameters: Set[str] = set()
+        triples = []
+        for triple in template.body.triples((None, None, None)):
+            plan = []
+            for term in triple:
+                if term not in slots:
+                    if isinstance(term, BNode):
+                        slots[term] = (_BLANK_NODE, str(term))
+                    elif str(term).startswith(PARAM):
+                        name = str(term)[len(PARAM) :]
+                        parameters.add(name)
+                        slots[term] = (_PARAMETER, name)
+                    else:
+                        slots[term] = (_CONSTANT, term)
+                plan.append(slots[term])
+            triples.append(tuple(plan))
+        return cls(
+            name=template.name,
+            triples=tuple(triples),
+            parameters=frozenset(parameters),
+            optional_args=frozenset(template.optional_args),
+            namespaces=tuple(
+                (prefix, str(ns)) for prefix, ns in template.body.namespaces()
+            ),
+        )
+
+    def fill(
+        self, bindings: Dict[str, Node], keep_unbound: bool = False
+    ) -> Generator[Triple, None, None]:
+        """Fills the slots of the plan with the provided bindings.
+
+        :param bindings: map of parameter {name: RDF term} to substitute
+        :type bindings: Dict[str, Node]
+        :param keep_unbound: if True, unbound parameters are emitted as
+            parameter URIs; otherwise triples containing unbound parameters
+            are skipped, defaults to False
+        :type keep_unbound: bool, optional
+        :yield: the triples of the evaluated template
+        :rtype: Generator[Triple, None, None]
+        """
+        triples = self.triples if keep_unbound else self._prune(bindings)
+        # blank nodes are renamed the same way as in copy_graph
+        bnode_prefix = token_hex(4)
+        bnodes: Dict[str, BNode] = {}
+        for plan in triples:
+            triple = []
+            for kind, value in plan:
+                if kind == _CONSTANT:
+                    triple.append(value)
+                elif kind == _PARAMETER:
+                    term = bindings.get(value)
+                    if term is None:
+                        if not keep_unbound:
+                            break
+                        term = PARAM[value]
+                    triple.append(term)
+                else:
+                    if value not in bnodes:
+                        bnodes[value] = BNode(value=bnode_prefix + value)
+                    triple.append(bnodes[value])
+            else:
+                yield (triple[0], triple[1], triple[2])
+
+    def fill_columns(
+        self, columns: Dict[str, Sequence[Optional[Node]]]
+    ) -> Generator[Triple, None, None]:
+        """Fills the slots of the plan once per row of the provided columns.
+        Each triple of the plan is filled for all rows before moving on to
+        the next one. Triples with an unbound optional parameter in a row are
+        skipped for that row.
+
+        :param columns: map of parameter name to the RDF terms to substitute,
+            one per row; all columns must have the same length
+        :type columns: Dict[str, Sequence[Optional[Node]]]
+        :raises ValueError: if the columns have different lengths or a row
+            leaves a non-optional parameter unbound
+        :yield: the triples of all evaluations of the template
+        :rtype: Generator[Triple, None, None]
+        """
+        lengths = {len(column) for column in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        rows = lengths.pop() if lengths else 0
+        missing = {
+            param
+            for param in self.parameters - self.optional_args
+            if param not in columns or any(v is None for v in columns[param])
+        }
+        if missing and rows > 0:
+            raise ValueError(
+                f"Parameters \"{', '.join(missing)}\" of template {self.name} were "
+                "not provided during evaluation"
+            )
+
+        # blank nodes are renamed per row, as fill renames them per evaluation
+        bnode_prefix = token_hex(4)
+        bnodes: Dict[str, List[BNode]] = {}
+        for plan in self.triples:
+            slots: List[Iterable[Optional[Node]]] = []
+            for kind, value in plan:
+                if kind == _CONSTANT:
+                    slots.append(repeat(value, rows))
+                elif kind == _PARAMETER:
+                    if value not in columns:
+                        break
+                    slots.append(columns[value])
+                else:
+                    if value not in bnodes:
+                        bnodes[value] = [
+                            BNode(value=f"{bnode_prefix}{row}_{value}")
+                            for row in range(rows)
+                        ]
+                    slots.append(bnodes[value])
+            else:
+                for s, p, o in zip(*slots):
+                    if s is not None and p is not None and o is not None:
+                        yield (s, p, o)
+
+    def _prune(
+        self, bindings: Dict[str, Node]
+    ) -> Tuple[Tuple[Tuple[int, Any], ...], ...]:
+        """Returns the plan without the triples that touch the optional args
+        which are not bound. Computed once per set of bound optional args.
+        """
+        bound = self.optional_args.intersection(
+            k for k, v in bindings.items() if v is not None
+        )
+        if bound not in self._pruned:
+            unbound = {(_PARAMETER, arg) for arg in self.optional_args - bound}
+            self._pruned[bound] = tuple(
+                plan for plan in self.triples if unbound.isdisjoint(plan)
+            )
+        return self._pruned[bound]
+
+
 @dataclass
 class Dependency:
     """Dependency"""
@@ -3,16 +3,27 @@ from dataclasses import dataclass, field
 from functools import cached_property
 from itertools import chain
 from secrets import token_hex
-from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional, Set, Tuple
 
+import pyshacl
 import rdflib
-from rdflib import Graph, URIRef
+from pyshacl import ShapesGraph
+from rdflib import BNode, Graph, Literal, URIRef
 from rdflib.term import Node
 
 from buildingmotif import get_building_motif
 from buildingmotif.dataclasses.shape_collection import ShapeCollection
 from buildingmotif.namespaces import CONSTRAINT, PARAM, SH, A
-from buildingmotif.utils import _gensym, get_template_parts_from_shape, replace_nodes
+from buildingmotif.utils import (
+    LRUCache,
+    OverlayGraph,
+    _gensym,
+    get_shape_dependencies,
+    get_template_parts_from_shape,
+    graph_hash,
+    replace_nodes,
+    rewrite_shape_graph,
+)
 
 if TYPE_CHECKING:
     from buildingmotif.dataclasses import Library, Model, Template
@@ -245,6 +256,82 @@ class GraphClassCardinality(GraphDiff):
         return templs
 
 
+@dataclass
+class ValidationShapes:
+    """The aggregated and rewritten shape graph of a list of ShapeCollections,
+    ready to validate models against.
+
+    Instances are cached by :py:meth:`ValidationShapes.load`; the shapes
+    parsed by pySHACL are kept and reused by every validation.
+    """
+
+    # the ids and content hashes of the shape collections
+    version: Hashable
+    graph: Graph
+    _shapes: Optional[ShapesGraph] = field(default=None, repr=False)
+
+    @classmethod
+    def load(cls, shape_collections: List[ShapeCollection]) -> "ValidationShapes":
+        """Get the validation shapes for the given ShapeCollections, reusing
+        the cached shapes if none of the ShapeCollections changed since.
+
+        :param shape_collections: the ShapeCollections to validate against
+        :type shape_collections: List[ShapeCollection]
+        :return: the validation shapes
+        :rtype: ValidationShapes
+        """
+        version = tuple((sc.id, graph_hash(sc.graph)) for sc in shape_collections)
+
+        def aggregate() -> "ValidationShapes":
+            shapeg = Graph()
+            # aggregate shape graphs
+            for sc in shape_collections:
+                shapeg += sc.graph
+            # inline sh:node for interpretability
+            return cls(version, rewrite_shape_graph(shapeg))
+
+        return _validation_shapes_cache.get(version, aggregate)
+
+    @cached_property
+    def dependencies(self) -> Optional[Tuple[Set[URIRef], Set[URIRef]]]:
+        """The predicates the shapes follow through a data graph; see
+        :py:func:`utils.get_shape_dependencies`.
+        """
+        return get_shape_dependencies(self.graph)
+
+    def validate(self, data_graph: Graph) -> Tuple[bool, Graph, str]:
+        """Validate a data graph against these shapes. The shape graph is
+        also used as the ontology graph.
+
+        :param data_graph: the graph to validate; it is not modified
+        :type data_graph: Graph
+        :return: a tuple of whether the data graph conforms, the validation
+            report and its textual representation
+        :rtype: Tuple[bool, Graph, str]
+        """
+        # pySHACL mixes the ontology into (a copy of) the data graph; an
+        # overlay avoids copying the data graph
+        validator = pyshacl.Validator(
+            OverlayGraph(data_graph),
+            shacl_graph=self.graph,
+            ont_graph=self.graph,
+            options={
+                "advanced": True,
+                "use_js": True,
+                "allow_warnings": True,
+                "inplace": True,
+            },
+        )
+        if self._shapes is None:
+            self._shapes = validator.shacl_graph
+        else:
+            validator.shacl_graph = self._shapes
+        return validator.run()
+
+
+_validation_shapes_cache: LRUCache[Hashable, ValidationShapes] = LRUCache(8)
+
+
 @dataclass
 class ValidationContext:
     """Holds the necessary information for processing the results of SHACL
@@ -256,6 +343,12 @@ class ValidationContext:
     report: rdflib.Graph
     report_string: str
     model: "Model"
+    # the position in the record of changes to the model when it was
+    # validated (only kept if asked for with Model.validate(incremental=True))
+    # and the versions of the shape collections; used by Model.validate to
+    # revalidate only what changed since
+    _changes_position: Optional[Hashable] = field(default=None, repr=False)
+    _shapes_version: Optional[Hashable] = field(default=None, repr=False)
 
     @cached_property
     def diffset(self) -> Set[GraphDiff]:
@@ -452,3 +545,108 @@ def diffset_to_templates(diffset: Set[GraphDiff]) -> List["Template"]:
         assert isinstance(unified_evaluated, Template)
         templates.append(unified_evaluated)
     return templates
+
+
+def merge_validation_reports(
+    previous: Graph, update: Graph, focus_nodes: Set[Node]
+) -> Tuple[bool, Graph, str]:
+    """Replaces the results about the given focus nodes in a SHACL validation
+    report with the results about those focus nodes from another report.
+
+    :param previous: the report whose results should be updated
+    :type previous: Graph
+    :param update: a report on (at least) the given focus nodes
+    :type update: Graph
+    :param focus_nodes: the focus nodes whose results should be replaced
+    :type focus_nodes: Set[Node]
+    :return: a tuple of whether the merged report conforms, the merged report
+        and its textual representation
+    :rtype: Tuple[bool, Graph, str]
+    """
+    results = [
+        (previous, result)
+        for result in previous.objects(predicate=SH.result)
+        if previous.value(result, SH.focusNode) not in focus_nodes
+    ]
+    results.extend(
+        (update, result)
+        for result in update.objects(predicate=SH.result)
+        if update.value(result, SH.focusNode) in focus_nodes
+    )
+    return _build_report([previous, update], results)
+
+
+def split_validation_report(
+    report: Graph, source_shapes: Dict[Node, Set[Node]]
+) -> Dict[Node, Tuple[bool, Graph, str]]:
+    """Splits a SHACL validation report into one report per shape. Each
+    result is assigned to the shapes of its `sh:sourceShape`; results of
+    source shapes which are not in `source_shapes` are part of every report.
+
+    :param report: the report to split
+    :type report: Graph
+    :param source_shapes: maps the (node and property) shapes which can be
+        the source of a result to the shapes whose reports it belongs to
+    :type source_shapes: Dict[Node, Set[Node]]
+    :return: a dictionary relating each shape to a tuple of whether its
+        report conforms, the report and its textual representation
+    :rtype: Dict[Node, Tuple[bool, Graph, str]]
+    """
+    shape_results: Dict[Node, List[Tuple[Graph, Node]]] = {
+        shape: [] for shape in set().union(*source_shapes.values())
+    }
+    for result in report.objects(predicate=SH.result):
+        shapes = source_shapes.get(report.value(result, SH.sourceShape))
+        for shape, results in shape_results.items():
+            if shapes is None or shape in shapes:
+                results.append((report, result))
+    return {
+        shape: _build_report([report], results)
+        for shape, results in shape_results.items()
+    }
+
+
+def _build_report(
+    sources: List[Graph], results: List[Tuple[Graph, Node]]
+) -> Tuple[bool, Graph, str]:
+    """Builds a SHACL validation report from results of other reports."""
+    report = Graph()
+    for prefix, namespace in chain.from_iterable(g.namespaces() for g in sources):
+        report.bind(prefix, namespace)
+    root = BNode()
+    report.add((root, A, SH.ValidationReport))
+    for source, result in results:
+        report.add((root, SH.result, result))
+        report += source.cbd(result)
+
+    # warnings and infos are allowed, as in Model.validate
+    conforms = (None, SH.resultSeverity, SH.Violation) not in report
+    report.add((root, SH.conforms, Literal(conforms)))
+    return conforms, report, _report_to_string(report, conforms)
+
+
+def _report_to_string(report: Graph, conforms: bool) -> str:
+    """Renders a SHACL validation report in the style of pySHACL's text
+    reports.
+    """
+    results = list(report.objects(predicate=SH.result))
+    text = f"Validation Report\nConforms: {conforms}\n"
+    if results:
+        text += f"Results ({len(results)}):\n"
+    for result in results:
+        severity = report.value(result, SH.resultSeverity)
+        component = report.value(result, SH.sourceConstraintComponent)
+        kind = str(severity).split("#")[-1]
+        text += f"Constraint {kind} in {component}:\n"
+        for label, predicate in [
+            ("Severity", SH.resultSeverity),
+            ("Source Shape", SH.sourceShape),
+            ("Focus Node", SH.focusNode),
+            ("Value Node", SH.value),
+            ("Result Path", SH.resultPath),
+            ("Message", SH.resultMessage),
+        ]:
+            value = report.value(result, predicate)
+            if value is not None and not isinstance(value, BNode):
+                text += f"\t{label}: {value}\n"
+    return text
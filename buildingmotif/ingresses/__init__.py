@@ -1,6 +1,6 @@
 import logging
 
-from buildingmotif.ingresses.base import Record  # noqa
+from buildingmotif.ingresses.base import ColumnBatch, Record  # noqa
 from buildingmotif.ingresses.csv import CSVIngress  # noqa
 from buildingmotif.ingresses.template import (  # noqa
     TemplateIngress,
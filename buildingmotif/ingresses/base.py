@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from functools import cached_property
-from typing import List
+from itertools import groupby, islice
+from typing import Any, Dict, Generator, Iterator, List, Sequence
 
 from rdflib import Graph, Namespace
 
@@ -18,6 +19,20 @@ class Record:
     fields: dict
 
 
+@dataclass
+class ColumnBatch:
+    """Represents consecutive Records of the same type and with the same
+    fields, stored column by column"""
+
+    # the "type hint" shared by all of the records
+    rtype: str
+    # map from each field name to the values of that field, one per record
+    columns: Dict[str, list]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), ()))
+
+
 class IngressHandler:
     """Abstract superclass for Record/Graph ingress handlers"""
 
@@ -37,6 +52,87 @@ class RecordIngressHandler(IngressHandler):
         """
         raise NotImplementedError("Must be overridden by subclass")
 
+    def iter_records(
+        self, chunk_size: int = 10000
+    ) -> Generator[List[Record], None, None]:
+        """
+        Generates the Records from the underlying data source in chunks.
+        Subclasses which can read their source incrementally override this so
+        that only one chunk is held in memory at a time; by default, the
+        cached list of records is split into chunks.
+
+        :param chunk_size: the maximum number of records in each chunk,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: lists of at most chunk_size records
+        :rtype: Generator[List[Record], None, None]
+        """
+        yield from _chunks(iter(self.records), chunk_size)
+
+    def iter_columns(
+        self, chunk_size: int = 10000
+    ) -> Generator[ColumnBatch, None, None]:
+        """
+        Generates the Records from the underlying data source as batches of
+        columns. Subclasses which read tabular sources override this to build
+        the columns directly; by default, each chunk of records from
+        :py:meth:`iter_records` is split into runs of records with the same
+        type and fields, and each run is transposed into a batch.
+
+        :param chunk_size: the maximum number of records in each batch,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: batches of at most chunk_size records
+        :rtype: Generator[ColumnBatch, None, None]
+        """
+        for chunk in self.iter_records(chunk_size):
+            runs = groupby(chunk, key=lambda rec: (rec.rtype, tuple(rec.fields)))
+            for (rtype, keys), run in runs:
+                records = list(run)
+                yield ColumnBatch(
+                    rtype=rtype,
+                    columns={key: [rec.fields[key] for rec in records] for key in keys},
+                )
+
+
+def _chunks(
+    records: Iterator[Record], chunk_size: int
+) -> Generator[List[Record], None, None]:
+    """Splits an iterator of records into lists of at most chunk_size."""
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, not {chunk_size}")
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _column_batches(
+    rtype: str, header: Sequence[Any], rows: Iterator[Sequence[Any]], chunk_size: int
+) -> Generator[ColumnBatch, None, None]:
+    """Transposes rows of values into batches of at most chunk_size rows, with
+    a column for each name in the header. Short rows are padded with None and
+    values beyond the header are dropped. If the header repeats a name, the
+    last column with that name is kept, as when each row is made into a dict.
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, not {chunk_size}")
+    width = len(header)
+    padding = (None,) * width
+    while True:
+        chunk = [
+            row if len(row) == width else (tuple(row) + padding)[:width]
+            for row in islice(rows, chunk_size)
+        ]
+        if not chunk:
+            return
+        yield ColumnBatch(
+            rtype=rtype, columns=dict(zip(header, map(list, zip(*chunk))))
+        )
+
 
 class GraphIngressHandler(IngressHandler):
     """Generates a Graph from an underlying metadata source or RecordIngressHandler"""
@@ -1,4 +1,7 @@
+from typing import Dict
+
 from rdflib import Graph, Literal, Namespace
+from rdflib.term import Node
 
 from buildingmotif import BuildingMOTIF
 from buildingmotif.dataclasses import Library
@@ -44,32 +47,31 @@ class BACnetToBrickIngress(GraphIngressHandler):
         g = Graph()
         records = self.upstream.records
         assert records is not None
-        for record in records:
-            if record.rtype == "Device":
-                dev = record.fields
-                device_id = dev["device_id"]
-                name = _clean_uri(device_id) or _clean_uri(dev["address"])
-                dev_graph = self.device_template.evaluate(
-                    {
-                        "name": ns[name],
-                        "instance-number": Literal(device_id),
-                        "address": Literal(dev["address"]),
-                    }
-                )
-                assert isinstance(dev_graph, Graph)
-                g += dev_graph
-            elif record.rtype == "Object":
-                point = record.fields
-                device_id = point["device_id"]
-                obj_graph = self.object_template.evaluate(
-                    {
-                        "name": ns[f"{_clean_uri(point['name'])}-{point['address']}"],
-                        "identifier": Literal(f"{point['type']},{point['address']}"),
-                        "obj-name": Literal(point["name"]),
-                        "device": ns[_clean_uri(device_id)],
-                    }
-                )
-                assert isinstance(obj_graph, Graph)
-                g += obj_graph
+        devices = (r.fields for r in records if r.rtype == "Device")
+        self.device_template.evaluate_many(
+            (self._device_bindings(dev, ns) for dev in devices), into=g
+        )
+        points = (r.fields for r in records if r.rtype == "Object")
+        self.object_template.evaluate_many(
+            (self._object_bindings(point, ns) for point in points), into=g
+        )
 
         return g
+
+    def _device_bindings(self, dev: dict, ns: Namespace) -> Dict[str, Node]:
+        device_id = dev["device_id"]
+        name = _clean_uri(device_id) or _clean_uri(dev["address"])
+        return {
+            "name": ns[name],
+            "instance-number": Literal(device_id),
+            "address": Literal(dev["address"]),
+        }
+
+    def _object_bindings(self, point: dict, ns: Namespace) -> Dict[str, Node]:
+        device_id = point["device_id"]
+        return {
+            "name": ns[f"{_clean_uri(point['name'])}-{point['address']}"],
+            "identifier": Literal(f"{point['type']},{point['address']}"),
+            "obj-name": Literal(point["name"]),
+            "device": ns[_clean_uri(device_id)],
+        }
@@ -1,9 +1,15 @@
-from csv import DictReader
+from csv import DictReader, reader
 from functools import cached_property
 from pathlib import Path
-from typing import List
+from typing import Generator, List
 
-from buildingmotif.ingresses.base import Record, RecordIngressHandler
+from buildingmotif.ingresses.base import (
+    ColumnBatch,
+    Record,
+    RecordIngressHandler,
+    _chunks,
+    _column_batches,
+)
 
 
 class CSVIngress(RecordIngressHandler):
@@ -16,13 +22,46 @@ class CSVIngress(RecordIngressHandler):
 
     @cached_property
     def records(self) -> List[Record]:
-        records = []
-        rdr = DictReader(open(self.filename))
-        for row in rdr:
-            rec = Record(
-                rtype=str(self.filename),
-                fields=row,
-            )
-            records.append(rec)
-
-        return records
+        return [rec for chunk in self.iter_records() for rec in chunk]
+
+    def iter_records(
+        self, chunk_size: int = 10000
+    ) -> Generator[List[Record], None, None]:
+        """Reads the rows of the CSV file in chunks, so that only one chunk of
+        records is held in memory at a time. The file is closed once all rows
+        have been read or the generator is closed.
+
+        :param chunk_size: the maximum number of records in each chunk,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: lists of at most chunk_size records
+        :rtype: Generator[List[Record], None, None]
+        """
+        rtype = str(self.filename)
+        with open(self.filename, newline="") as f:
+            rows = (Record(rtype=rtype, fields=row) for row in DictReader(f))
+            yield from _chunks(rows, chunk_size)
+
+    def iter_columns(
+        self, chunk_size: int = 10000
+    ) -> Generator[ColumnBatch, None, None]:
+        """Reads the rows of the CSV file in chunks and transposes each chunk
+        into columns, without building a Record per row. Rows are read as
+        by :py:meth:`iter_records`: blank rows are skipped, missing values are
+        None and values beyond the header are dropped.
+
+        :param chunk_size: the maximum number of rows in each batch,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: batches of at most chunk_size rows
+        :rtype: Generator[ColumnBatch, None, None]
+        """
+        rtype = str(self.filename)
+        with open(self.filename, newline="") as f:
+            lines = reader(f)
+            header = next(lines, None)
+            if header is not None:
+                rows = filter(None, lines)
+                yield from _column_batches(rtype, header, rows, chunk_size)
@@ -1,14 +1,30 @@
-from typing import Callable, Optional
+import re
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from rdflib import Graph, Literal, Namespace, URIRef
 from rdflib.term import Node
 
 from buildingmotif.dataclasses import Template
+from buildingmotif.dataclasses.template import CompiledTemplate
 from buildingmotif.ingresses.base import (
     GraphIngressHandler,
     Record,
     RecordIngressHandler,
 )
+from buildingmotif.utils import Triple, worker_count
 
 
 class TemplateIngress(GraphIngressHandler):
@@ -17,6 +33,8 @@ class TemplateIngress(GraphIngressHandler):
     with each record. Produces a graph.
 
     If 'inline' is True, inlines all templates when they are instantiated.
+    With more than one worker, batches of records are evaluated in parallel
+    by a pool of processes.
     """
 
     def __init__(
@@ -25,6 +43,7 @@ class TemplateIngress(GraphIngressHandler):
         mapper: Optional[Callable[[str], str]],
         upstream: RecordIngressHandler,
         inline: bool = False,
+        workers: Optional[int] = 1,
     ):
         """
         Create a new TemplateIngress handler
@@ -41,6 +60,10 @@ class TemplateIngress(GraphIngressHandler):
         :param inline: if True, inline the template before evaluating it on
                       each row, defaults to False
         :type inline: bool, optional
+        :param workers: number of worker processes evaluating the template;
+                        None uses the number of CPUs, defaults to 1
+        :type workers: Optional[int], optional
+        :raises ValueError: if workers is not positive
         """
         self.mapper = mapper if mapper else lambda x: x
         self.upstream = upstream
@@ -48,19 +71,34 @@ class TemplateIngress(GraphIngressHandler):
             self.template = template.inline_dependencies()
         else:
             self.template = template
+        self.workers = worker_count(workers)
 
     def graph(self, ns: Namespace) -> Graph:
         g = Graph()
-
-        records = self.upstream.records
-        assert records is not None
-        for rec in records:
-            bindings = {self.mapper(k): _get_term(v, ns) for k, v in rec.fields.items()}
-            graph = self.template.evaluate(bindings)
-            assert isinstance(graph, Graph)
-            g += graph
+        g.addN((s, p, o, g) for s, p, o in self.triples(ns))
         return g
 
+    def triples(self, ns: Namespace) -> Generator[Triple, None, None]:
+        """Generates the triples of the graph without collecting them into a
+        graph, e.g. to bulk load them into a model with
+        :py:meth:`GraphConnection.bulk_load`.
+
+        :param ns: the namespace of the entities in the records
+        :type ns: Namespace
+        :raises ValueError: if a record leaves a non-optional parameter of the
+                            template unbound
+        :yield: the triples of the template evaluated on each record
+        :rtype: Generator[Triple, None, None]
+        """
+        plans = {0: self.template.compile()}
+        # records are read from upstream one batch of columns at a time, and
+        # the template is evaluated on all rows of a batch at once
+        tasks = (
+            (0, {self.mapper(k): v for k, v in batch.columns.items()})
+            for batch in self.upstream.iter_columns()
+        )
+        yield from _evaluate(tasks, plans, ns, self.workers)
+
 
 class TemplateIngressWithChooser(GraphIngressHandler):
     """
@@ -69,6 +107,8 @@ class TemplateIngressWithChooser(GraphIngressHandler):
     instantiated for each record. Produces a graph.
 
     If 'inline' is True, inlines all templates when they are instantiated.
+    With more than one worker, the records chosen for each template are
+    evaluated in parallel by a pool of processes.
     """
 
     def __init__(
@@ -77,6 +117,7 @@ class TemplateIngressWithChooser(GraphIngressHandler):
         mapper: Optional[Callable[[str], str]],
         upstream: RecordIngressHandler,
         inline=False,
+        workers: Optional[int] = 1,
     ):
         """
         Create a new TemplateIngress handler
@@ -96,32 +137,177 @@ class TemplateIngressWithChooser(GraphIngressHandler):
         :param inline: if True, inline the template before evaluating it on
                       each row, defaults to False
         :type inline: bool, optional
+        :param workers: number of worker processes evaluating the templates;
+                        None uses the number of CPUs, defaults to 1
+        :type workers: Optional[int], optional
+        :raises ValueError: if workers is not positive
         """
         self.chooser = chooser
         self.mapper = mapper if mapper else lambda x: x
         self.upstream = upstream
         self.inline = inline
+        self.workers = worker_count(workers)
 
     def graph(self, ns: Namespace) -> Graph:
         g = Graph()
-
-        records = self.upstream.records
-        assert records is not None
-        for rec in records:
-            template = self.chooser(rec)
-            if self.inline:
-                template = template.inline_dependencies()
-            bindings = {self.mapper(k): _get_term(v, ns) for k, v in rec.fields.items()}
-            graph = template.evaluate(bindings)
-            assert isinstance(graph, Graph)
-            g += graph
+        g.addN((s, p, o, g) for s, p, o in self.triples(ns))
         return g
 
+    def triples(self, ns: Namespace) -> Generator[Triple, None, None]:
+        """Generates the triples of the graph without collecting them into a
+        graph, e.g. to bulk load them into a model with
+        :py:meth:`GraphConnection.bulk_load`.
+
+        :param ns: the namespace of the entities in the records
+        :type ns: Namespace
+        :raises ValueError: if a record leaves a non-optional parameter of its
+                            template unbound
+        :yield: the triples of the chosen template evaluated on each record
+        :rtype: Generator[Triple, None, None]
+        """
+        plans: Dict[int, CompiledTemplate] = {}
+        yield from _evaluate(self._tasks(plans), plans, ns, self.workers)
+
+    def _tasks(
+        self, plans: Dict[int, CompiledTemplate]
+    ) -> Generator[Tuple[int, Dict[str, list]], None, None]:
+        """Groups each chunk of records by the template chosen for them and by
+        their fields, and transposes each group into columns. The plan of each
+        template is looked up once per chunk and added to `plans`; the tasks
+        refer to it by its key in `plans`."""
+        # plan keys by the id of the compiled template; `plans` keeps the
+        # compiled templates alive, so their ids are not reused
+        keys: Dict[int, int] = {}
+        for chunk in self.upstream.iter_records():
+            # the templates chosen in this chunk, by identity; keeping them
+            # keeps their ids from being reused within the chunk
+            templates: Dict[int, Template] = {}
+            # a missing field leaves its parameter unbound, so only records
+            # with the same fields share columns
+            groups: Dict[Tuple[int, Tuple[str, ...]], List[Record]] = defaultdict(list)
+            for rec in chunk:
+                template = self.chooser(rec)
+                templates.setdefault(id(template), template)
+                groups[(id(template), tuple(rec.fields))].append(rec)
+
+            plan_keys: Dict[int, int] = {}
+            for template_id, template in templates.items():
+                compiled = template.compile(inline=self.inline)
+                if id(compiled) not in keys:
+                    keys[id(compiled)] = len(plans)
+                    plans[len(plans)] = compiled
+                plan_keys[template_id] = keys[id(compiled)]
+            for (template_id, fields), records in groups.items():
+                yield plan_keys[template_id], {
+                    self.mapper(k): [rec.fields[k] for rec in records] for k in fields
+                }
+
+
+def _evaluate_columns(
+    compiled: CompiledTemplate, columns: Dict[str, list], ns: Namespace
+) -> List[Triple]:
+    """Evaluates the template on each row of a batch of field values."""
+    terms = {param: _get_terms(values, ns) for param, values in columns.items()}
+    return list(compiled.fill_columns(terms))
+
+
+def _evaluate(
+    tasks: Iterator[Tuple[int, Dict[str, list]]],
+    plans: Dict[int, CompiledTemplate],
+    ns: Namespace,
+    workers: int,
+) -> Generator[Triple, None, None]:
+    """Evaluates each (plan key, columns) task with the compiled template in
+    `plans`, in this process if workers is 1 and in a pool of processes
+    otherwise. The tasks may add plans as they are generated. The triples of
+    each task are yielded once it is done, in no particular order."""
+    if workers == 1:
+        for key, columns in tasks:
+            yield from _evaluate_columns(plans[key], columns, ns)
+        return
+
+    # a single pool evaluates all tasks. Each plan is sent along with the
+    # first task which uses it, and each worker keeps the plans it has seen;
+    # a worker which gets a task for a plan it has not seen hands it back,
+    # and the task is submitted again with its plan.
+    sent: Set[int] = set()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_ingress_worker, initargs=(ns,)
+    ) as executor:
+        pending: Dict[Future, Tuple[int, Dict[str, list]]] = {}
+
+        def submit(key: int, columns: Dict[str, list], with_plan: bool) -> None:
+            plan = plans[key] if with_plan else None
+            future = executor.submit(_evaluate_in_worker, key, plan, columns)
+            pending[future] = (key, columns)
+
+        while True:
+            # keep every worker busy without reading all records up front
+            for key, columns in islice(tasks, 2 * workers - len(pending)):
+                submit(key, columns, key not in sent)
+                sent.add(key)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, columns = pending.pop(future)
+                triples = future.result()
+                if triples is None:
+                    submit(key, columns, True)
+                else:
+                    yield from triples
+
+
+# the compiled templates and the namespace of an ingress worker process; see
+# _evaluate
+_worker_plans: Dict[int, CompiledTemplate] = {}
+_worker_ns: Optional[Namespace] = None
+
+
+def _init_ingress_worker(ns: Namespace) -> None:
+    global _worker_plans, _worker_ns
+    _worker_plans = {}
+    _worker_ns = ns
+
+
+def _evaluate_in_worker(
+    key: int, plan: Optional[CompiledTemplate], columns: Dict[str, list]
+) -> Optional[List[Triple]]:
+    """Evaluates a task in an ingress worker, keeping its plan if it is given.
+    Returns None if the worker has not seen the plan of the task."""
+    assert _worker_ns is not None
+    if plan is not None:
+        _worker_plans[key] = plan
+    elif key not in _worker_plans:
+        return None
+    return _evaluate_columns(_worker_plans[key], columns, _worker_ns)
+
+
+# characters which rdflib does not allow in URIs
+_INVALID_URI_CHARS = re.compile(r'[<>" {}|\\^`]')
+
 
 def _get_term(field_value: str, ns: Namespace) -> Node:
-    try:
-        uri = URIRef(ns[field_value])
-        uri.n3()  # raises an exception if invalid URI
-        return uri
-    except Exception:
+    # non-string values are not appended to the namespace, as in ns[value]
+    uri = ns + (field_value if isinstance(field_value, str) else "")
+    if _INVALID_URI_CHARS.search(uri):
         return Literal(field_value)
+    return URIRef(uri)
+
+
+def _get_terms(field_values: Sequence, ns: Namespace) -> List[Node]:
+    """Converts a column of field values to terms as _get_term does for each
+    value. Columns of strings are classified once: if no value can make an
+    invalid URI, the whole column becomes URIs without checking each value.
+    """
+    if not all(isinstance(v, str) for v in field_values):
+        return [_get_term(v, ns) for v in field_values]
+    prefix = str(ns)
+    if _INVALID_URI_CHARS.search(prefix):
+        return [Literal(v) for v in field_values]
+    if not _INVALID_URI_CHARS.search("".join(field_values)):
+        return [URIRef(prefix + v) for v in field_values]
+    return [
+        Literal(v) if _INVALID_URI_CHARS.search(v) else URIRef(prefix + v)
+        for v in field_values
+    ]
@@ -1,9 +1,18 @@
 import logging
-from functools import cached_property
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, partial
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Generator, List, Optional, Sequence
 
-from buildingmotif.ingresses.base import Record, RecordIngressHandler
+from buildingmotif.ingresses.base import (
+    ColumnBatch,
+    Record,
+    RecordIngressHandler,
+    _column_batches,
+)
+from buildingmotif.utils import worker_count
 
 try:
     from openpyxl import load_workbook
@@ -16,17 +25,30 @@ except ImportError:
 class XLSXIngress(RecordIngressHandler):
     """Reads sheets from a XLSX file and exposes them as records. The 'rtype'
     field of each Record gives the name of the sheet.
+
+    The workbook is opened in read-only mode and its rows are streamed, so
+    with a single worker only one chunk of rows is held in memory at a time.
+    With more than one worker, the sheets are read in parallel by a pool of
+    processes. Each worker reads a whole sheet before handing it back, so
+    memory is bounded by the size of the sheets rather than of the chunks:
+    up to one sheet per worker, plus the sheet being handed out, is held in
+    memory.
     """
 
-    def __init__(self, filename: Path):
+    def __init__(self, filename: Path, workers: Optional[int] = 1):
         """
         Path to the .xlsx file to be ingested
 
         :param filename: Path to a .xlsx file
         :type filename: Path
+        :param workers: number of worker processes reading sheets; None uses
+                        the number of CPUs, defaults to 1
+        :type workers: Optional[int], optional
+        :raises ValueError: if workers is not positive
         """
 
         self.filename = filename
+        self.workers = worker_count(workers)
 
     @cached_property
     def records(self) -> List[Record]:
@@ -38,20 +60,86 @@ class XLSXIngress(RecordIngressHandler):
                 are the cell values at that column for the given row.
         :rtype: List[Record]
         """
-        records = []
-        wb = load_workbook(self.filename)  # noqa
-        for sheetname in wb.sheetnames:
-            sheet = wb[sheetname]
-            columns = [sheet.cell(1, c + 1).value for c in range(sheet.max_column)]
-            for row in range(2, sheet.max_row + 1):
-                fields = {
-                    columns[c]: sheet.cell(row, c + 1).value
-                    for c in range(sheet.max_column)
-                }
-                records.append(
-                    Record(
-                        rtype=sheetname,
-                        fields=fields,
-                    )
-                )
-        return records
+        return [rec for chunk in self.iter_records() for rec in chunk]
+
+    def iter_records(
+        self, chunk_size: int = 10000
+    ) -> Generator[List[Record], None, None]:
+        """Reads the rows of all sheets in the XLSX file in chunks. Each chunk
+        holds rows of a single sheet.
+
+        :param chunk_size: the maximum number of records in each chunk,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: lists of at most chunk_size records
+        :rtype: Generator[List[Record], None, None]
+        """
+        for batch in self.iter_columns(chunk_size):
+            yield [
+                Record(rtype=batch.rtype, fields=dict(zip(batch.columns, values)))
+                for values in zip(*batch.columns.values())
+            ]
+
+    def iter_columns(
+        self, chunk_size: int = 10000
+    ) -> Generator[ColumnBatch, None, None]:
+        """Reads the rows of all sheets in the XLSX file and transposes them
+        into batches of columns. Each batch holds rows of a single sheet. The
+        first row of each sheet gives the names of the columns.
+
+        :param chunk_size: the maximum number of rows in each batch,
+                           defaults to 10000
+        :type chunk_size: int, optional
+        :raises ValueError: if chunk_size is not positive
+        :yield: batches of at most chunk_size rows
+        :rtype: Generator[ColumnBatch, None, None]
+        """
+        if self.workers == 1:
+            yield from _read_sheets(self.filename, None, chunk_size)
+            return
+
+        wb = load_workbook(self.filename, read_only=True)
+        sheetnames = wb.sheetnames
+        wb.close()
+        if len(sheetnames) < 2:
+            yield from _read_sheets(self.filename, sheetnames, chunk_size)
+            return
+        workers = min(self.workers, len(sheetnames))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            read_sheet = partial(_read_sheet, self.filename, chunk_size)
+            remaining = iter(sheetnames)
+            # read at most one sheet ahead per worker, rather than all of them
+            # as executor.map would; sheets come back in the order of the
+            # workbook
+            pending = deque(
+                executor.submit(read_sheet, sheetname)
+                for sheetname in islice(remaining, workers)
+            )
+            while pending:
+                batches = pending.popleft().result()
+                for sheetname in islice(remaining, 1):
+                    pending.append(executor.submit(read_sheet, sheetname))
+                yield from batches
+
+
+def _read_sheets(
+    filename: Path, sheetnames: Optional[Sequence[str]], chunk_size: int
+) -> Generator[ColumnBatch, None, None]:
+    """Streams the rows of the given sheets (all sheets if None) of the
+    workbook as batches of columns. The workbook is closed once all rows have
+    been read or the generator is closed."""
+    wb = load_workbook(filename, read_only=True)
+    try:
+        for sheetname in sheetnames or wb.sheetnames:
+            rows = wb[sheetname].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is not None:
+                yield from _column_batches(sheetname, header, rows, chunk_size)
+    finally:
+        wb.close()
+
+
+def _read_sheet(filename: Path, chunk_size: int, sheetname: str) -> List[ColumnBatch]:
+    """Reads all rows of one sheet of the workbook in a worker process."""
+    return list(_read_sheets(filename, [sheetname], chunk_size))
@@ -0,0 +1,395 @@
+"""
+Precomputed lookups into the class and property hierarchies of ontologies.
+
+A closure only depends on the rdfs:subClassOf, rdfs:subPropertyOf,
+owl:equivalentClass and owl:Class triples of an ontology, so closures are
+identified by a hash of those triples rather than by the identity of a Graph
+object. Every Graph with the same hierarchy (e.g. each union of library shape
+collections built for template matching) shares one closure. The closures
+of library shape collections are persisted to the database when the library
+is loaded, so they survive across processes; the closure of a union of
+shape collections is composed from theirs.
+"""
+import hashlib
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, List, Set
+
+from rdflib import BNode, Graph, URIRef
+from rdflib.term import Node
+
+from buildingmotif import get_building_motif
+from buildingmotif.building_motif.singleton import SingletonNotInstantiatedException
+from buildingmotif.namespaces import OWL, RDF, RDFS
+from buildingmotif.utils import LRUCache, Triple, graph_version, triples_hash
+
+
+def _hierarchy_triples(g: Graph) -> List[Triple]:
+    """Returns the triples of the graph which the closure depends on."""
+    triples: List[Triple] = []
+    triples.extend(g.triples((None, RDFS.subClassOf, None)))
+    triples.extend(g.triples((None, RDFS.subPropertyOf, None)))
+    triples.extend(g.triples((None, OWL.equivalentClass, None)))
+    triples.extend(g.triples((None, RDF.type, OWL.Class)))
+    return triples
+
+
+def hierarchy_graph(*graphs: Graph) -> Graph:
+    """Returns a graph with the class and property hierarchy of the union of
+    the given graphs, which is all a closure of them depends on.
+
+    :param graphs: the graphs which make up the ontology
+    :type graphs: Graph
+    :return: the hierarchy triples of the graphs
+    :rtype: Graph
+    """
+    hierarchy = Graph()
+    for g in graphs:
+        hierarchy.addN((s, p, o, hierarchy) for s, p, o in _hierarchy_triples(g))
+    return hierarchy
+
+
+def hierarchy_hash(g: Graph) -> str:
+    """Returns a hash of the class and property hierarchy of the graph which
+    does not depend on the order of the triples or on the identity of the
+    graph.
+
+    The hash is memoized until the contents of the graph change (see
+    :py:func:`utils.graph_version`).
+
+    :param g: the graph to hash
+    :type g: Graph
+    :return: a hex digest of the hierarchy triples of the graph
+    :rtype: str
+    """
+    return _hierarchy_hashes.get(
+        graph_version(g), lambda: triples_hash(_hierarchy_triples(g))
+    )
+
+
+def _union_hash(graphs: Iterable[Graph]) -> str:
+    """Returns a hash identifying the union of the given graphs. Duplicated
+    graphs and the order of the graphs do not matter."""
+    hashes = sorted({hierarchy_hash(g) for g in graphs})
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+
+
+def _closure(edges: Dict[Node, Set[Node]]) -> Dict[Node, FrozenSet[Node]]:
+    """Computes the reflexive transitive closure of each node with outgoing
+    edges."""
+    closure: Dict[Node, FrozenSet[Node]] = {}
+    for start in edges:
+        seen = {start}
+        stack = [start]
+        while stack:
+            for parent in edges.get(stack.pop(), ()):
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        closure[start] = frozenset(seen)
+    return closure
+
+
+def _invert(closure: Dict[Node, FrozenSet[Node]]) -> Dict[Node, FrozenSet[Node]]:
+    """Turns a map from nodes to themselves and their ancestors into a map
+    from nodes to themselves and their descendants."""
+    inverse: Dict[Node, Set[Node]] = defaultdict(set)
+    for node, ancestors in closure.items():
+        for ancestor in ancestors:
+            inverse[ancestor].update((node, ancestor))
+    return {node: frozenset(descendants) for node, descendants in inverse.items()}
+
+
+def _components(edges: Dict[Node, Set[Node]]) -> Dict[Node, FrozenSet[Node]]:
+    """Maps each node of an undirected graph to its connected component."""
+    components: Dict[Node, FrozenSet[Node]] = {}
+    for start in edges:
+        if start in components:
+            continue
+        component = {start}
+        stack = [start]
+        while stack:
+            for other in edges.get(stack.pop(), ()):
+                if other not in component:
+                    component.add(other)
+                    stack.append(other)
+        frozen = frozenset(component)
+        for node in component:
+            components[node] = frozen
+    return components
+
+
+@dataclass(frozen=True)
+class OntologyClosure:
+    """The transitive closures of the rdfs:subClassOf, rdfs:subPropertyOf and
+    owl:equivalentClass relations of an ontology and the set of classes it
+    defines. Each lookup is a dictionary access.
+
+    Use :py:meth:`OntologyClosure.load` to get the closure of a graph.
+    """
+
+    hierarchy_hash: str
+    # map from a class to itself and all of its superclasses
+    superclasses: Dict[Node, FrozenSet[Node]]
+    # map from a class to itself and all of its subclasses
+    subclasses: Dict[Node, FrozenSet[Node]]
+    # map from a property to itself and all of its superproperties
+    superproperties: Dict[Node, FrozenSet[Node]]
+    # map from a class to itself and all classes equivalent to it
+    equivalent_classes: Dict[Node, FrozenSet[Node]]
+    # the nodes which are declared as owl:Class
+    classes: FrozenSet[Node]
+
+    def parents(self, cls: Node) -> FrozenSet[Node]:
+        """Returns the class and all of its superclasses.
+
+        :param cls: the class
+        :type cls: Node
+        :return: the class and its superclasses
+        :rtype: FrozenSet[Node]
+        """
+        return self.superclasses.get(cls) or frozenset((cls,))
+
+    def children(self, cls: Node) -> FrozenSet[Node]:
+        """Returns the class and all of its subclasses.
+
+        :param cls: the class
+        :type cls: Node
+        :return: the class and its subclasses
+        :rtype: FrozenSet[Node]
+        """
+        return self.subclasses.get(cls) or frozenset((cls,))
+
+    def equivalents(self, cls: Node) -> FrozenSet[Node]:
+        """Returns the class and all classes equivalent to it.
+
+        :param cls: the class
+        :type cls: Node
+        :return: the class and its equivalent classes
+        :rtype: FrozenSet[Node]
+        """
+        return self.equivalent_classes.get(cls) or frozenset((cls,))
+
+    def parent_properties(self, prop: Node) -> FrozenSet[Node]:
+        """Returns the property and all of its superproperties.
+
+        :param prop: the property
+        :type prop: Node
+        :return: the property and its superproperties
+        :rtype: FrozenSet[Node]
+        """
+        return self.superproperties.get(prop) or frozenset((prop,))
+
+    def is_class(self, node: Node) -> bool:
+        """Returns True if the node is declared as an owl:Class.
+
+        :param node: the node
+        :type node: Node
+        :return: True if the node is a class
+        :rtype: bool
+        """
+        return node in self.classes
+
+    @classmethod
+    def compute(cls, *graphs: Graph) -> "OntologyClosure":
+        """Computes the closure of the union of the given graphs, without
+        consulting or populating any cache.
+
+        :param graphs: the graphs which make up the ontology
+        :type graphs: Graph
+        :return: the closure of the ontology
+        :rtype: OntologyClosure
+        """
+        subclass_of: Dict[Node, Set[Node]] = defaultdict(set)
+        subproperty_of: Dict[Node, Set[Node]] = defaultdict(set)
+        equivalent: Dict[Node, Set[Node]] = defaultdict(set)
+        classes: Set[Node] = set()
+        for g in graphs:
+            for child, predicate, parent in _hierarchy_triples(g):
+                if predicate == RDFS.subClassOf:
+                    subclass_of[child].add(parent)
+                elif predicate == RDFS.subPropertyOf:
+                    subproperty_of[child].add(parent)
+                elif predicate == OWL.equivalentClass:
+                    equivalent[child].add(parent)
+                    equivalent[parent].add(child)
+                else:
+                    classes.add(child)
+        superclasses = _closure(subclass_of)
+        return cls(
+            _union_hash(graphs),
+            superclasses,
+            _invert(superclasses),
+            _closure(subproperty_of),
+            _components(equivalent),
+            frozenset(classes),
+        )
+
+    @classmethod
+    def load(cls, *graphs: Graph, persist: bool = False) -> "OntologyClosure":
+        """Get the closure of the union of the given graphs. The closure is
+        looked up by the hash of the contents of the graphs, first in memory
+        and then in the database; if it is in neither, it is computed. Only
+        if `persist` is set is a computed closure stored in the database, so
+        looking up a closure does not write to the database.
+
+        Passing the parts of an ontology (e.g. the shape collections of
+        several libraries) rather than their union lets the hash of each part
+        be reused until that part changes. The closure of several parts is
+        composed from the closures of each part, which are looked up the same
+        way.
+
+        :param graphs: the graphs which make up the ontology
+        :type graphs: Graph
+        :param persist: store the closure in the database if it is not there
+            yet, defaults to False
+        :type persist: bool, optional
+        :return: the closure of the ontology
+        :rtype: OntologyClosure
+        """
+        key = _union_hash(graphs)
+        table_connection = _table_connection()
+
+        def load_or_compute() -> "OntologyClosure":
+            db_closure = (
+                table_connection.get_db_ontology_closure(key)
+                if table_connection is not None
+                else None
+            )
+            parts = {hierarchy_hash(g): g for g in graphs}
+            if db_closure is not None:
+                return cls._from_json(key, db_closure.closure)
+            if len(parts) > 1:
+                parts_closures = [cls.load(g) for g in parts.values()]
+                return cls._compose(key, parts_closures)
+            logging.debug(f"Computing the closure of ontology {key}")
+            return cls.compute(*graphs)
+
+        closure = _closures.get(key, load_or_compute)
+
+        if (
+            persist
+            and table_connection is not None
+            and table_connection.get_db_ontology_closure(key) is None
+        ):
+            table_connection.create_db_ontology_closure(key, closure._to_json())
+        return closure
+
+    @classmethod
+    def _compose(cls, key: str, parts: List["OntologyClosure"]) -> "OntologyClosure":
+        """Combines the closures of the parts of an ontology into the closure
+        of their union."""
+
+        def merged(closures: Iterable[Dict[Node, FrozenSet[Node]]]):
+            edges: Dict[Node, Set[Node]] = defaultdict(set)
+            for closure in closures:
+                for node, related in closure.items():
+                    edges[node].update(related)
+            return edges
+
+        superclasses = _closure(merged(part.superclasses for part in parts))
+        return cls(
+            key,
+            superclasses,
+            _invert(superclasses),
+            _closure(merged(part.superproperties for part in parts)),
+            _components(merged(part.equivalent_classes for part in parts)),
+            frozenset().union(*(part.classes for part in parts)),
+        )
+
+    @staticmethod
+    def discard(key: str) -> None:
+        """Delete the closure with the given hierarchy hash from the database
+        and from memory, e.g. the closure of an earlier version of a library.
+
+        :param key: the hierarchy hash of the closure
+        :type key: str
+        """
+        _closures.discard(key)
+        table_connection = _table_connection()
+        if table_connection is not None:
+            table_connection.delete_db_ontology_closure(key)
+
+    @staticmethod
+    def prune() -> int:
+        """Delete the closures stored in the database which do not belong to
+        the shape collection of any library, e.g. the closures of earlier
+        versions of a library. This reads the shape collection of every
+        library, so it is meant for occasional maintenance; loading a library
+        only discards the closure it replaces.
+
+        :return: the number of deleted closures
+        :rtype: int
+        """
+        try:
+            bm = get_building_motif()
+        except SingletonNotInstantiatedException:
+            return 0
+        live = {
+            hierarchy_hash(
+                bm.graph_connection.get_graph(db_library.shape_collection.graph_id)
+            )
+            for db_library in bm.table_connection.get_all_db_libraries()
+        }
+        return bm.table_connection.delete_db_ontology_closures(keep=live)
+
+    def _to_json(self) -> Dict[str, Any]:
+        def nontrivial(closure: Dict[Node, FrozenSet[Node]]) -> Dict[str, Any]:
+            return {
+                node.n3(): sorted(p.n3() for p in parents if p != node)
+                for node, parents in closure.items()
+                if len(parents) > 1
+            }
+
+        return {
+            "subClassOf": nontrivial(self.superclasses),
+            "subPropertyOf": nontrivial(self.superproperties),
+            "equivalentClass": nontrivial(self.equivalent_classes),
+            "classes": sorted(c.n3() for c in self.classes),
+        }
+
+    @classmethod
+    def _from_json(cls, key: str, data: Dict[str, Any]) -> "OntologyClosure":
+        terms: Dict[str, Node] = {}
+
+        def term(n3: str) -> Node:
+            node = terms.get(n3)
+            if node is None:
+                # classes and properties are URIs or blank nodes
+                node = BNode(n3[2:]) if n3.startswith("_:") else URIRef(n3[1:-1])
+                terms[n3] = node
+            return node
+
+        def closure(entries: Dict[str, Iterable[str]]) -> Dict[Node, FrozenSet[Node]]:
+            return {
+                term(node): frozenset([term(node)] + [term(p) for p in parents])
+                for node, parents in entries.items()
+            }
+
+        superclasses = closure(data["subClassOf"])
+        return cls(
+            key,
+            superclasses,
+            _invert(superclasses),
+            closure(data["subPropertyOf"]),
+            # closures stored for ontologies without owl:equivalentClass
+            # triples predate this entry
+            closure(data.get("equivalentClass", {})),
+            frozenset(term(c) for c in data["classes"]),
+        )
+
+
+def _table_connection():
+    """Returns the table connection of the BuildingMOTIF instance, or None if
+    there is none."""
+    try:
+        return get_building_motif().table_connection
+    except SingletonNotInstantiatedException:
+        return None
+
+
+_hierarchy_hashes: LRUCache[Hashable, str] = LRUCache(32)
+_closures: LRUCache[str, OntologyClosure] = LRUCache(8)
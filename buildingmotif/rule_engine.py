@@ -0,0 +1,360 @@
+import logging
+from dataclasses import dataclass, field
+from itertools import chain
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+
+import pyshacl
+from pyshacl.extras import check_extra_installed
+from pyshacl.functions import apply_functions, gather_functions, unapply_functions
+from pyshacl.helper import get_query_helper_cls
+from pyshacl.rules import gather_rules
+from pyshacl.rules.shacl_rule import SHACLRule
+from pyshacl.rules.sparql import SPARQLRule
+from pyshacl.shape import Shape
+from pyshacl.shapes_graph import ShapesGraph
+from pyshacl.target import apply_target_types, gather_target_types
+from rdflib import Graph
+from rdflib.store import Store, TripleAddedEvent
+from rdflib.term import Node
+
+from buildingmotif.namespaces import RDF, RDFS, SH
+from buildingmotif.utils import (
+    LRUCache,
+    OverlayGraph,
+    Triple,
+    get_rule_dependencies,
+    graph_hash,
+)
+
+if TYPE_CHECKING:
+    from buildingmotif.dataclasses import ShapeCollection
+
+
+@dataclass
+class RuleStats:
+    """Statistics about one application of a SHACL rule."""
+
+    shape: Node
+    rule: Node
+    triples_added: int
+    seconds: float
+
+
+@dataclass
+class CompileRound:
+    """Statistics about one round of rule evaluation."""
+
+    number: int
+    triples_added: int = 0
+    seconds: float = 0.0
+    rules: List[RuleStats] = field(default_factory=list)
+    # the triples added in this round
+    triples: List[Triple] = field(default_factory=list, repr=False)
+
+
+@dataclass
+class _RulePlan:
+    """A rule and the parts of the data graph it depends on."""
+
+    rule: SHACLRule
+    # predicates whose addition requires the rule to be applied again, or
+    # None if any addition does
+    reads: Optional[Set[Node]]
+    # classes whose new instances require the rule to be applied again
+    classes: Set[Node]
+    # whether the rule only needs to be applied again to focus nodes which
+    # appear in an added triple
+    local: bool
+
+
+class _AdditionLog:
+    """Records the triples added to a graph, in order, along with the position
+    of the most recent addition of each predicate and of an instance of each
+    class. The log records additions until it is closed."""
+
+    def __init__(self, graph: Graph) -> None:
+        self.graph: Optional[Graph] = graph
+        self.triples: List[Triple] = []
+        self.predicate_added: Dict[Node, int] = {}
+        self.instance_added: Dict[Node, int] = {}
+        self._superclasses: Dict[Node, Set[Node]] = {}
+        listener = _addition_listeners.get(graph.store)
+        if listener is None:
+            listener = _addition_listeners[graph.store] = _AdditionListener()
+            graph.store.dispatcher.subscribe(TripleAddedEvent, listener)
+        listener.logs.append(self)
+
+    def close(self) -> None:
+        """Stops recording additions and drops the recorded state."""
+        if self.graph is None:
+            return
+        listener = _addition_listeners.get(self.graph.store)
+        if listener is not None:
+            listener.logs.remove(self)
+        self.graph = None
+        self.triples = []
+        self.predicate_added.clear()
+        self.instance_added.clear()
+        self._superclasses.clear()
+
+    def _on_add(self, event) -> None:
+        # the event is dispatched before the triple is added, and also for
+        # triples which are already in the graph
+        graph = self.graph
+        if graph is None or event.triple in graph:
+            return
+        _, p, o = event.triple
+        position = len(self.triples)
+        self.triples.append(event.triple)
+        self.predicate_added[p] = position
+        if p == RDFS.subClassOf:
+            self._superclasses.clear()
+        elif p == RDF.type:
+            superclasses = self._superclasses.get(o)
+            if superclasses is None:
+                superclasses = set(graph.transitive_objects(o, RDFS.subClassOf))
+                self._superclasses[o] = superclasses
+            for cls in superclasses:
+                self.instance_added[cls] = position
+
+    def changed_since(self, position: int, plan: _RulePlan) -> bool:
+        """Returns True if a triple which the rule reads on every focus node
+        has been added since the given position."""
+        if plan.reads is None:
+            return len(self.triples) > position
+        return any(
+            self.predicate_added.get(p, -1) >= position for p in plan.reads
+        ) or any(self.instance_added.get(c, -1) >= position for c in plan.classes)
+
+    def touched_since(self, position: int) -> Set[Node]:
+        """Returns the nodes in the triples added since the given position."""
+        return set(chain.from_iterable(self.triples[position:]))
+
+    def __len__(self) -> int:
+        return len(self.triples)
+
+
+class _AdditionListener:
+    """Forwards the additions to a store to the open addition logs of graphs
+    in that store. rdflib cannot unsubscribe from a store's dispatcher, so a
+    store has a single listener which outlives the logs, rather than one
+    subscription per log."""
+
+    def __init__(self) -> None:
+        self.logs: List[_AdditionLog] = []
+
+    def __call__(self, event) -> None:
+        for log in self.logs:
+            log._on_add(event)
+
+
+# one addition listener per store; entries go away with their store
+_addition_listeners: "WeakKeyDictionary[Store, _AdditionListener]" = WeakKeyDictionary()
+
+
+def _apply_sparql_rule(rule: SPARQLRule, data_graph: Graph, nodes: Set[Node]) -> None:
+    """Applies a SPARQL rule to those of its focus nodes which are in `nodes`.
+    This mirrors :py:meth:`pyshacl.rules.sparql.SPARQLRule.apply`, which can
+    only be applied to all focus nodes. It reads private attributes of
+    SPARQLRule, so if another version of pySHACL lacks them, the rule is
+    applied to all focus nodes instead."""
+    constructs = getattr(rule, "_constructs", None)
+    prefix_helper = getattr(rule, "_qh", None)
+    if constructs is None or not hasattr(prefix_helper, "apply_prefixes"):
+        logging.debug(
+            f"pySHACL {pyshacl.__version__} does not expose the SPARQL rule "
+            "internals used to apply a rule to some focus nodes; applying "
+            f"{rule.node} to all focus nodes"
+        )
+        rule.apply(data_graph)
+        return
+    query_helper = get_query_helper_cls()
+    focus_nodes = [n for n in rule.shape.focus_nodes(data_graph) if n in nodes]
+    constructed = []
+    for node in rule.filter_conditions(focus_nodes, data_graph):
+        for construct in constructs:
+            bindings = {}
+            if query_helper.bind_this_regex.search(construct):
+                bindings["this"] = node
+            query = prefix_helper.apply_prefixes(construct)
+            constructed.append(data_graph.query(query, initBindings=bindings).graph)
+    for graph in constructed:
+        for triple in graph:
+            data_graph.add(triple)
+
+
+class RuleEngine:
+    """Applies the SHACL rules of a shape graph to data graphs until a fixed
+    point is reached.
+
+    Evaluation is semi-naive: the first round applies every rule; each later
+    round only applies a rule if a triple it reads was added since the rule
+    was last applied (see :py:func:`utils.get_rule_dependencies`). SPARQL
+    rules which only read arbitrary triples about the focus node are only
+    applied to the focus nodes in those triples. Evaluation stops once a
+    round adds no triples.
+    """
+
+    def __init__(self, shape_graph: Graph) -> None:
+        """Class constructor.
+
+        :param shape_graph: the graph containing the shapes and their rules
+        :type shape_graph: Graph
+        """
+        self.shapes = ShapesGraph(shape_graph)
+        if check_extra_installed("js"):
+            self.shapes.enable_js()
+        for shape in self.shapes.shapes:
+            shape.set_advanced(True)
+        apply_target_types(gather_target_types(self.shapes))
+        self._functions = gather_functions(self.shapes)
+
+        shape_rules = gather_rules(self.shapes)
+        self._plans: List[_RulePlan] = []
+        for shape in sorted(shape_rules, key=lambda s: s.order):
+            for rule in sorted(shape_rules[shape], key=lambda r: r.order):
+                if not rule.deactivated:
+                    self._plans.append(self._plan(shape_graph, shape, rule))
+
+    @staticmethod
+    def _plan(shape_graph: Graph, shape: Shape, rule: SHACLRule) -> _RulePlan:
+        deps = get_rule_dependencies(shape_graph, rule.node)
+        if deps is None or (shape.node, SH.target, None) in shape_graph:
+            return _RulePlan(rule, None, set(), False)
+        reads, classes = set(deps.predicates), set(deps.classes)
+        _, target_classes, implicit_classes, objects_of, subjects_of = shape.target()
+        if target_classes or implicit_classes:
+            reads.add(RDFS.subClassOf)
+        if deps.local and isinstance(rule, SPARQLRule):
+            # new focus nodes are in an added triple
+            return _RulePlan(rule, reads, classes, True)
+        classes.update(target_classes)
+        classes.update(implicit_classes)
+        reads.update(objects_of)
+        reads.update(subjects_of)
+        return _RulePlan(rule, reads, classes, False)
+
+    def run(
+        self, data_graph: Graph, max_rounds: Optional[int] = None
+    ) -> List[CompileRound]:
+        """Applies the rules to the data graph in place until no more triples
+        are inferred.
+
+        :param data_graph: the graph to apply the rules to
+        :type data_graph: Graph
+        :param max_rounds: stop after this many rounds even if no fixed point
+            has been reached, defaults to None (no limit)
+        :type max_rounds: Optional[int], optional
+        :return: statistics about each round
+        :rtype: List[CompileRound]
+        """
+        additions = _AdditionLog(data_graph)
+        # position in the addition log at which each rule was last applied
+        applied_at: Dict[int, int] = {}
+        rounds: List[CompileRound] = []
+        apply_functions(self._functions, data_graph)
+        try:
+            while max_rounds is None or len(rounds) < max_rounds:
+                stats = CompileRound(len(rounds) + 1)
+                round_start, round_size = perf_counter(), len(additions)
+                for idx, plan in enumerate(self._plans):
+                    since = applied_at.get(idx)
+                    rule_start, rule_size = perf_counter(), len(additions)
+                    if since is None or additions.changed_since(since, plan):
+                        plan.rule.apply(data_graph)
+                    elif plan.local and len(additions) > since:
+                        touched = additions.touched_since(since)
+                        _apply_sparql_rule(plan.rule, data_graph, touched)
+                    else:
+                        continue
+                    applied_at[idx] = rule_size
+                    stats.rules.append(
+                        RuleStats(
+                            plan.rule.shape.node,
+                            plan.rule.node,
+                            len(additions) - rule_size,
+                            perf_counter() - rule_start,
+                        )
+                    )
+                stats.triples = additions.triples[round_size:]
+                stats.triples_added = len(stats.triples)
+                stats.seconds = perf_counter() - round_start
+                rounds.append(stats)
+                logging.debug(
+                    f"Rule round {stats.number}: applied {len(stats.rules)} of "
+                    f"{len(self._plans)} rules, added {stats.triples_added} "
+                    f"triples in {stats.seconds:.3f}s"
+                )
+                if stats.triples_added == 0:
+                    break
+            else:
+                logging.warning(
+                    f"Stopped applying rules after {max_rounds} rounds "
+                    "without reaching a fixed point"
+                )
+        finally:
+            unapply_functions(self._functions, data_graph)
+            additions.close()
+        return rounds
+
+
+@dataclass
+class PreparedOntology:
+    """The aggregated and skolemized graph of a list of ShapeCollections and
+    a rule engine for its rules, ready to compile models against.
+
+    Instances are cached by :py:meth:`PreparedOntology.load`.
+    """
+
+    # the ids and content hashes of the shape collections
+    version: Hashable
+    graph: Graph
+    engine: RuleEngine
+
+    @classmethod
+    def load(cls, shape_collections: List["ShapeCollection"]) -> "PreparedOntology":
+        """Get the prepared ontology for the given ShapeCollections, reusing
+        the cached ontology if none of the ShapeCollections changed since.
+
+        :param shape_collections: the ShapeCollections to compile against
+        :type shape_collections: List[ShapeCollection]
+        :return: the prepared ontology
+        :rtype: PreparedOntology
+        """
+        version = tuple((sc.id, graph_hash(sc.graph)) for sc in shape_collections)
+
+        def prepare() -> "PreparedOntology":
+            ontology_graph = Graph()
+            for shape_collection in shape_collections:
+                ontology_graph += shape_collection.graph
+            ontology_graph = ontology_graph.skolemize()
+            return cls(version, ontology_graph, RuleEngine(ontology_graph))
+
+        return _prepared_ontology_cache.get(version, prepare)
+
+    def compile(self, model_graph: Graph) -> Tuple[Graph, List[CompileRound]]:
+        """Applies the rules of the ontology to a model graph. The rules can
+        read the ontology, but the compiled graph contains no triples of the
+        ontology.
+
+        :param model_graph: the skolemized graph of the model; it is not
+            modified
+        :type model_graph: Graph
+        :return: the compiled graph and statistics about each round of rule
+            evaluation
+        :rtype: Tuple[Graph, List[CompileRound]]
+        """
+        # the overlay only records the model and inferred triples which are
+        # not in the ontology, which are exactly the compiled model
+        data_graph = OverlayGraph(self.graph)
+        data_graph += model_graph
+        rounds = self.engine.run(data_graph, max_rounds=_COMPILE_MAX_ROUNDS)
+        return data_graph.added, rounds
+
+
+# a safety cap on the rounds of rule evaluation when compiling a model; rules
+# which keep inferring new triples would otherwise never stop
+_COMPILE_MAX_ROUNDS = 1000
+_prepared_ontology_cache: LRUCache[Hashable, PreparedOntology] = LRUCache(4)
@@ -1,19 +1,35 @@
 """
-Using the VF2 algorithm to compute subgraph isomorphisms between a template T and a graph G.
+Computes subgraph monomorphisms between a template T and a graph G.
 If the found isomorphism is a subgraph of T, then T is not fully matched and additional
 input is required to fully populate the template.
 """
+import time
 from collections import defaultdict
-from itertools import combinations, permutations
-from typing import TYPE_CHECKING, Callable, Dict, Generator, List, Optional, Set, Tuple
+from dataclasses import dataclass
+from itertools import chain, combinations, permutations, product
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import networkx as nx  # type: ignore
-from networkx.algorithms.isomorphism import DiGraphMatcher  # type: ignore
 from rdflib import Graph, URIRef
 from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
 from rdflib.term import Node
 
-from buildingmotif.namespaces import OWL, PARAM, RDF, RDFS
+from buildingmotif.namespaces import OWL, PARAM, RDF
+from buildingmotif.ontology_closure import OntologyClosure
 from buildingmotif.utils import copy_graph
 
 if TYPE_CHECKING:
@@ -22,37 +38,36 @@ if TYPE_CHECKING:
 Mapping = Dict[Node, Node]
 
 
+@dataclass
+class TemplatePattern:
+    """The parts of a template which a :py:class:`TemplateMatcher` reads, for
+    matching a template without loading it from the database, e.g. in a
+    worker process."""
+
+    name: str
+    body: Graph
+    parameters: Set[str]
+
+
 # used to accelerate monomorphism search
-# outer key is the address of the ontology graph
-# inner map is from a class to its parent classes
+# lookups into the ontology are answered by its closure; the types of the
+# nodes of each graph are cached, keyed by the address of the graph
 class _ontology_lookup_cache:
-    sc_cache: Dict[int, Dict[Node, Set[Node]]]
     t_cache: Dict[int, Dict[Node, Set[Node]]]
-    in_cache: Dict[int, Dict[Node, bool]]
+    closure: OntologyClosure
 
-    def __init__(self):
-        self.sc_cache = {}
-        self.sp_cache = {}
+    def __init__(self, closure: OntologyClosure):
         self.t_cache = {}
-        self.in_cache = {}
+        self.closure = closure
 
-    def parents(self, ntype: Node, ontology: Graph) -> Set[Node]:
-        if id(ontology) not in self.sc_cache:
-            self.sc_cache[id(ontology)] = {}
-        cache = self.sc_cache[id(ontology)]
-        # populate cache if necessary
-        if ntype not in cache:
-            cache[ntype] = set(ontology.transitive_objects(ntype, RDFS.subClassOf))
-        return cache[ntype]
-
-    def superproperties(self, ntype: Node, ontology: Graph) -> Set[Node]:
-        if id(ontology) not in self.sp_cache:
-            self.sp_cache[id(ontology)] = {}
-        cache = self.sp_cache[id(ontology)]
-        # populate cache if necessary
-        if ntype not in cache:
-            cache[ntype] = set(ontology.transitive_objects(ntype, RDFS.subPropertyOf))
-        return cache[ntype]
+    def parents(self, ntype: Node) -> AbstractSet[Node]:
+        return self.closure.parents(ntype)
+
+    def equivalents(self, ntype: Node) -> AbstractSet[Node]:
+        return self.closure.equivalents(ntype)
+
+    def superproperties(self, ntype: Node) -> AbstractSet[Node]:
+        return self.closure.parent_properties(ntype)
 
     def types(self, node: Node, graph: Graph) -> Set[URIRef]:
         if id(graph) not in self.t_cache:
@@ -65,14 +80,8 @@ class _ontology_lookup_cache:
             cache[node] = {OWL.NamedIndividual}
         return cache[node]  # type: ignore
 
-    def defined_in(self, node: Node, graph: Graph) -> bool:
-        if id(graph) not in self.in_cache:
-            self.in_cache[id(graph)] = {}
-        cache = self.in_cache[id(graph)]
-        # populate cache if necessary
-        if node not in cache:
-            cache[node] = (node, RDF.type, OWL.Class) in graph
-        return cache[node]
+    def is_class(self, node: Node) -> bool:
+        return self.closure.is_class(node)
 
 
 def _get_types(n: Node, g: Graph, _cache: _ontology_lookup_cache) -> Set[URIRef]:
@@ -110,25 +119,45 @@ def _compatible_types(
     """
     n1types = _get_types(n1, g1, _cache)
     n2types = _get_types(n2, g2, _cache)
+    return _covariant_types(n1types, n2types, ontology, _cache)
+
+
+def _covariant_types(
+    n1types: AbstractSet[Node],
+    n2types: AbstractSet[Node],
+    ontology: Graph,
+    _cache: _ontology_lookup_cache,
+) -> bool:
+    """
+    Returns true if some type of the first set is covariant with some type of
+    the second set.
+
+    :param n1types: types of the first node
+    :type n1types: AbstractSet[Node]
+    :param n2types: types of the second node
+    :type n2types: AbstractSet[Node]
+    :param ontology: The ontology graph that defines the class hierarchy
+    :type ontology: Graph
+    :return: True if the types are compatible, false otherwise
+    :rtype: bool
+    """
     # check if these are properties; if so, use subPropertyOf, not subClassOf
     property_types = {OWL.ObjectProperty, OWL.DatatypeProperty}
     if property_types.intersection(n1types) and property_types.intersection(n2types):
-        for n1type in _get_types(n1, g1, _cache):
-            for n2type in _get_types(n2, g2, _cache):
+        for n1type in n1types:
+            for n2type in n2types:
 
                 # check if types are covariant
                 if n2type in _cache.superproperties(
-                    n1type, ontology
-                ) or n1type in _cache.superproperties(n2type, ontology):
+                    n1type
+                ) or n1type in _cache.superproperties(n2type):
                     return True
     else:
-        for n1type in _get_types(n1, g1, _cache):
-            for n2type in _get_types(n2, g2, _cache):
+        for n1type in n1types:
+            for n2type in n2types:
 
                 # check if types are covariant
-                if n2type in _cache.parents(
-                    n1type, ontology
-                ) or n1type in _cache.parents(n2type, ontology):
+                if n2type in _cache.parents(n1type) or n1type in _cache.parents(n2type):
                     return True
     return False
 
@@ -170,10 +199,12 @@ def get_semantic_feasibility(
         if n1 == n2:
             return True
         # case 1: both are classes
-        if _cache.defined_in(n1, ontology) and _cache.defined_in(n2, ontology):
-            if n2 in _cache.parents(n1, ontology):
+        if _cache.is_class(n1) and _cache.is_class(n2):
+            if n2 in _cache.parents(n1):
                 return True
-            elif n1 in _cache.parents(n2, ontology):
+            elif n1 in _cache.parents(n2):
+                return True
+            elif n2 in _cache.equivalents(n1):
                 return True
             else:
                 return False
@@ -185,32 +216,6 @@ def get_semantic_feasibility(
     return semantic_feasibility
 
 
-class _VF2SemanticMatcher(DiGraphMatcher):
-    """
-    A subclass of DiGraphMatcher that incorporates semantic feasibility into the matching
-    process using the provided ontology.
-
-    :param T: template graph
-    :param G: building graph
-    :param ontology: ontology that contains the information about node semantics
-    """
-
-    def __init__(self, T: Graph, G: Graph, ontology: Graph):
-        super().__init__(rdflib_to_networkx_digraph(T), rdflib_to_networkx_digraph(G))
-        self.ontology = ontology
-        self._cache = _ontology_lookup_cache()
-        self._semantic_feasibility = get_semantic_feasibility(
-            T, G, ontology, self._cache
-        )
-
-    def semantic_feasibility(self, g1: Node, g2: Node) -> bool:
-        """
-        Returns true if the two nodes are semantically feasible to be matched.
-        """
-        val = self._semantic_feasibility(g1, g2)
-        return val
-
-
 def generate_all_subgraphs(T: Graph) -> Generator[Graph, None, None]:
     """Generates all node-induced subgraphs of T in order of decreasing size.
 
@@ -246,59 +251,563 @@ def digraph_to_rdflib(digraph: nx.DiGraph) -> Graph:
     return g
 
 
+def _edges_to_rdflib(digraph: nx.DiGraph, edges: Iterable[Tuple[Node, Node]]) -> Graph:
+    """Turns the edges of a `nx.DiGraph` between the given pairs of nodes into
+    an `rdflib.Graph`, like :py:func:`digraph_to_rdflib` on a subgraph of the
+    digraph but without copying it. Pairs which are not edges are ignored.
+
+    :param digraph: directed graph
+    :type digraph: nx.DiGraph
+    :param edges: pairs of nodes
+    :type edges: Iterable[Tuple[Node, Node]]
+    :return: RDF graph
+    :rtype: Graph
+    """
+    g = Graph()
+    succ = digraph.succ
+    for s, o in edges:
+        if s not in succ:
+            continue
+        pdict = succ[s].get(o)
+        if pdict is not None:
+            g.add((s, pdict["triples"][0][1], o))
+    return g
+
+
+@dataclass
+class BuildingIndex:
+    """The digraph of a building graph and its nodes, grouped for computing
+    match candidates. An index only depends on the building graph and the
+    ontology closure, so it can be shared by the matchers of many templates.
+    """
+
+    digraph: nx.DiGraph
+    # position of each node in the building digraph
+    order: Dict[Node, int]
+    # nodes which are classes in the ontology
+    classes: List[Node]
+    # all other nodes, grouped by their types
+    by_types: Dict[FrozenSet[Node], List[Node]]
+
+    @classmethod
+    def build(cls, building: Graph, closure: OntologyClosure) -> "BuildingIndex":
+        """Indexes a building graph.
+
+        :param building: the building graph
+        :type building: Graph
+        :param closure: the closure of the ontology used for matching
+        :type closure: OntologyClosure
+        :return: the index of the building graph
+        :rtype: BuildingIndex
+        """
+        digraph = rdflib_to_networkx_digraph(building)
+        _cache = _ontology_lookup_cache(closure)
+        order: Dict[Node, int] = {}
+        classes: List[Node] = []
+        by_types: Dict[FrozenSet[Node], List[Node]] = defaultdict(list)
+        for position, node in enumerate(digraph):
+            order[node] = position
+            if closure.is_class(node):
+                classes.append(node)
+            else:
+                by_types[frozenset(_cache.types(node, building))].append(node)
+        return cls(digraph, order, classes, dict(by_types))
+
+
+@dataclass
+class MatchStatistics:
+    """Counts of the search done by a :py:class:`TemplateMatcher`."""
+
+    # subsets of the template nodes which were searched for a match
+    subsets_searched: int = 0
+    # subsets which were not searched because a subset they extend has no match
+    subsets_pruned: int = 0
+    # building nodes tried as the match of a template node
+    candidates_tried: int = 0
+    # distinct mappings found
+    mappings: int = 0
+    # the search stopped at its deadline
+    timed_out: bool = False
+    # the search stopped after finding the maximum number of mappings
+    budget_exhausted: bool = False
+
+    @property
+    def complete(self) -> bool:
+        """True if the search was not cut short by a bound.
+
+        :return: whether every mapping was searched for
+        :rtype: bool
+        """
+        return not (self.timed_out or self.budget_exhausted)
+
+
+def remaining_template(template: "Template", mapping: Mapping) -> Optional["Template"]:
+    """Returns the part of the template left to be filled out given a mapping
+    found by a :py:class:`TemplateMatcher` for it.
+
+    :param template: the matched template
+    :type template: Template
+    :param mapping: mapping
+    :type mapping: Mapping
+    :return: remaining template to be filled out, or None if the mapping
+        binds every parameter
+    :rtype: Optional[Template]
+    """
+    # if all parameters are fulfilled by the mapping, then return None
+    mapping = {k: v for k, v in mapping.items() if str(v) in PARAM}
+    mapped_params: Set[Node] = {v for v in mapping.values()}
+    if not {PARAM[p] for p in template.parameters} - mapped_params:
+        # return self.building_subgraph_from_mapping(mapping)
+        return None
+    bindings = {}
+    for building_node, param in mapping.items():
+        if param is not None:
+            bindings[str(param)[len(PARAM) :]] = building_node
+    # this is a template because we don't have bindings for all of the
+    # template's parameters; unbound optional args stay in the template
+    res = template.evaluate(bindings, require_optional_args=True)
+    assert not isinstance(res, Graph)
+    return res
+
+
 class TemplateMatcher:
     """Computes the set of subgraphs of G that are monomorphic to T; these are
     organized by how "complete" the monomorphism is.
+
+    Mappings are found by a search over the lattice of subsets of the nodes
+    of T. The lattice is built bottom-up: a subset is only searched if the
+    subsets it extends have a match, and a match of the smaller subset is
+    tried as the prefix of a match of the larger one. Mappings are then
+    enumerated lazily, largest first, by :py:meth:`mappings_iter`.
+
+    Matchers of several templates against the same building can share one
+    :py:class:`BuildingIndex`, which must be built with the same ontology
+    closure.
+
+    The search can be bounded by the number of mappings (``max_mappings``),
+    by a number of seconds from the creation of the matcher (``timeout``) and
+    by the size of the mappings (``min_size``). A bounded search keeps the
+    mappings it found before it stopped; if it stops before the lattice is
+    built, these are the matches of the largest subsets found so far. How
+    much was searched is counted in :py:attr:`stats`.
     """
 
-    mappings: Dict[int, List[Mapping]]
-    template: "Template"
+    template: Union["Template", TemplatePattern]
     building: Graph
     template_bindings: Dict[str, Node]
     template_graph: Graph
+    ontology_closure: OntologyClosure
 
     def __init__(
         self,
         building: Graph,
-        template: "Template",
+        template: Union["Template", TemplatePattern],
         ontology: Graph,
         graph_target: Optional[Node] = None,
+        ontology_closure: Optional[OntologyClosure] = None,
+        building_index: Optional[BuildingIndex] = None,
+        max_mappings: Optional[int] = None,
+        timeout: Optional[float] = None,
+        min_size: int = 2,
     ):
-        self.mappings = defaultdict(list)
+        if max_mappings is not None and max_mappings < 1:
+            raise ValueError(f"max_mappings must be positive, not {max_mappings}")
+        if timeout is not None and timeout <= 0:
+            raise ValueError(f"timeout must be positive, not {timeout}")
+        self.max_mappings = max_mappings
+        self._deadline = time.monotonic() + timeout if timeout is not None else None
+        # mappings of size 1 do not relate any two nodes
+        self.min_size = max(min_size, 2)
+        self.stats = MatchStatistics()
+        self._mappings: Dict[int, List[Mapping]] = defaultdict(list)
+        self._mapping_keys: Dict[int, Set[FrozenSet[Tuple[Node, Node]]]] = defaultdict(
+            set
+        )
+        # sizes whose mappings have all been enumerated
+        self._complete_sizes: Set[int] = set()
         self.template_bindings = {}
         self.template = template
         self.building = building
         self.ontology = ontology
         self.graph_target = graph_target
+        # lookups into the ontology are shared by the matchers of all subgraphs
+        if ontology_closure is None:
+            ontology_closure = OntologyClosure.load(ontology)
+        self.ontology_closure = ontology_closure
+        self._cache = _ontology_lookup_cache(ontology_closure)
+        self._building_index = building_index
 
         self.template_graph = copy_graph(template.body)
         self.template_parameters: Set[Node] = {
             PARAM[p] for p in self.template.parameters
         }
+        self._template_digraph = rdflib_to_networkx_digraph(self.template_graph)
+        self._template_order = {
+            node: position for position, node in enumerate(self._template_digraph)
+        }
+        # the types of a template node, as they appear in the subgraphs of the
+        # template (see digraph_to_rdflib)
+        self._template_types: Dict[Node, Set[Node]] = defaultdict(set)
+        for s, o, pdict in self._template_digraph.edges(data=True):
+            if pdict["triples"][0][1] == RDF.type:
+                self._template_types[s].add(o)
+        self._node_candidates: Dict[
+            Tuple[Node, FrozenSet[Node]], Tuple[List[Node], Set[Node]]
+        ] = {}
+        # subsets of the template nodes which have a match, by size
+        self._lattice: Optional[Dict[int, List[FrozenSet[Node]]]] = None
+
+    @property
+    def building_index(self) -> BuildingIndex:
+        """The index of the building graph, built on first use unless one was
+        given to the matcher.
+
+        :return: index of the building graph
+        :rtype: BuildingIndex
+        """
+        if self._building_index is None:
+            self._building_index = BuildingIndex.build(
+                self.building, self.ontology_closure
+            )
+        return self._building_index
+
+    @property
+    def building_digraph(self) -> nx.DiGraph:
+        """The building graph as a networkx digraph.
 
-        self._generate_mappings()
+        :return: digraph of the building graph
+        :rtype: nx.DiGraph
+        """
+        return self.building_index.digraph
+
+    @property
+    def mappings(self) -> Dict[int, List[Mapping]]:
+        """All mappings, by size. Accessing this enumerates every mapping; use
+        :py:meth:`mappings_iter` to stop early.
 
-    def _generate_mappings(self):
-        for template_subgraph in generate_all_subgraphs(self.template_graph):
-            matching = _VF2SemanticMatcher(
-                self.building, template_subgraph, self.ontology
+        :return: map from a size to the mappings of that size
+        :rtype: Dict[int, List[Mapping]]
+        """
+        for _ in self.mappings_iter():
+            pass
+        return self._mappings
+
+    def _subset_types(self, node: Node, subset: AbstractSet[Node]) -> FrozenSet[Node]:
+        """Returns the types of a template node in the subgraph of the template
+        induced by the subset."""
+        types = frozenset(t for t in self._template_types[node] if t in subset)
+        return types or frozenset((OWL.NamedIndividual,))
+
+    def _candidates(
+        self, node: Node, types: FrozenSet[Node]
+    ) -> Tuple[List[Node], Set[Node]]:
+        """Returns the building nodes which are semantically feasible matches
+        for a template node with the given types, in the order of the building
+        digraph and as a set. See :py:func:`get_semantic_feasibility`.
+        """
+        key = (node, types)
+        if key in self._node_candidates:
+            return self._node_candidates[key]
+        index = self.building_index
+        closure = self.ontology_closure
+        _cache = self._cache
+        node_is_class = closure.is_class(node)
+        matches: Set[Node] = set()
+        for candidate in index.classes:
+            if candidate == node:
+                matches.add(candidate)
+            elif node_is_class:
+                if (
+                    node in closure.parents(candidate)
+                    or candidate in closure.parents(node)
+                    or node in closure.equivalents(candidate)
+                ):
+                    matches.add(candidate)
+            elif _covariant_types(
+                _cache.types(candidate, self.building), types, self.ontology, _cache
+            ):
+                matches.add(candidate)
+        # the feasibility of the other nodes only depends on their types
+        for candidate_types, nodes in index.by_types.items():
+            if _covariant_types(candidate_types, types, self.ontology, _cache):
+                matches.update(nodes)
+        if node in index.order:
+            matches.add(node)
+        ordered = sorted(matches, key=index.order.__getitem__)
+        self._node_candidates[key] = ordered, matches
+        return ordered, matches
+
+    def _assignments(
+        self, subset: FrozenSet[Node], prefix: Optional[Dict[Node, Node]] = None
+    ) -> Generator[Dict[Node, Node], None, None]:
+        """Enumerates the maps from the template nodes in the subset to
+        building nodes such that every edge of the template between nodes of
+        the subset is an edge of the building, and each pair of nodes is
+        semantically feasible.
+
+        The template nodes are assigned one at a time; each template node after
+        the first is chosen to share as many edges as possible with the nodes
+        that are already assigned, and its candidates are drawn from the
+        neighbors of their building nodes.
+
+        :param subset: template nodes to assign
+        :type subset: FrozenSet[Node]
+        :param prefix: assignments of some of the template nodes to extend,
+            defaults to None
+        :type prefix: Optional[Dict[Node, Node]]
+        :yield: maps from template nodes to building nodes
+        :rtype: Generator[Dict[Node, Node], None, None]
+        """
+        template = self._template_digraph
+        building = self.building_digraph
+        assigned: Dict[Node, Node] = dict(prefix or {})
+        used = set(assigned.values())
+
+        # plan the order of assignment
+        candidates = {
+            node: self._candidates(node, self._subset_types(node, subset))
+            for node in subset
+            if node not in assigned
+        }
+        placed = set(assigned)
+        plan = []
+        while len(placed) < len(subset):
+            node = min(
+                (n for n in subset if n not in placed),
+                key=lambda n: (
+                    -sum(
+                        1
+                        for m in chain(template.succ[n], template.pred[n])
+                        if m in placed
+                    ),
+                    len(candidates[n][0]),
+                    self._template_order[n],
+                ),
+            )
+            # (u, node) edges constrain the node's building node to successors
+            # of u's building node, and (node, u) edges to its predecessors
+            sources = [u for u in template.pred[node] if u in placed]
+            targets = [u for u in template.succ[node] if u in placed]
+            loop = node in template.succ[node]
+            # distinct neighbors of the node in the subset need distinct
+            # neighbors of its building node, which prunes the candidates of
+            # nodes without assigned neighbors
+            degrees = (
+                sum(1 for u in template.succ[node] if u in subset),
+                sum(1 for u in template.pred[node] if u in subset),
             )
-            if matching.subgraph_is_monomorphic():
-                for sg in matching.subgraph_monomorphisms_iter():
-                    # skip if the subgraph does not contain the graph node we care about
-                    if self.graph_target and self.graph_target not in sg.keys():
+            plan.append((node, candidates[node], sources, targets, loop, degrees))
+            placed.add(node)
+
+        def options(position: int) -> Iterator[Node]:
+            node, (ordered, feasible), sources, targets, loop, degrees = plan[position]
+            out_degree, in_degree = degrees
+            if sources:
+                pool: Iterable[Node] = building.succ[assigned[sources[0]]]
+            elif targets:
+                pool = building.pred[assigned[targets[0]]]
+            else:
+                pool = ordered
+            for candidate in pool:
+                if candidate in used or candidate not in feasible:
+                    continue
+                successors = building.succ[candidate]
+                if (
+                    len(successors) < out_degree
+                    or len(building.pred[candidate]) < in_degree
+                ):
+                    continue
+                if loop and candidate not in successors:
+                    continue
+                if any(candidate not in building.succ[assigned[u]] for u in sources):
+                    continue
+                if any(assigned[u] not in successors for u in targets):
+                    continue
+                yield candidate
+
+        if self._stopped():
+            return
+        if not plan:
+            yield dict(assigned)
+            return
+        stats = self.stats
+        stack = [options(0)]
+        while stack:
+            position = len(stack) - 1
+            node = plan[position][0]
+            previous = assigned.pop(node, None)
+            if previous is not None:
+                used.discard(previous)
+            candidate = next(stack[-1], None)
+            if candidate is None:
+                stack.pop()
+                continue
+            stats.candidates_tried += 1
+            if stats.candidates_tried % 1024 == 0 and self._past_deadline():
+                return
+            assigned[node] = candidate
+            used.add(candidate)
+            if position + 1 == len(plan):
+                yield dict(assigned)
+            else:
+                stack.append(options(position + 1))
+
+    def _past_deadline(self) -> bool:
+        """Returns True, and records that the search timed out, if the
+        deadline has passed."""
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self.stats.timed_out = True
+        return self.stats.timed_out
+
+    def _stopped(self) -> bool:
+        """Returns True if the search was stopped by one of its bounds."""
+        return not self.stats.complete
+
+    def _removable(self, node: Node, subset: AbstractSet[Node]) -> bool:
+        """Returns True if removing the node from the subset does not change
+        the types of the other nodes in the subset. Every match of the subset
+        is then an extension of a match of the subset without the node."""
+        return not any(
+            node in self._template_types[other] for other in subset if other != node
+        )
+
+    def _feasible_subsets(self) -> Dict[int, List[FrozenSet[Node]]]:
+        """Returns the subsets of the template nodes which have a match in the
+        building, by size. The lattice of subsets is built bottom-up and
+        subsets which extend a subset without a match are never searched.
+
+        :return: map from a size to the subsets of that size with a match
+        :rtype: Dict[int, List[FrozenSet[Node]]]
+        """
+        if self._lattice is not None:
+            return self._lattice
+        nodes = sorted(self._template_digraph, key=self._template_order.__getitem__)
+        stats = self.stats
+        # map from each subset with a match to one of its matches
+        level: Dict[FrozenSet[Node], Dict[Node, Node]] = {}
+        for node in nodes:
+            subset = frozenset((node,))
+            stats.subsets_searched += 1
+            witness = next(self._assignments(subset), None)
+            if witness is not None:
+                level[subset] = witness
+        lattice: Dict[int, List[FrozenSet[Node]]] = {}
+        # the witnesses of each size, kept until the lattice is built in case
+        # the search is stopped
+        levels: List[Dict[FrozenSet[Node], Dict[Node, Node]]] = []
+        size = 1
+        while level and not self._stopped():
+            lattice[size] = sorted(
+                level, key=lambda s: sorted(map(self._template_order.__getitem__, s))
+            )
+            next_level: Dict[FrozenSet[Node], Dict[Node, Node]] = {}
+            tried: Set[FrozenSet[Node]] = set()
+            for subset in lattice[size]:
+                for node in nodes:
+                    if node in subset:
+                        continue
+                    grown = subset | {node}
+                    if grown in tried:
                         continue
-                    # sg is a mapping from building graph nodes to template nodes
-                    # that constitutes a monomorphism.
-                    if len(sg) == 0:
+                    tried.add(grown)
+                    # prune: every subset this one extends must have a match
+                    if any(
+                        grown - {n} not in level
+                        for n in grown
+                        if self._removable(n, grown)
+                    ):
+                        stats.subsets_pruned += 1
                         continue
-                    # TODO: Limit mappings to those that include all of the params?
-                    # TODO: ignore optional parameters?
-                    # TODO: require that 'name' is in the parameters?
+                    if self._past_deadline():
+                        break
+                    stats.subsets_searched += 1
+                    witness = None
+                    if self._removable(node, grown):
+                        witness = next(
+                            self._assignments(grown, prefix=level[subset]), None
+                        )
+                    if witness is None:
+                        witness = next(self._assignments(grown), None)
+                    if self._stopped():
+                        break
+                    if witness is not None:
+                        next_level[grown] = witness
+                if self._stopped():
+                    break
+            levels.append(level)
+            if self._stopped():
+                # keep the matches of the largest subsets found so far
+                levels.append(next_level)
+                for witnesses in reversed(levels):
+                    for subset, witness in witnesses.items():
+                        if self._matchable(subset):
+                            self._record(witness)
+                if next_level:
+                    lattice[size + 1] = list(next_level)
+            level = next_level
+            size += 1
+        self._lattice = lattice
+        return lattice
+
+    def _has_isolated_node(self, subset: AbstractSet[Node]) -> bool:
+        """Returns True if some node of the subset has no edge to a node of
+        the subset. Such subsets do not correspond to a subgraph of the
+        template."""
+        template = self._template_digraph
+        return any(
+            not any(m in subset for m in chain(template.succ[n], template.pred[n]))
+            for n in subset
+        )
 
-                    # if there is an overlap, yield the subgraph
-                    if set(sg.values()).intersection(self.template_parameters):
-                        self.add_mapping(sg)
+    def _matchable(self, subset: AbstractSet[Node]) -> bool:
+        """Returns True if the matches of the subset are reported as
+        mappings."""
+        if len(subset) < self.min_size:
+            return False
+        if not self.template_parameters.intersection(subset):
+            return False
+        if self._has_isolated_node(subset):
+            return False
+        if self.graph_target is not None and not any(
+            self.graph_target in self._candidates(n, self._subset_types(n, subset))[1]
+            for n in subset
+        ):
+            return False
+        return True
+
+    def _record(self, assignment: Dict[Node, Node]) -> Optional[Mapping]:
+        """Records the mapping of an assignment of template nodes to building
+        nodes, and returns it unless it is filtered out or the search has
+        found as many mappings as it may."""
+        if self.stats.budget_exhausted:
+            return None
+        # mappings are from building graph nodes to template nodes
+        mapping = {building_node: node for node, building_node in assignment.items()}
+        # skip if the subgraph does not contain the graph node we care about
+        if self.graph_target and self.graph_target not in mapping:
+            return None
+        # TODO: Limit mappings to those that include all of the params?
+        # TODO: ignore optional parameters?
+        # TODO: require that 'name' is in the parameters?
+        self.add_mapping(mapping)
+        if self.max_mappings is not None and self.stats.mappings >= self.max_mappings:
+            self.stats.budget_exhausted = True
+        return mapping
+
+    def _generate_mappings(self, size: int) -> Generator[Mapping, None, None]:
+        """Enumerates the mappings of the given size and records them."""
+        for subset in self._feasible_subsets().get(size, []):
+            if not self._matchable(subset):
+                continue
+            for assignment in self._assignments(subset):
+                mapping = self._record(assignment)
+                if mapping is not None:
+                    yield mapping
+                if self._stopped() or self._past_deadline():
+                    return
+            if self._stopped():
+                return
+        self._complete_sizes.add(size)
 
     def add_mapping(self, mapping: Mapping):
         """Adds a mapping to the set of mappings.
@@ -306,8 +815,11 @@ class TemplateMatcher:
         :param mapping: mapping
         :type mapping: Mapping
         """
-        if mapping not in self.mappings[len(mapping)]:
-            self.mappings[len(mapping)].append(mapping)
+        key = frozenset(mapping.items())
+        if key not in self._mapping_keys[len(mapping)]:
+            self._mapping_keys[len(mapping)].add(key)
+            self._mappings[len(mapping)].append(mapping)
+            self.stats.mappings += 1
 
     @property
     def largest_mapping_size(self) -> int:
@@ -316,7 +828,9 @@ class TemplateMatcher:
         :return: size of largest mapping
         :rtype: int
         """
-        return max(self.mappings.keys())
+        for mapping in self.mappings_iter():
+            return len(mapping)
+        raise ValueError("There are no mappings of the template")
 
     def building_subgraph_from_mapping(self, mapping: Mapping) -> Graph:
         """Returns the subgraph of the building graph that corresponds to the
@@ -327,10 +841,8 @@ class TemplateMatcher:
         :return: subgraph
         :rtype: Graph
         """
-        g = rdflib_to_networkx_digraph(self.building)
         edges = permutations(mapping.keys(), 2)
-        sg = g.edge_subgraph(edges)
-        return digraph_to_rdflib(sg)
+        return _edges_to_rdflib(self.building_digraph, edges)
 
     def template_subgraph_from_mapping(self, mapping: Mapping) -> Graph:
         """Returns the subgraph of the template graph that corresponds to the
@@ -344,8 +856,8 @@ class TemplateMatcher:
         # TODO: need to keep the edges that are more generic than what we have inside the graph.
         # For example, if the building has (x a brick:AHU) then we don't need to remind them to
         # add an edge (x a brick:Equipment) because that is redundant
-        g = rdflib_to_networkx_digraph(self.template_graph)
-        return digraph_to_rdflib(g.subgraph(mapping.values()))
+        edges = product(mapping.values(), repeat=2)
+        return _edges_to_rdflib(self._template_digraph, edges)
 
     def remaining_template_graph(self, mapping: Mapping) -> Graph:
         """Returns the remaining template graph to be filled out given a
@@ -364,48 +876,43 @@ class TemplateMatcher:
 
         :param mapping: mapping
         :type mapping: Mapping
+        :raises TypeError: if the matcher was given a TemplatePattern rather
+            than a Template
         :return: remaining template to be filled out
         :rtype: Optional[Template]
         """
-        # if all parameters are fulfilled by the mapping, then return None
-        mapping = {k: v for k, v in mapping.items() if str(v) in PARAM}
-        mapped_params: Set[Node] = {v for v in mapping.values()}
-        if not self.template_parameters - mapped_params:
-            # return self.building_subgraph_from_mapping(mapping)
-            return None
-        bindings = {}
-        for building_node, param in mapping.items():
-            if param is not None:
-                bindings[str(param)[len(PARAM) :]] = building_node
-        # this *should* be a template because we don't have bindings for all of
-        # the template's parameters
-        res = self.template.evaluate(bindings)
-        assert not isinstance(res, Graph)
-        return res
+        if isinstance(self.template, TemplatePattern):
+            raise TypeError(
+                f"The remaining template of {self.template.name} needs a Template"
+            )
+        return remaining_template(self.template, mapping)
 
     def mappings_iter(self, size=None) -> Generator[Mapping, None, None]:
         """Returns an iterator over all of the mappings of the given size.
 
         If size is None, then all mappings are returned in descending order
         of the size of the mapping. This means the most complete mappings
-        will be returned first.
+        will be returned first. Mappings are searched for as they are
+        iterated, so stopping early skips the search for smaller mappings.
 
         :param size: size, defaults to None
         :type size: int, optional
         :yield: mapping iterator
         :rtype: Generator[Mapping, None, None]
         """
+        lattice = self._feasible_subsets()
         if size is None:
-            for size in sorted(self.mappings.keys(), reverse=True):
-                for mapping in self.mappings[size]:
-                    if not mapping:
-                        continue
-                    yield mapping
+            sizes = sorted(set(lattice) | set(self._mappings), reverse=True)
         else:
-            for mapping in self.mappings[size]:
-                if not mapping:
-                    continue
-                yield mapping
+            sizes = [size]
+        for size in sizes:
+            if size < self.min_size:
+                continue
+            if size in self._complete_sizes or self._stopped():
+                # a stopped search only has the mappings it already found
+                yield from list(self._mappings[size])
+            else:
+                yield from self._generate_mappings(size)
 
     def building_mapping_subgraphs_iter(
         self,
@@ -1,22 +1,51 @@
+import hashlib
 import logging
+import os
 import secrets
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from copy import copy
-from dataclasses import dataclass
-from itertools import chain
+from dataclasses import dataclass, field
+from itertools import chain, count
 from pathlib import Path
-from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
-
-from rdflib import BNode, Graph, Literal, URIRef
-from rdflib.paths import ZeroOrOne
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+from weakref import WeakKeyDictionary
+
+from rdflib import BNode, Graph, Literal, URIRef, Variable
+from rdflib.events import Event
+from rdflib.paths import (
+    AlternativePath,
+    InvPath,
+    MulPath,
+    NegatedPath,
+    SequencePath,
+    ZeroOrOne,
+)
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.stores.memory import Memory, SimpleMemory
+from rdflib.store import Store, TripleAddedEvent, TripleRemovedEvent
 from rdflib.term import Node
 
-from buildingmotif.namespaces import OWL, PARAM, RDF, SH, XSD, bind_prefixes
+from buildingmotif.namespaces import OWL, PARAM, RDF, RDFS, SH, XSD, bind_prefixes
 
 if TYPE_CHECKING:
     from buildingmotif.dataclasses import Template
 
 Triple = Tuple[Node, Node, Node]
+# a triple, or a pattern of triples with None for any term
+TriplePattern = Tuple[Optional[Node], Optional[Node], Optional[Node]]
 _gensym_counter = 0
 
 
@@ -48,24 +77,479 @@ def copy_graph(g: Graph, preserve_blank_nodes: bool = True) -> Graph:
     :return: a copy of the input graph
     :rtype: Graph
     """
+    if not preserve_blank_nodes:
+        return BlankNodeRenamer(g).copy()
     c = Graph()
     for pfx, ns in g.namespaces():
         c.bind(pfx, ns)
-    new_prefix = secrets.token_hex(4)
-    for t in g.triples((None, None, None)):
-        assert isinstance(t, tuple)
-        (s, p, o) = t
-        if not preserve_blank_nodes:
-            if isinstance(s, BNode):
-                s = BNode(value=new_prefix + s.toPython())
-            if isinstance(p, BNode):
-                p = BNode(value=new_prefix + p.toPython())
-            if isinstance(o, BNode):
-                o = BNode(value=new_prefix + o.toPython())
-        c.add((s, p, o))
+    c.addN((s, p, o, c) for (s, p, o) in g.triples((None, None, None)))
     return c
 
 
+class BlankNodeRenamer:
+    """Makes copies of a graph in which the blank nodes are renamed.
+
+    The graph is read once, when the renamer is created; every call to
+    :py:meth:`copy` gives the blank nodes fresh names, so a renamer can be
+    reused to make many copies of the same graph. Later changes to the graph
+    are not reflected in the copies.
+    """
+
+    def __init__(self, g: Graph):
+        """Class constructor.
+
+        :param g: the graph to copy
+        :type g: Graph
+        """
+        self.namespaces = list(g.namespaces())
+        # triples without blank nodes are copied as-is
+        self._plain: List[Triple] = []
+        self._with_bnodes: List[Triple] = []
+        bnodes: Set[BNode] = set()
+        for triple in g.triples((None, None, None)):
+            found = [term for term in triple if isinstance(term, BNode)]
+            if found:
+                self._with_bnodes.append(triple)
+                bnodes.update(found)
+            else:
+                self._plain.append(triple)
+        self.bnodes: List[BNode] = list(bnodes)
+
+    def rename_map(self) -> Dict[BNode, BNode]:
+        """Returns new names for the blank nodes of the graph; each call
+        returns different names.
+
+        :return: map from the blank nodes of the graph to their new names
+        :rtype: Dict[BNode, BNode]
+        """
+        prefix = secrets.token_hex(4)
+        return {b: BNode(value=prefix + b.toPython()) for b in self.bnodes}
+
+    def copy(
+        self, into: Optional[Graph] = None, replace: Optional[Dict[Node, Node]] = None
+    ) -> Graph:
+        """Copies the graph, giving its blank nodes new names.
+
+        :param into: the graph to add the triples to; if None, a new graph
+            with the namespaces of the original graph bound is created,
+            defaults to None
+        :type into: Optional[Graph], optional
+        :param replace: other nodes to replace while copying, as with
+            :py:func:`replace_nodes`, defaults to None
+        :type replace: Optional[Dict[Node, Node]], optional
+        :return: the graph containing the copied triples
+        :rtype: Graph
+        """
+        if into is None:
+            into = Graph()
+            for pfx, ns in self.namespaces:
+                into.bind(pfx, ns)
+        renamed: Dict[Node, Node] = dict(self.rename_map())
+        if replace:
+            renamed.update(replace)
+        rename = renamed.get
+        c = into
+        if replace:
+            c.addN(
+                (rename(s, s), rename(p, p), rename(o, o), c)
+                for (s, p, o) in self._plain
+            )
+        else:
+            c.addN((s, p, o, c) for (s, p, o) in self._plain)
+        c.addN(
+            (rename(s, s), rename(p, p), rename(o, o), c)
+            for (s, p, o) in self._with_bnodes
+        )
+        return c
+
+
+class OverlayStore(Store):
+    """A copy-on-write rdflib store which reads through to a base graph.
+
+    Triples added to the store are recorded in an in-memory graph, and
+    triples of the base graph removed from the store are recorded in a set;
+    the base graph itself is never modified.
+
+    The store is meant to be used briefly, while the base graph does not
+    change, e.g. for the duration of one validation. Changes to the base
+    graph are seen by the store, but a triple which was removed from the
+    store stays removed even if it is added to the base graph again, and the
+    length of the store only counts the changes made through the store. To
+    keep a graph beyond that, copy it with :py:meth:`OverlayGraph.materialize`.
+    """
+
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, base: Graph) -> None:
+        """Class constructor.
+
+        :param base: the graph to read through to
+        :type base: Graph
+        """
+        super().__init__()
+        self.base = base
+        self.added = Graph()
+        self.removed: Set[Triple] = set()
+        # the number of triples added to the store minus the number removed
+        self._size_change = 0
+        for prefix, namespace in base.namespaces():
+            self.added.store.bind(prefix, namespace)
+
+    def add(self, triple, context=None, quoted=False):
+        Store.add(self, triple, context, quoted)
+        if triple in self.removed:
+            self.removed.discard(triple)
+            self._size_change += 1
+        elif triple not in self.base and triple not in self.added:
+            self.added.add(triple)
+            self._size_change += 1
+
+    def remove(self, triple, context=None):
+        for match in list(self.base.triples(triple)):
+            if match not in self.removed:
+                Store.remove(self, match, context)
+                self.removed.add(match)
+                self._size_change -= 1
+        for match in list(self.added.triples(triple)):
+            Store.remove(self, match, context)
+            self.added.remove(match)
+            self._size_change -= 1
+
+    def triples(self, triple, context=None):
+        removed = self.removed
+        for match in self.base.triples(triple):
+            if not removed or match not in removed:
+                yield match, iter(())
+        base = self.base
+        for match in self.added.triples(triple):
+            # the triple may have been added to the base graph since
+            if match not in base:
+                yield match, iter(())
+
+    def __len__(self, context=None):
+        # consistent with triples() while the base graph does not change
+        return len(self.base) + self._size_change
+
+    def bind(self, prefix, namespace, override=True):
+        self.added.store.bind(prefix, namespace, override=override)
+
+    def prefix(self, namespace):
+        return self.added.store.prefix(namespace)
+
+    def namespace(self, prefix):
+        return self.added.store.namespace(prefix)
+
+    def namespaces(self):
+        return self.added.store.namespaces()
+
+
+class OverlayGraph(Graph):
+    """A graph which reads through to a base graph and records its own
+    changes, so that a graph can be changed briefly without copying it first.
+    See :py:class:`OverlayStore` for when the base graph may change.
+    """
+
+    def __init__(self, base: Graph) -> None:
+        """Class constructor.
+
+        :param base: the graph to read through to; it is never modified
+        :type base: Graph
+        """
+        super().__init__(store=OverlayStore(base), identifier=base.identifier)
+
+    @property
+    def added(self) -> Graph:
+        """The triples which were added to the overlay and are not in the
+        base graph."""
+        return self.store.added
+
+    @property
+    def removed(self) -> Set[Triple]:
+        """The triples of the base graph which were removed from the
+        overlay."""
+        return self.store.removed
+
+    def materialize(self) -> Graph:
+        """Copy the contents of the overlay into a new in-memory graph.
+
+        :return: the copy
+        :rtype: Graph
+        """
+        graph = Graph()
+        for prefix, namespace in self.namespaces():
+            graph.bind(prefix, namespace)
+        graph += self
+        return graph
+
+
+class _StoreChangeCounter:
+    """Counts the add/remove events dispatched by an rdflib store, per graph,
+    and records the events of the graphs whose changes are asked for (see
+    :py:func:`graph_changes_since`).
+    """
+
+    def __init__(self, store: Store):
+        # identifies this counter among all counters of this process; unlike
+        # id(store), it is never reused by a later store
+        self.token = next(_change_counter_tokens)
+        # bumped by events which are not scoped to a single graph
+        self.epoch = 0
+        self.counts: Dict[Node, int] = defaultdict(int)
+        self.journals: Dict[Node, _ChangeJournal] = {}
+        store.dispatcher.subscribe(TripleAddedEvent, self._on_change)
+        store.dispatcher.subscribe(TripleRemovedEvent, self._on_change)
+
+    def _on_change(self, event: Event):
+        context = getattr(event, "context", None)
+        if context is None:
+            self.epoch += 1
+            # the event may have changed any of the recorded graphs
+            for journal in self.journals.values():
+                journal.append(None)
+        else:
+            identifier = getattr(context, "identifier", context)
+            self.counts[identifier] += 1
+            journal = self.journals.get(identifier)
+            if journal is not None:
+                journal.append(getattr(event, "triple", None))
+
+
+@dataclass
+class _ChangeJournal:
+    """The triples (or patterns) added to or removed from a graph, in order.
+    None stands for a change which is not known.
+    """
+
+    # the position of the first entry which is still kept
+    offset: int = 0
+    entries: List[Optional[TriplePattern]] = field(default_factory=list)
+
+    def append(self, entry: Optional[TriplePattern]) -> None:
+        self.entries.append(entry)
+        if len(self.entries) > _CHANGE_JOURNAL_SIZE:
+            # forget the oldest half; changes since a position before the
+            # offset are no longer known
+            dropped = len(self.entries) // 2
+            del self.entries[:dropped]
+            self.offset += dropped
+
+
+# one change counter per store; entries go away with their store
+_change_counters: "WeakKeyDictionary[Store, _StoreChangeCounter]" = WeakKeyDictionary()
+_change_counter_tokens = count()
+_CHANGE_JOURNAL_SIZE = 1000000
+
+
+def _change_counter(store: Store) -> _StoreChangeCounter:
+    counter = _change_counters.get(store)
+    if counter is None:
+        counter = _change_counters[store] = _StoreChangeCounter(store)
+    return counter
+
+
+def graph_version(g: Graph) -> Hashable:
+    """Returns a token which changes whenever the contents of the graph change.
+
+    The token is cheap to compute, but it only reflects the changes which
+    this process makes through the graph's store object; changes made by
+    other processes (or through other store objects on the same database)
+    are only seen once :py:func:`invalidate_graph_versions` is called for
+    the store. It is therefore only used to memoize values which are
+    expensive to recompute, like :py:func:`graph_hash`, and not as a cache
+    key in its own right.
+
+    :param g: the graph to get the version of
+    :type g: Graph
+    :return: a hashable version token
+    :rtype: Hashable
+    """
+    counter = _change_counter(g.store)
+    version: Tuple = (
+        counter.token,
+        g.identifier,
+        counter.epoch,
+        counter.counts[g.identifier],
+    )
+    # rdflib's in-memory stores do not dispatch removal events, so fold in the
+    # (constant-time) size of the graph to catch removals
+    if isinstance(g.store, (Memory, SimpleMemory)):
+        version += (len(g),)  # type: ignore
+    return version
+
+
+def graph_changes_position(g: Graph) -> Hashable:
+    """Returns the current position in the record of the changes to the
+    graph, to pass to :py:func:`graph_changes_since` later on. The changes
+    of a graph are only recorded once this has been called for it.
+
+    :param g: the graph whose changes to record
+    :type g: Graph
+    :return: a hashable position
+    :rtype: Hashable
+    """
+    counter = _change_counter(g.store)
+    journal = counter.journals.setdefault(g.identifier, _ChangeJournal())
+    return (counter.token, g.identifier, journal.offset + len(journal.entries))
+
+
+def graph_changes_since(g: Graph, position: Hashable) -> Optional[List[TriplePattern]]:
+    """Returns the triples added to or removed from the graph since the
+    given position (see :py:func:`graph_changes_position`). Removals may be
+    triple patterns, with None for any term. A triple may be listed even if
+    adding or removing it did not change the graph.
+
+    As with :py:func:`graph_version`, only the changes which this process
+    makes through the graph's store object are recorded.
+
+    :param g: the graph whose changes to return
+    :type g: Graph
+    :param position: a position returned for the same graph and store
+    :type position: Hashable
+    :return: the changes since the position, or None if they are not known
+    :rtype: Optional[List[TriplePattern]]
+    """
+    # rdflib's in-memory stores do not dispatch removal events
+    if isinstance(g.store, (Memory, SimpleMemory)):
+        return None
+    counter = _change_counters.get(g.store)
+    journal = counter.journals.get(g.identifier) if counter is not None else None
+    if counter is None or journal is None:
+        return None
+    token, identifier, start = position  # type: ignore
+    if token != counter.token or identifier != g.identifier or start < journal.offset:
+        return None
+    changes = journal.entries[start - journal.offset :]
+    if any(change is None for change in changes):
+        return None
+    return changes  # type: ignore
+
+
+def invalidate_graph_versions(store: Store) -> None:
+    """Changes the version (see :py:func:`graph_version`) of every graph in
+    the store, so that values memoized on those versions are recomputed.
+    Called whenever others may have changed the graphs of the store, e.g.
+    when a database transaction ends.
+
+    :param store: the store whose graphs may have changed
+    :type store: Store
+    """
+    counter = _change_counters.get(store)
+    if counter is not None:
+        counter.epoch += 1
+
+
+def _length_prefixed(*parts: str) -> str:
+    """Joins the parts, each prefixed with its length, so that different
+    sequences of parts never join into the same string."""
+    return "".join(f"{len(part)}:{part}" for part in parts)
+
+
+def term_key(term: Node) -> str:
+    """Returns a string which identifies the term, including its type and,
+    for literals, its datatype and language.
+
+    :param term: the term
+    :type term: Node
+    :return: the key of the term
+    :rtype: str
+    """
+    if isinstance(term, Literal):
+        return _length_prefixed(
+            "Literal", str(term), str(term.datatype or ""), term.language or ""
+        )
+    return _length_prefixed(type(term).__name__, str(term))
+
+
+def triples_hash(triples: Iterable[Triple]) -> str:
+    """Returns a hash of the given triples which does not depend on their
+    order. Blank nodes are hashed by their labels.
+
+    :param triples: the triples to hash
+    :type triples: Iterable[Triple]
+    :return: a hex digest of the triples
+    :rtype: str
+    """
+    digests = sorted(
+        hashlib.sha256(_length_prefixed(*map(term_key, triple)).encode()).digest()
+        for triple in triples
+    )
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def graph_hash(g: Graph) -> str:
+    """Returns a hash of the contents of the graph, for use as a cache key
+    of values derived from the graph. Graphs with the same triples have the
+    same hash, whichever store holds them.
+
+    The hash is memoized until the version of the graph changes (see
+    :py:func:`graph_version`): when this process changes the graph, or when
+    the graph's store is invalidated with
+    :py:func:`invalidate_graph_versions`.
+
+    :param g: the graph to hash
+    :type g: Graph
+    :return: a hex digest of the triples of the graph
+    :rtype: str
+    """
+    return _graph_hashes.get(graph_version(g), lambda: triples_hash(g))
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """Keeps the values of the most recently used keys, up to a number of
+    keys."""
+
+    def __init__(self, size: int) -> None:
+        """Class constructor.
+
+        :param size: the number of keys to keep the values of
+        :type size: int
+        """
+        self.size = size
+        self._entries: "OrderedDict[K, V]" = OrderedDict()
+
+    def get(self, key: K, compute: Callable[[], V]) -> V:
+        """Returns the value of the key, computing it if it is not cached and
+        evicting the least recently used key if there are too many.
+
+        :param key: the key
+        :type key: K
+        :param compute: computes the value of the key
+        :type compute: Callable[[], V]
+        :return: the value of the key
+        :rtype: V
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        value = compute()
+        self._entries[key] = value
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return value
+
+    def discard(self, key: K) -> None:
+        """Drops the value of the key, if it is cached.
+
+        :param key: the key
+        :type key: K
+        """
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drops all values."""
+        self._entries.clear()
+
+
+_graph_hashes: LRUCache[Hashable, str] = LRUCache(256)
+
+
 def inline_sh_nodes(g: Graph):
     """
     Recursively inlines all sh:node properties and objects on the graph.
@@ -104,6 +588,21 @@ def combine_graphs(*graphs: Graph) -> Graph:
     return newg
 
 
+def graph_from_triples(triples: Iterable[Triple]) -> Graph:
+    """Builds a new in-memory graph containing the given triples. Blank nodes
+    keep their labels, so graphs sent between processes as lists of triples
+    still share blank nodes with the graphs they were taken from.
+
+    :param triples: the triples of the graph
+    :type triples: Iterable[Triple]
+    :return: the new graph
+    :rtype: Graph
+    """
+    g = Graph()
+    g.addN((s, p, o, g) for s, p, o in triples)
+    return g
+
+
 def graph_size(g: Graph) -> int:
     """Returns the number of triples in a graph.
 
@@ -115,6 +614,67 @@ def graph_size(g: Graph) -> int:
     return len(tuple(g.triples((None, None, None))))
 
 
+def worker_count(workers: Optional[int]) -> int:
+    """Returns the number of worker processes to use.
+
+    :param workers: the requested number of workers, or None for the number
+        of CPUs
+    :type workers: Optional[int]
+    :raises ValueError: if workers is not positive
+    :return: the number of workers
+    :rtype: int
+    """
+    if workers is None:
+        return os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f"workers must be positive, not {workers}")
+    return workers
+
+
+def _triples_with_nodes(g: Graph, nodes: Iterable[Node]) -> Set[Triple]:
+    """Returns the triples of the graph which include any of the given nodes,
+    using the store's indexes rather than scanning the whole graph."""
+    found: Set[Triple] = set()
+    for node in nodes:
+        found.update(g.triples((node, None, None)))
+        found.update(g.triples((None, node, None)))
+        found.update(g.triples((None, None, node)))
+    return found
+
+
+def rewrite_nodes(
+    g: Graph,
+    replace: Optional[Dict[Node, Node]] = None,
+    remove: Optional[Iterable[Node]] = None,
+) -> None:
+    """Replaces and removes nodes in a graph in one batch. Edits the graph
+    in-place.
+
+    Only the triples which include one of the nodes are visited, so the cost
+    is proportional to the number of occurrences of the nodes rather than to
+    the size of the graph. Replacements are not applied transitively.
+
+    :param g: the graph to edit
+    :type g: Graph
+    :param replace: dict mapping old nodes to new nodes, defaults to None
+    :type replace: Optional[Dict[Node, Node]], optional
+    :param remove: nodes whose triples are removed; removal takes precedence
+        over replacement, defaults to None
+    :type remove: Optional[Iterable[Node]], optional
+    """
+    replace = replace or {}
+    remove = set(remove or ())
+    affected = _triples_with_nodes(g, chain(replace, remove))
+    for triple in affected:
+        g.remove(triple)
+    get = replace.get
+    g.addN(
+        (get(s, s), get(p, p), get(o, o), g)
+        for (s, p, o) in affected
+        if remove.isdisjoint((s, p, o))
+    )
+
+
 def remove_triples_with_node(g: Graph, node: URIRef) -> None:
     """Remove all triples that include the given node. Edits the graph
     in-place.
@@ -124,12 +684,7 @@ def remove_triples_with_node(g: Graph, node: URIRef) -> None:
     :param node: the node to remove
     :type node: URIRef
     """
-    for triple in g.triples((node, None, None)):
-        g.remove(triple)
-    for triple in g.triples((None, node, None)):
-        g.remove(triple)
-    for triple in g.triples((None, None, node)):
-        g.remove(triple)
+    rewrite_nodes(g, remove=[node])
 
 
 def replace_nodes(g: Graph, replace: Dict[Node, Node]) -> None:
@@ -140,15 +695,7 @@ def replace_nodes(g: Graph, replace: Dict[Node, Node]) -> None:
     :param replace: dict mapping old nodes to new nodes
     :type replace: Dict[Node, Node]
     """
-    for s, p, o in g.triples((None, None, None)):
-        g.remove((s, p, o))
-        if s in replace:
-            s = replace[s]
-        if p in replace:
-            p = replace[p]
-        if o in replace:
-            o = replace[o]
-        g.add((s, p, o))
+    rewrite_nodes(g, replace=replace)
 
 
 def get_ontology_files(directory: Path, recursive: bool = True) -> List[Path]:
@@ -482,7 +1029,9 @@ def rewrite_shape_graph(g: Graph) -> Graph:
     :return: a *copy* of the original shape graph w/ rewritten shapes
     :rtype: Graph
     """
-    sg = copy_graph(g)
+    # rewrite an overlay, which only lives as long as this call, and copy
+    # the result so that it does not depend on the original graph
+    sg = OverlayGraph(g)
 
     previous_size = -1
     while len(sg) != previous_size:  # type: ignore
@@ -490,7 +1039,7 @@ def rewrite_shape_graph(g: Graph) -> Graph:
         _inline_sh_and(sg)
         # make sure to handle sh:node *after* sh:and
         _inline_sh_node(sg)
-    return sg
+    return sg.materialize()
 
 
 def skip_uri(uri: URIRef) -> bool:
@@ -513,3 +1062,338 @@ def skip_uri(uri: URIRef) -> bool:
         if uri.startswith(ns):
             return True
     return False
+
+
+# predicates which can appear inside of a SHACL property path
+_PATH_STRUCTURE = {
+    SH.alternativePath,
+    SH.inversePath,
+    SH.zeroOrMorePath,
+    SH.oneOrMorePath,
+    SH.zeroOrOnePath,
+    RDF.first,
+    RDF.rest,
+}
+# predicates whose values are SPARQL queries which pySHACL will execute
+_SPARQL_QUERIES = [SH.select, SH.ask, SH.construct]
+# SPARQL variables which are bound to the node being validated
+_SPARQL_ANCHORS = {Variable("this"), Variable("value")}
+# properties whose presence means the reach of a shape cannot be determined
+_NONLOCAL_CONSTRAINTS = [SH.target, SH.jsFunctionName, SH.update]
+
+
+def _collect_path_predicates(
+    sg: Graph, path: Node, forward: Set[URIRef], inverse: Set[URIRef], inverted=False
+) -> None:
+    """Adds all predicates in the given SHACL property path to `forward`, or
+    to `inverse` if they are followed in reverse.
+    """
+    if isinstance(path, URIRef):
+        if path != RDF.nil:
+            (inverse if inverted else forward).add(path)
+        return
+    for p, o in sg.predicate_objects(path):
+        if p in _PATH_STRUCTURE:
+            inner_inverted = inverted != (p == SH.inversePath)
+            _collect_path_predicates(sg, o, forward, inverse, inner_inverted)
+
+
+def _collect_query_terms(node, terms: Set[Node]) -> bool:
+    """Adds the IRIs and variables in a SPARQL algebra expression to `terms`.
+    Returns False if the query may follow an unknown predicate.
+    """
+    if isinstance(node, (URIRef, Variable)):
+        terms.add(node)
+        return True
+    if isinstance(node, NegatedPath):
+        return False
+    if isinstance(node, (SequencePath, AlternativePath)):
+        return all(_collect_query_terms(arg, terms) for arg in node.args)
+    if isinstance(node, InvPath):
+        return _collect_query_terms(node.arg, terms)
+    if isinstance(node, MulPath):
+        return _collect_query_terms(node.path, terms)
+    if isinstance(node, CompValue):
+        if node.name == "BGP":
+            for _, p, _ in node.triples:
+                # $PATH is replaced with the (known) path of the shape
+                if isinstance(p, Variable) and p != Variable("PATH"):
+                    return False
+        return all(_collect_query_terms(v, terms) for v in node.values())
+    if isinstance(node, (list, tuple, set)):
+        return all(_collect_query_terms(v, terms) for v in node)
+    return True
+
+
+def _query_namespaces(sg: Graph) -> Dict[str, URIRef]:
+    """Returns the prefixes available to SPARQL queries in the shape graph."""
+    namespaces = {prefix: URIRef(ns) for prefix, ns in sg.namespaces()}
+    for decl in sg.subjects(predicate=SH.prefix):
+        prefix, ns = sg.value(decl, SH.prefix), sg.value(decl, SH.namespace)
+        if prefix is not None and ns is not None:
+            namespaces[str(prefix)] = URIRef(ns)
+    return namespaces
+
+
+def _collect_predicate_dependencies(
+    sg: Graph, forward: Set[URIRef], inverse: Set[URIRef]
+) -> bool:
+    """Adds the predicates followed by the paths, triple rules and SPARQL
+    queries in the shape graph to `forward` and `inverse`. Returns False if
+    the shapes can depend on parts of the data graph which are not reachable
+    from the focus node.
+    """
+    for predicate in _NONLOCAL_CONSTRAINTS:
+        if (None, predicate, None) in sg:
+            return False
+
+    for path in sg.objects(predicate=SH.path):
+        _collect_path_predicates(sg, path, forward, inverse)
+    # triple rules add edges in either direction
+    for predicate in sg.objects(predicate=SH.predicate):
+        if isinstance(predicate, URIRef):
+            forward.add(predicate)
+            inverse.add(predicate)
+
+    queries = [q for p in _SPARQL_QUERIES for q in sg.objects(predicate=p)]
+    namespaces = _query_namespaces(sg) if queries else {}
+    for query in queries:
+        try:
+            algebra = prepareQuery(str(query), initNs=namespaces).algebra
+        except Exception:
+            logging.debug(f"Could not parse SPARQL query {query}")
+            return False
+        terms: Set[Node] = set()
+        if not _collect_query_terms(algebra, terms):
+            return False
+        if not terms & _SPARQL_ANCHORS:
+            return False
+        iris = {t for t in terms if isinstance(t, URIRef)}
+        forward.update(iris)
+        inverse.update(iris)
+    return True
+
+
+def get_shape_dependencies(
+    sg: Graph,
+) -> Optional[Tuple[Set[URIRef], Set[URIRef]]]:
+    """Determines which predicates the validation of a focus node against the
+    shapes in the given shape graph can follow through a data graph.
+
+    The first set contains predicates which are followed from subject to
+    object, the second set contains predicates which are followed from
+    object to subject. SPARQL-based constraints and rules are assumed to
+    follow any IRI they mention in both directions. Returns None if the
+    shapes can depend on parts of the data graph which are not reachable
+    from the focus node, e.g. through SPARQL-based targets, JavaScript or
+    SPARQL queries which do not mention $this or $value.
+
+    :param sg: the shape graph
+    :type sg: Graph
+    :return: the forward and inverse predicates, or None
+    :rtype: Optional[Tuple[Set[URIRef], Set[URIRef]]]
+    """
+    # the type hierarchy is always consulted for targets and sh:class
+    forward: Set[URIRef] = {RDF.type}
+    inverse: Set[URIRef] = set()
+    if not _collect_predicate_dependencies(sg, forward, inverse):
+        return None
+    return forward, inverse
+
+
+def get_affected_focus_nodes(
+    data_graph: Graph,
+    touched: Set[Node],
+    forward: Set[URIRef],
+    inverse: Set[URIRef],
+) -> Set[Node]:
+    """Finds all nodes whose validation result could have changed because of
+    changes to the given nodes: the nodes from which a touched node can be
+    reached along the predicates returned by :py:func:`get_shape_dependencies`.
+
+    :param data_graph: the data graph after the changes
+    :type data_graph: Graph
+    :param touched: the subjects and objects of all added or removed triples
+    :type touched: Set[Node]
+    :param forward: predicates followed from subject to object
+    :type forward: Set[URIRef]
+    :param inverse: predicates followed from object to subject
+    :type inverse: Set[URIRef]
+    :return: the affected nodes, including the touched nodes
+    :rtype: Set[Node]
+    """
+    affected = set(touched)
+    frontier = list(touched)
+    while frontier:
+        node = frontier.pop()
+        reaching = [s for s, p in data_graph.subject_predicates(node) if p in forward]
+        reaching.extend(
+            o for p, o in data_graph.predicate_objects(node) if p in inverse
+        )
+        for other in reaching:
+            if other not in affected and not isinstance(other, Literal):
+                affected.add(other)
+                frontier.append(other)
+    return affected
+
+
+def get_focus_node_subgraph(
+    data_graph: Graph,
+    focus_nodes: Set[Node],
+    forward: Set[URIRef],
+    inverse: Set[URIRef],
+) -> Graph:
+    """Extracts the part of the data graph which is needed to validate the
+    given focus nodes: every triple about a node reachable from a focus node
+    along the predicates returned by :py:func:`get_shape_dependencies`.
+
+    :param data_graph: the data graph
+    :type data_graph: Graph
+    :param focus_nodes: the nodes to be validated
+    :type focus_nodes: Set[Node]
+    :param forward: predicates followed from subject to object
+    :type forward: Set[URIRef]
+    :param inverse: predicates followed from object to subject
+    :type inverse: Set[URIRef]
+    :return: a new graph with the needed triples
+    :rtype: Graph
+    """
+    subgraph = Graph()
+    for prefix, namespace in data_graph.namespaces():
+        subgraph.bind(prefix, namespace)
+    visited = set(focus_nodes)
+    frontier = list(focus_nodes)
+    while frontier:
+        node = frontier.pop()
+        reached = []
+        for p, o in data_graph.predicate_objects(node):
+            subgraph.add((node, p, o))
+            if p in forward:
+                reached.append(o)
+        for s, p in data_graph.subject_predicates(node):
+            if p in inverse:
+                subgraph.add((s, p, node))
+                reached.append(s)
+        for other in reached:
+            if other not in visited and not isinstance(other, Literal):
+                visited.add(other)
+                frontier.append(other)
+    return subgraph
+
+
+# edges which are not followed when collecting the definition of a rule
+_RULE_BOUNDARY = {SH.rule, SH.prefixes, RDF.type, RDFS.subClassOf}
+
+
+@dataclass
+class RuleDependencies:
+    """The parts of a data graph which a SHACL rule reads. The rule needs to
+    be applied to all of its focus nodes again once a triple with one of the
+    `predicates`, or an instance of one of the `classes` has been added. If
+    `local` is True, the rule also reads arbitrary triples about the focus
+    node itself (e.g. `$this ?p ?o`), so it needs to be applied again to
+    each focus node which is the subject, predicate or object of an added
+    triple.
+    """
+
+    predicates: Set[URIRef]
+    classes: Set[URIRef]
+    local: bool
+
+
+def _add_path_predicates(path, predicates: Set[URIRef]) -> bool:
+    terms: Set[Node] = set()
+    if not _collect_query_terms(path, terms):
+        return False
+    predicates.update(t for t in terms if isinstance(t, URIRef))
+    return True
+
+
+def _collect_anchored_query_reads(node, deps: RuleDependencies) -> bool:
+    """Adds what the triple patterns in a SPARQL algebra expression read
+    beyond the triples about $this to `deps`. Returns False if the query can
+    follow an unknown predicate away from $this.
+    """
+    if isinstance(node, CompValue):
+        if node.name != "BGP":
+            return all(_collect_anchored_query_reads(v, deps) for v in node.values())
+        this = Variable("this")
+        for s, p, o in node.triples:
+            if this in (s, p, o) and isinstance(p, (URIRef, Variable)):
+                continue
+            if s == this and isinstance(p, SequencePath):
+                # the first step is a triple about $this
+                if not _add_path_predicates(p.args[1:], deps.predicates):
+                    return False
+            elif o == this and isinstance(p, SequencePath):
+                if not _add_path_predicates(p.args[:-1], deps.predicates):
+                    return False
+            elif p == RDF.type and isinstance(o, URIRef):
+                deps.classes.add(o)
+            elif isinstance(p, Variable):
+                return False
+            elif not _add_path_predicates(p, deps.predicates):
+                return False
+        return True
+    if isinstance(node, (list, tuple, set)):
+        return all(_collect_anchored_query_reads(v, deps) for v in node)
+    return True
+
+
+def get_rule_dependencies(sg: Graph, rule: Node) -> Optional[RuleDependencies]:
+    """Determines which parts of a data graph a SHACL rule reads, so that the
+    rule only needs to be applied again once triples have been added to
+    these parts. Targets of the shape which the rule is attached to are not
+    considered. Returns None if the rule can read any part of the data graph.
+
+    :param sg: the shape graph
+    :type sg: Graph
+    :param rule: the rule
+    :type rule: Node
+    :return: the parts of the data graph read by the rule, or None
+    :rtype: Optional[RuleDependencies]
+    """
+    queries = list(sg.objects(rule, SH.construct))
+    if queries and (rule, SH.condition, None) not in sg:
+        deps = RuleDependencies(set(), set(), True)
+        namespaces = _query_namespaces(sg)
+        try:
+            anchored = all(
+                _collect_anchored_query_reads(
+                    prepareQuery(str(query), initNs=namespaces).algebra, deps
+                )
+                for query in queries
+            )
+        except Exception:
+            logging.debug(f"Could not parse SPARQL rule {rule}")
+            return None
+        if anchored:
+            return deps
+
+    # collect the definition of the rule and of its conditions
+    definition = Graph()
+    visited = {rule}
+    frontier = [rule]
+    while frontier:
+        node = frontier.pop()
+        for p, o in sg.predicate_objects(node):
+            # the predicate the rule writes is not read by the rule
+            if p in _RULE_BOUNDARY or (node == rule and p == SH.predicate):
+                continue
+            definition.add((node, p, o))
+            if o not in visited and not isinstance(o, Literal):
+                visited.add(o)
+                frontier.append(o)
+    if any((None, query, None) in definition for query in _SPARQL_QUERIES):
+        for prefix, namespace in sg.namespaces():
+            definition.bind(prefix, namespace)
+        for decl in sg.subjects(predicate=SH.prefix):
+            for triple in sg.triples((decl, None, None)):
+                definition.add(triple)
+
+    reads: Set[URIRef] = set()
+    if not _collect_predicate_dependencies(definition, reads, reads):
+        return None
+    if (None, SH["class"], None) in definition:
+        reads.update((RDF.type, RDFS.subClassOf))
+    return RuleDependencies(reads, set(), False)
@@ -1,12 +1,17 @@
+import logging
+import re
 from pathlib import Path
 
 import pytest
-from rdflib import RDF, Graph, URIRef
+from rdflib import RDF, Graph, Literal, URIRef
 from rdflib.compare import isomorphic
 from rdflib.namespace import FOAF
+from rdflib_sqlalchemy.store import SQLAlchemy
+from sqlalchemy.pool.base import _ConnectionFairy
 
 from buildingmotif.building_motif.building_motif import BuildingMotifEngine
 from buildingmotif.database.graph_connection import GraphConnection
+from buildingmotif.utils import graph_hash
 from tests.unit.conftest import MockBuildingMotif
 
 FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
@@ -25,15 +30,18 @@ def graph_connection():
     bm.close()
 
 
-def test_create_graph(graph_connection):
+def test_create_graph(graph_connection, caplog):
     g = Graph()
     hannahs_personhood = (URIRef("http://example.org/hannah"), RDF.type, FOAF.Person)
     g.add(hannahs_personhood)
 
-    res = graph_connection.create_graph("my_graph", g)
+    with caplog.at_level(logging.INFO):
+        res = graph_connection.create_graph("my_graph", g)
 
     assert isomorphic(res, g)
     assert graph_connection.get_all_graph_identifiers() == ["my_graph"]
+    # creating a graph does not log the statistics of its bulk load
+    assert not [r for r in caplog.records if r.levelno >= logging.INFO]
 
 
 @pytest.mark.skip(reason="empty graphs can't be entered")
@@ -71,3 +79,237 @@ def test_delete_graph(graph_connection):
     assert graph_connection.get_all_graph_identifiers() == ["my_graph"]
     graph_connection.delete_graph("my_graph")
     assert graph_connection.get_all_graph_identifiers() == []
+
+
+def test_bulk_load(graph_connection):
+    g = Graph()
+    for i in range(25):
+        g.add((URIRef(f"http://example.org/person{i}"), RDF.type, FOAF.Person))
+        g.add((URIRef(f"http://example.org/person{i}"), FOAF.age, Literal(i)))
+        g.add(
+            (
+                URIRef(f"http://example.org/person{i}"),
+                FOAF.knows,
+                URIRef("http://example.org/hannah"),
+            )
+        )
+
+    stats = graph_connection.bulk_load("my_graph", g, chunk_size=7)
+    assert stats.triples == 75
+    assert stats.triples_per_second > 0
+    assert isomorphic(graph_connection.get_graph("my_graph"), g)
+
+    # triples already in the graph are ignored
+    graph_connection.bulk_load("my_graph", iter(g))
+    assert len(graph_connection.get_graph("my_graph")) == 75
+
+    with pytest.raises(ValueError):
+        graph_connection.bulk_load("my_graph", g, chunk_size=0)
+
+
+def test_bulk_load_rows_match_store(graph_connection):
+    person = URIRef("http://example.org/alex")
+    triples = [
+        (person, RDF.type, FOAF.Person),
+        (person, FOAF.age, Literal(30)),
+        (person, FOAF.name, Literal("Alex", lang="en")),
+        (person, FOAF.knows, URIRef("http://example.org/hannah")),
+    ]
+    graph_connection.bulk_load("bulk", triples)
+    g = graph_connection.get_graph("added")
+    for triple in triples:
+        g.add(triple)
+
+    # bulk_load writes the same rows as the store's own inserts
+    store = graph_connection.store
+    with store.engine.engine.connect() as connection:
+        for name in ("asserted_statements", "type_statements", "literal_statements"):
+            table = store.tables[name]
+            rows = {
+                context: {
+                    tuple(
+                        v for k, v in row._mapping.items() if k not in ("id", "context")
+                    )
+                    for row in connection.execute(table.select())
+                    if row._mapping["context"] == context
+                }
+                for context in ("bulk", "added")
+            }
+            assert rows["bulk"] and rows["bulk"] == rows["added"]
+
+
+class _CopyCursor:
+    """Wraps a sqlite cursor and emulates the PostgreSQL statements used by
+    GraphConnection._copy_rows: the staging table, COPY ... FROM STDIN in CSV
+    format (where an unquoted empty field is NULL) and the merge."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.staged = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, statement, *args):
+        if statement.startswith(
+            ('CREATE TEMPORARY TABLE "staging_', 'DROP TABLE "staging_')
+        ):
+            return None
+        merge = re.match(
+            r'INSERT INTO "(\w+)" \((.*)\) SELECT .* FROM "staging_', statement
+        )
+        if merge is None:
+            return self._cursor.execute(statement, *args)
+        table, columns = merge.groups()
+        placeholders = ", ".join("?" * len(self.staged[0]))
+        self._cursor.executemany(
+            f'INSERT OR IGNORE INTO "{table}" ({columns}) VALUES ({placeholders})',
+            self.staged,
+        )
+
+    def copy_expert(self, statement, buffer):
+        width = statement.split("(")[1].count(",") + 1
+        field = re.compile(r'(?:"((?:[^"]|"")*)"|([^,"]*))(?:,|$)')
+        self.staged = [
+            [
+                quoted.replace('""', '"') if quoted is not None else bare or None
+                for quoted, bare in (m.group(1, 2) for m in field.finditer(line))
+            ][:width]
+            for line in buffer.read().splitlines()
+        ]
+
+
+@pytest.mark.parametrize("session", [True, False])
+def test_bulk_load_postgres_copy(graph_connection, monkeypatch, session):
+    g = Graph()
+    for i in range(10):
+        person = URIRef(f"http://example.org/person{i}")
+        g.add((person, RDF.type, FOAF.Person))
+        g.add((person, FOAF.age, Literal(i)))
+        g.add((person, FOAF.name, Literal(f'Person "{i}", esq.', lang="en")))
+        g.add((person, FOAF.nick, Literal("")))
+
+    cursors = []
+    cursor = _ConnectionFairy.cursor
+
+    def copy_cursor(fairy, *args, **kwargs):
+        cursors.append(_CopyCursor(cursor(fairy, *args, **kwargs)))
+        return cursors[-1]
+
+    engine = graph_connection.store.engine
+    if not session:
+        # transactions of a plain engine are connections rather than sessions
+        monkeypatch.setattr(engine, "begin", engine.engine.begin)
+    monkeypatch.setattr(engine.dialect, "name", "postgresql")
+    monkeypatch.setattr(_ConnectionFairy, "cursor", copy_cursor)
+    graph_connection.bulk_load("my_graph", g, chunk_size=15)
+    monkeypatch.undo()
+
+    # the rows went through COPY rather than through INSERT statements
+    assert any(c.staged for c in cursors)
+    assert isomorphic(graph_connection.get_graph("my_graph"), g)
+
+
+def test_graph_cache(graph_connection):
+    g = Graph()
+    alex = URIRef("http://example.org/alex")
+    hannah = URIRef("http://example.org/hannah")
+    g.add((hannah, RDF.type, FOAF.Person))
+    graph_connection.create_graph("my_graph", g)
+    store = graph_connection.store
+
+    res = graph_connection.get_graph("my_graph")
+    assert (hannah, RDF.type, FOAF.Person) in res
+    assert res.identifier in store._cache
+
+    # writes go through to the database and the cached copy
+    res.add((alex, RDF.type, FOAF.Person))
+    res.add((alex, RDF.type, FOAF.Person))
+    res.remove((hannah, None, None))
+    assert set(res.subjects()) == {alex}
+    assert store._cached_triples == 1
+    store.invalidate()
+    assert set(graph_connection.get_graph("my_graph").subjects()) == {alex}
+
+    # committing drops the cache
+    res.add((hannah, FOAF.knows, alex))
+    graph_connection.store.engine.Session().commit()
+    assert res.identifier not in store._cache
+    assert len(res) == 2
+
+
+def test_graph_hash_after_commit(graph_connection):
+    g = Graph()
+    alex = URIRef("http://example.org/alex")
+    hannah = URIRef("http://example.org/hannah")
+    g.add((hannah, RDF.type, FOAF.Person))
+    graph_connection.create_graph("my_graph", g)
+    res = graph_connection.get_graph("my_graph")
+    digest = graph_hash(res)
+
+    # another store on the same database, e.g. in another process, changes
+    # the graph; this store sees the change once the transaction ends
+    engine = graph_connection.store.engine
+    other = GraphConnection(BuildingMotifEngine(engine.engine, engine.Session))
+    other.get_graph("my_graph").add((alex, RDF.type, FOAF.Person))
+    engine.Session().commit()
+    assert graph_hash(res) != digest
+    assert graph_hash(res) == graph_hash(other.get_graph("my_graph"))
+
+
+def test_graph_cache_eviction(graph_connection):
+    store = graph_connection.store
+    store.max_cached_triples = 3
+    for name in ["a", "b", "c"]:
+        g = Graph()
+        for i in range(2):
+            g.add((URIRef(f"urn:ex/{name}{i}"), RDF.type, FOAF.Person))
+        graph_connection.create_graph(name, g)
+        assert len(list(graph_connection.get_graph(name).subjects())) == 2
+
+    # each graph evicts the least recently used one
+    assert list(store._cache.keys()) == [URIRef("c")]
+    assert store._cached_triples == 2
+
+    # graphs larger than the budget are never cached
+    store.max_cached_triples = 1
+    store.invalidate()
+    assert len(list(graph_connection.get_graph("a").subjects())) == 2
+    assert len(store._cache) == 0
+    # and are only counted once until the cache is invalidated
+    assert store._uncacheable == {URIRef("a")}
+    store.invalidate()
+    assert not store._uncacheable
+
+
+def test_graph_length_cache(graph_connection, monkeypatch):
+    store = graph_connection.store
+    store.max_cached_triples = 1
+    g = Graph()
+    for i in range(2):
+        g.add((URIRef(f"urn:ex/a{i}"), RDF.type, FOAF.Person))
+    graph_connection.create_graph("a", g)
+    res = graph_connection.get_graph("a")
+
+    counted = []
+    count = SQLAlchemy.__len__
+
+    def counting_len(self, context=None):
+        counted.append(context)
+        return count(self, context)
+
+    monkeypatch.setattr(SQLAlchemy, "__len__", counting_len)
+    # the length of a graph which is not materialized is counted once
+    assert len(res) == len(res) == 2
+    assert len(counted) == 1
+    assert res.identifier not in store._cache
+
+    # until the graph is written to
+    res.add((URIRef("urn:ex/a2"), RDF.type, FOAF.Person))
+    assert len(res) == len(res) == 3
+    assert len(counted) == 2
+    res.remove((URIRef("urn:ex/a2"), None, None))
+    assert len(res) == 2
+    store.invalidate(res.identifier)
+    assert len(res) == 2
+    assert len(counted) == 4
@@ -2,12 +2,13 @@ from pathlib import Path
 from typing import Optional
 
 import pytest
-from rdflib import RDF, Graph, URIRef
+from rdflib import RDF, Graph, Namespace, URIRef
 from rdflib.compare import isomorphic
 from rdflib.namespace import FOAF
 
 from buildingmotif import BuildingMOTIF
-from buildingmotif.dataclasses import Library
+from buildingmotif.dataclasses import Library, Model
+from buildingmotif.namespaces import BRICK, PARAM
 from tests.unit.conftest import MockLibrary
 
 
@@ -181,3 +182,90 @@ def test_builtin_ontologies(bm: BuildingMOTIF, builtin_ontology):
 def test_builtin_libraries(bm: BuildingMOTIF, builtin_library):
     lib = Library.load(directory=builtin_library)
     assert lib is not None
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_find_subgraphs(clean_building_motif, workers):
+    BLDG = Namespace("urn:find-subgraphs/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    model = Model.create(BLDG)
+    model.add_triples(
+        (BLDG["sf1"], RDF.type, BRICK.Supply_Fan),
+        (BLDG["sf1"], BRICK.hasPoint, BLDG["st1"]),
+        (BLDG["st1"], RDF.type, BRICK.Fan_Status),
+    )
+    ontology = brick.get_shape_collection().graph
+
+    results = lib.find_subgraphs(model, ontology, workers=workers)
+    matches = results["supply-fan"]
+    mapping, sg, remaining = matches[0]
+    assert mapping[BLDG["sf1"]] == PARAM["name"]
+    assert mapping[BLDG["st1"]] == PARAM["st"]
+    assert (BLDG["sf1"], BRICK.hasPoint, BLDG["st1"]) in sg
+    assert remaining is not None
+    assert remaining.parameters == {"spd", "ss"}
+    # matches are the same as those of each template
+    expected = [
+        mapping
+        for mapping, _, _ in lib.get_template_by_name("supply-fan").find_subgraphs(
+            model, ontology
+        )
+    ]
+    assert [mapping for mapping, _, _ in matches] == expected
+    # templates are ranked by their most complete match
+    sizes = [len(matches[0][0]) for matches in results.values()]
+    assert sizes == sorted(sizes, reverse=True)
+
+    results = lib.find_subgraphs(model, ontology, workers=workers, top_k=1)
+    assert all(len(matches) == 1 for matches in results.values())
+    assert results["supply-fan"][0][0] == mapping
+
+    with pytest.raises(ValueError):
+        lib.find_subgraphs(model, ontology, workers=workers, top_k=0)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_find_subgraphs_partial_optional(clean_building_motif, workers):
+    BLDG = Namespace("urn:find-subgraphs-optional/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    lib = Library.create("optional_fan")
+    body = Graph().parse(
+        data="""
+@prefix P: <urn:___param___#> .
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+P:name a brick:Supply_Fan ;
+    brick:hasPoint P:spd, P:st, P:ss .
+P:spd a brick:Fan_Speed_Command .
+P:st a brick:Fan_Status .
+P:ss a brick:Start_Stop_Command .
+    """
+    )
+    lib.create_template("opt-fan", body, optional_args=["spd", "st", "ss"])
+    model = Model.create(BLDG)
+    model.add_triples(
+        (BLDG["sf1"], RDF.type, BRICK.Supply_Fan),
+        (BLDG["sf1"], BRICK.hasPoint, BLDG["st1"]),
+        (BLDG["st1"], RDF.type, BRICK.Fan_Status),
+    )
+
+    results = lib.find_subgraphs(
+        model, brick.get_shape_collection().graph, workers=workers
+    )
+    mapping, _, remaining = results["opt-fan"][0]
+    assert mapping[BLDG["st1"]] == PARAM["st"]
+    # binding some of the optional args leaves the others in a template
+    assert remaining is not None
+    assert remaining.parameters == {"spd", "ss"}
+    # so does binding none of them
+    remaining = next(
+        remaining
+        for mapping, _, remaining in results["opt-fan"]
+        if set(mapping.values()) == {PARAM["name"], BRICK.Supply_Fan}
+    )
+    assert remaining is not None
+    assert remaining.parameters == {"spd", "st", "ss"}
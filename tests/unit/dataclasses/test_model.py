@@ -4,8 +4,11 @@ from rdflib.compare import isomorphic
 from rdflib.namespace import FOAF
 
 from buildingmotif import BuildingMOTIF
-from buildingmotif.dataclasses import Library, Model, ValidationContext
+from buildingmotif.dataclasses import Library, Model, ShapeCollection, ValidationContext
+from buildingmotif.dataclasses.model import validate_models
+from buildingmotif.dataclasses.validation import ValidationShapes
 from buildingmotif.namespaces import BRICK, RDF, RDFS, SH, A
+from buildingmotif.rule_engine import PreparedOntology
 
 BLDG = Namespace("urn:building/")
 
@@ -44,6 +47,18 @@ def test_load_model(clean_building_motif):
     assert isomorphic(result.graph, m.graph)
 
 
+def test_add_graph_bulk(clean_building_motif):
+    m = Model.create(name="https://example.com", description="a very good model")
+    g = Graph()
+    g.add((BLDG["vav1"], A, BRICK.VAV))
+    g.add((BLDG["vav1"], RDFS.label, Literal("VAV 1")))
+    m.add_graph(g, bulk=True)
+
+    assert (BLDG["vav1"], A, BRICK.VAV) in m.graph
+    assert isomorphic(Model.load(m.id).graph, m.graph)
+    assert len(m.graph) == 3
+
+
 def test_validate_model(clean_building_motif):
     # load library
     lib = Library.load(ontology_graph="tests/unit/fixtures/shapes/shape1.ttl")
@@ -68,6 +83,120 @@ def test_validate_model(clean_building_motif):
     assert len(ctx.diffset) == 0
 
 
+def test_validate_model_incremental(clean_building_motif):
+    lib = Library.load(ontology_graph="tests/unit/fixtures/shapes/shape1.ttl")
+    sc = lib.get_shape_collection()
+
+    m = Model.create(name=BLDG)
+    m.add_triples((BLDG["vav1"], A, BRICK.VAV), (BLDG["vav2"], A, BRICK.VAV))
+    # changes to the model are only recorded when asked for
+    assert m.validate([sc])._changes_position is None
+    ctx = m.validate([sc], incremental=True)
+    assert not ctx.valid
+
+    def failing(ctx):
+        return set(ctx.report.objects(predicate=SH.focusNode))
+
+    assert failing(ctx) == {BLDG["vav1"], BLDG["vav2"]}
+
+    # fix one of the VAVs
+    m.add_triples(
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["temp_sensor"]),
+        (BLDG["temp_sensor"], A, BRICK.Temperature_Sensor),
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["flow_sensor"]),
+        (BLDG["flow_sensor"], A, BRICK.Air_Flow_Sensor),
+    )
+    incremental = m.validate([sc], previous=ctx, incremental=True)
+    assert not incremental.valid
+    assert failing(incremental) == {BLDG["vav2"]}
+    assert failing(incremental) == failing(m.validate([sc]))
+
+    # changing a point of the VAV re-validates the VAV
+    m.graph.remove((BLDG["flow_sensor"], A, BRICK.Air_Flow_Sensor))
+    incremental = m.validate([sc], previous=incremental, incremental=True)
+    assert failing(incremental) == {BLDG["vav1"], BLDG["vav2"]}
+
+    m.graph.remove((BLDG["vav2"], A, BRICK.VAV))
+    m.add_triples((BLDG["flow_sensor"], A, BRICK.Air_Flow_Sensor))
+    incremental = m.validate([sc], previous=incremental, incremental=True)
+    assert incremental.valid
+    assert "Conforms: True" in incremental.report_string
+
+    # removing a pattern touches unknown nodes, so the whole model is validated
+    m.add_triples((BLDG["vav3"], A, BRICK.VAV))
+    m.graph.remove((None, BRICK.hasPoint, BLDG["temp_sensor"]))
+    incremental = m.validate([sc], previous=incremental, incremental=True)
+    assert BLDG["vav3"] in failing(incremental)
+    assert failing(incremental) == failing(m.validate([sc]))
+
+
+def test_validation_shapes_cache(clean_building_motif):
+    lib = Library.load(ontology_graph="tests/unit/fixtures/shapes/shape1.ttl")
+    sc = lib.get_shape_collection()
+
+    shapes = ValidationShapes.load([sc])
+    assert ValidationShapes.load([sc]) is shapes
+    assert ValidationShapes.load([lib.get_shape_collection()]) is shapes
+
+    m = Model.create(name=BLDG)
+    m.add_triples((BLDG["vav1"], A, BRICK.VAV))
+    assert not m.validate([sc]).valid
+    # the shapes parsed by pySHACL are kept for the next validation
+    assert shapes._shapes is not None
+
+    # changing a shape collection invalidates the cached shapes
+    sc.graph.remove((None, SH.targetClass, BRICK.VAV))
+    assert ValidationShapes.load([sc]) is not shapes
+    assert m.validate([sc]).valid
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_validate_models(clean_building_motif, monkeypatch, workers):
+    lib = Library.load(ontology_graph="tests/unit/fixtures/shapes/shape1.ttl")
+    sc = lib.get_shape_collection()
+
+    valid = Model.create(name="urn:valid_building/")
+    invalid = Model.create(name="urn:invalid_building/")
+    for m in [valid, invalid]:
+        m.add_triples((BLDG["vav1"], A, BRICK.VAV))
+    valid.add_triples(
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["temp_sensor"]),
+        (BLDG["temp_sensor"], A, BRICK.Temperature_Sensor),
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["flow_sensor"]),
+        (BLDG["flow_sensor"], A, BRICK.Air_Flow_Sensor),
+    )
+
+    results = validate_models([valid.id, invalid.id], [sc], workers=workers)
+    assert set(results.keys()) == {valid.id, invalid.id}
+    assert results[valid.id].valid
+    assert results[valid.id].model.id == valid.id
+    assert not results[invalid.id].valid
+    assert (None, SH.focusNode, BLDG["vav1"]) in results[invalid.id].report
+    assert results[invalid.id].report_string == invalid.validate([sc]).report_string
+    assert results[invalid.id]._changes_position is None
+
+    # both paths record the changes for an incremental validation
+    results = validate_models([invalid.id], [sc], workers=workers, incremental=True)
+    previous = results[invalid.id]
+    assert previous._changes_position is not None
+    invalid.add_triples(
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["temp_sensor"]),
+        (BLDG["temp_sensor"], A, BRICK.Temperature_Sensor),
+        (BLDG["vav1"], BRICK.hasPoint, BLDG["flow_sensor"]),
+        (BLDG["flow_sensor"], A, BRICK.Air_Flow_Sensor),
+    )
+    calls = []
+    validate_incremental = Model._validate_incremental
+
+    def recording(self, *args):
+        calls.append(self.id)
+        return validate_incremental(self, *args)
+
+    monkeypatch.setattr(Model, "_validate_incremental", recording)
+    assert invalid.validate([sc], previous=previous).valid
+    assert calls == [invalid.id]
+
+
 def test_validate_model_with_failure(bm: BuildingMOTIF):
     """
     Test that a model correctly validates
@@ -136,6 +265,94 @@ def test_model_compile(bm: BuildingMOTIF):
     assert isomorphic(compiled_model, precompiled_model)
 
 
+def test_model_compile_prepared_ontology(clean_building_motif):
+    sc = ShapeCollection.create()
+    sc.graph.parse(
+        data="""
+        @prefix brick: <https://brickschema.org/schema/Brick#> .
+        @prefix owl: <http://www.w3.org/2002/07/owl#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+        @prefix sh: <http://www.w3.org/ns/shacl#> .
+        brick:VAV a owl:Class, sh:NodeShape ;
+            rdfs:subClassOf brick:Equipment ;
+            sh:rule [ a sh:TripleRule ; sh:subject sh:this ;
+                sh:predicate rdfs:label ; sh:object "a vav" ] .
+        """,
+        format="turtle",
+    )
+    model = Model.create(name=BLDG)
+    model.add_triples(
+        (BLDG["vav1"], A, BRICK.VAV),
+        # also in the ontology, so it is not part of the compiled model
+        (BRICK.VAV, RDFS.subClassOf, BRICK.Equipment),
+    )
+
+    compiled = model.compile([sc])
+    assert (BLDG["vav1"], A, BRICK.VAV) in compiled
+    assert (BLDG["vav1"], RDFS.label, Literal("a vav")) in compiled
+    assert (BRICK.VAV, RDFS.subClassOf, BRICK.Equipment) not in compiled
+    assert (BRICK.VAV, A, SH.NodeShape) not in compiled
+
+    ontology = PreparedOntology.load([sc])
+    assert PreparedOntology.load([sc]) is ontology
+    assert isomorphic(model.compile([sc]), compiled)
+
+    # changing a shape collection invalidates the prepared ontology
+    sc.graph.add((BRICK.VAV, RDFS.label, Literal("variable air volume box")))
+    assert PreparedOntology.load([sc]) is not ontology
+    assert (BLDG["vav1"], RDFS.label, Literal("a vav")) in model.compile([sc])
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_model_against_shapes(clean_building_motif, single_pass):
+    sc = ShapeCollection.create()
+    sc.graph.parse(
+        data="""
+        @prefix brick: <https://brickschema.org/schema/Brick#> .
+        @prefix owl: <http://www.w3.org/2002/07/owl#> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+        @prefix sh: <http://www.w3.org/ns/shacl#> .
+        @prefix : <urn:shapes/> .
+        :labelled a owl:Class, sh:NodeShape ;
+            sh:property _:label .
+        :also_labelled a owl:Class, sh:NodeShape ;
+            sh:property _:label .
+        _:label sh:path rdfs:label ; sh:minCount 1 .
+        :with_point a owl:Class, sh:NodeShape ;
+            sh:property [ sh:path brick:hasPoint ; sh:minCount 1 ] .
+        """,
+        format="turtle",
+    )
+    SHAPES = Namespace("urn:shapes/")
+    model = Model.create(name=BLDG)
+    model.add_triples(
+        (BLDG["vav1"], A, BRICK.VAV),
+        (BLDG["vav1"], RDFS.label, Literal("VAV 1")),
+        (BLDG["vav2"], A, BRICK.VAV),
+        (BLDG["ahu1"], A, BRICK.AHU),
+    )
+    before = len(model.graph)
+
+    results = model.test_model_against_shapes(
+        [sc],
+        [SHAPES.labelled, SHAPES.also_labelled, SHAPES.with_point],
+        BRICK.VAV,
+        single_pass=single_pass,
+    )
+
+    def failing(ctx):
+        return set(ctx.report.objects(predicate=SH.focusNode))
+
+    assert not results[SHAPES.labelled].valid
+    assert failing(results[SHAPES.labelled]) == {BLDG["vav2"]}
+    # the property shape is shared, so its results belong to both shapes
+    assert not results[SHAPES.also_labelled].valid
+    assert failing(results[SHAPES.also_labelled]) == {BLDG["vav2"]}
+    assert not results[SHAPES.with_point].valid
+    assert failing(results[SHAPES.with_point]) == {BLDG["vav1"], BLDG["vav2"]}
+    assert len(model.graph) == before
+
+
 def test_get_manifest(clean_building_motif):
     BLDG = Namespace("urn:building/")
     model = Model.create(name=BLDG)
@@ -62,6 +62,14 @@ def test_get_shapes_of_definition_type(clean_building_motif):
         BMOTIF.Analytics_Application
     ) == [URIRef("urn:model#shape3")]
 
+    # the subclasses of a definition type come back in a stable order
+    subclasses = ShapeCollection._get_subclasses_of_definition_type(
+        BMOTIF.Definition_Type
+    )
+    assert subclasses[0] == BMOTIF.Definition_Type
+    assert len(subclasses) > 2
+    assert subclasses[1:] == sorted(subclasses[1:])
+
 
 def test_get_shapes_of_domain(clean_building_motif):
     shape_collection = ShapeCollection.create()
@@ -0,0 +1,233 @@
+import pytest
+from openpyxl import Workbook
+from rdflib import Graph, Literal, Namespace, URIRef
+from rdflib.compare import isomorphic
+
+import buildingmotif.ingresses.template as template_ingress
+from buildingmotif import BuildingMOTIF
+from buildingmotif.dataclasses import Library, Model
+from buildingmotif.ingresses import (
+    CSVIngress,
+    Record,
+    TemplateIngress,
+    TemplateIngressWithChooser,
+)
+from buildingmotif.ingresses.base import RecordIngressHandler
+from buildingmotif.ingresses.template import _get_term
+from buildingmotif.ingresses.xlsx import XLSXIngress
+from buildingmotif.namespaces import BRICK, OWL, A
+
+BLDG = Namespace("urn:bldg/")
+
+
+def _write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        f.write("name\n")
+        for i in range(rows):
+            f.write(f"sensor{i}\n")
+
+
+def test_csv_iter_records(tmp_path):
+    path = tmp_path / "points.csv"
+    _write_csv(path, 5)
+    ingress = CSVIngress(path)
+
+    chunks = list(ingress.iter_records(chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    records = [rec for chunk in chunks for rec in chunk]
+    assert records == ingress.records
+    assert records[0].rtype == str(path)
+    assert records[0].fields == {"name": "sensor0"}
+
+    with pytest.raises(ValueError):
+        list(ingress.iter_records(chunk_size=0))
+
+
+def test_template_ingress_streams_records(bm: BuildingMOTIF, tmp_path):
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    sensor = lib.get_template_by_name("temp-sensor")
+    path = tmp_path / "points.csv"
+    _write_csv(path, 25)
+
+    ingress = CSVIngress(path)
+    g = TemplateIngress(sensor, None, ingress).graph(BLDG)
+    # the records are never loaded all at once
+    assert "records" not in vars(ingress)
+    expected = Graph()
+    for i in range(25):
+        expected.add((BLDG[f"sensor{i}"], A, BRICK.Temperature_Sensor))
+    assert isomorphic(g, expected)
+
+
+class _ListIngress(RecordIngressHandler):
+    def __init__(self, records):
+        self.records = records
+
+
+class _OneByOneIngress(_ListIngress):
+    def iter_records(self, chunk_size=10000):
+        for rec in self.records:
+            yield [rec]
+
+
+def test_iter_columns(tmp_path):
+    path = tmp_path / "points.csv"
+    with open(path, "w", newline="") as f:
+        f.write("name,unit\nsensor0,degC\n\nsensor1\nsensor2,degF,extra\n")
+    batches = list(CSVIngress(path).iter_columns(chunk_size=2))
+    assert [batch.columns for batch in batches] == [
+        {"name": ["sensor0", "sensor1"], "unit": ["degC", None]},
+        {"name": ["sensor2"], "unit": ["degF"]},
+    ]
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0].rtype == str(path)
+
+    # by default, runs of records with the same type and fields are batched
+    records = [
+        Record("a", {"x": 1}),
+        Record("a", {"x": 2}),
+        Record("b", {"x": 3}),
+        Record("b", {"x": 4, "y": 5}),
+    ]
+    batches = list(_ListIngress(records).iter_columns())
+    assert [(batch.rtype, batch.columns) for batch in batches] == [
+        ("a", {"x": [1, 2]}),
+        ("b", {"x": [3]}),
+        ("b", {"x": [4], "y": [5]}),
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_template_ingress_columns(bm: BuildingMOTIF, tmp_path, workers):
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    vav = lib.get_template_by_name("opt-vav")
+    path = tmp_path / "vavs.csv"
+    with open(path, "w", newline="") as f:
+        f.write("name,zone,occ\nvav0,zone0,occ0\nvav1,zone1,\nvav2,zone 2,occ2\n")
+
+    g = TemplateIngress(vav, None, CSVIngress(path), workers=workers).graph(BLDG)
+    # the same graph as evaluating the template on each record
+    bindings = [
+        {k: _get_term(v, BLDG) for k, v in rec.fields.items()}
+        for rec in CSVIngress(path).records
+    ]
+    assert isomorphic(g, vav.evaluate_many(bindings))
+    assert (BLDG["occ2"], BRICK.isPointOf, Literal("zone 2")) in g
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_xlsx_ingress(tmp_path, workers):
+    path = tmp_path / "points.xlsx"
+    wb = Workbook()
+    points = wb.active
+    points.title = "points"
+    for row in (["name", "unit"], ["sensor0", "degC"], ["sensor1"], [], [2]):
+        points.append(row)
+    vavs = wb.create_sheet("vavs")
+    for row in (["name"], ["vav0"]):
+        vavs.append(row)
+    wb.create_sheet("empty")
+    wb.save(path)
+
+    ingress = XLSXIngress(path, workers=workers)
+    assert [(rec.rtype, rec.fields) for rec in ingress.records] == [
+        ("points", {"name": "sensor0", "unit": "degC"}),
+        ("points", {"name": "sensor1", "unit": None}),
+        ("points", {"name": None, "unit": None}),
+        ("points", {"name": 2, "unit": None}),
+        ("vavs", {"name": "vav0"}),
+    ]
+    batches = list(ingress.iter_columns(chunk_size=3))
+    assert [(batch.rtype, len(batch)) for batch in batches] == [
+        ("points", 3),
+        ("points", 1),
+        ("vavs", 1),
+    ]
+    assert batches[0].columns["name"] == ["sensor0", "sensor1", None]
+
+    with pytest.raises(ValueError):
+        XLSXIngress(path, workers=-1)
+    with pytest.raises(ValueError):
+        XLSXIngress(path, workers=0)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_template_ingress_with_chooser(bm: BuildingMOTIF, workers):
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    templates = {
+        "sensor": lib.get_template_by_name("temp-sensor"),
+        "vav": lib.get_template_by_name("opt-vav"),
+    }
+    records = [
+        Record("sensor", {"name": "sensor0"}),
+        Record("vav", {"name": "vav0", "zone": "zone0", "occ": "occ0"}),
+        Record("sensor", {"name": "sensor1"}),
+        # the unbound optional 'occ' is pruned
+        Record("vav", {"name": "vav1", "zone": "zone1"}),
+    ]
+    ingress = TemplateIngressWithChooser(
+        lambda rec: templates[rec.rtype], None, _ListIngress(records), workers=workers
+    )
+
+    expected = Graph()
+    for rec in records:
+        bindings = {k: _get_term(v, BLDG) for k, v in rec.fields.items()}
+        templates[rec.rtype].evaluate_many([bindings], into=expected)
+    assert isomorphic(ingress.graph(BLDG), expected)
+
+    # the triples can be loaded into a model without building a graph
+    model = Model.create(BLDG)
+    bm.graph_connection.bulk_load(model.graph.identifier, ingress.triples(BLDG))
+    expected.add((URIRef(BLDG), A, OWL.Ontology))
+    assert isomorphic(model.graph, expected)
+
+    # a template which is first chosen in a later chunk is evaluated too
+    records = [Record("sensor", {"name": f"sensor{i}"}) for i in range(6)]
+    records.append(Record("vav", {"name": "vav0", "zone": "zone0"}))
+    expected = Graph()
+    for rec in records:
+        bindings = {k: _get_term(v, BLDG) for k, v in rec.fields.items()}
+        templates[rec.rtype].evaluate_many([bindings], into=expected)
+    ingress = TemplateIngressWithChooser(
+        lambda rec: templates[rec.rtype],
+        None,
+        _OneByOneIngress(records),
+        workers=workers,
+    )
+    assert isomorphic(ingress.graph(BLDG), expected)
+
+    bad = _ListIngress([Record("vav", {"zone": "zone2"})])
+    with pytest.raises(ValueError):
+        TemplateIngressWithChooser(
+            lambda rec: templates[rec.rtype], None, bad, workers=workers
+        ).graph(BLDG)
+
+
+def test_template_ingress_with_chooser_single_pool(bm: BuildingMOTIF, monkeypatch):
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    templates = {
+        "sensor": lib.get_template_by_name("temp-sensor"),
+        "vav": lib.get_template_by_name("opt-vav"),
+    }
+    pools = []
+    pool_class = template_ingress.ProcessPoolExecutor
+
+    def counting_pool(*args, **kwargs):
+        pools.append(pool_class(*args, **kwargs))
+        return pools[-1]
+
+    monkeypatch.setattr(template_ingress, "ProcessPoolExecutor", counting_pool)
+
+    # the 'vav' template is first chosen in a later chunk, and its later
+    # records reach workers which were not sent its plan with the first one
+    records = [Record("sensor", {"name": f"sensor{i}"}) for i in range(6)]
+    records += [Record("vav", {"name": f"vav{i}", "zone": "zone0"}) for i in range(8)]
+    expected = Graph()
+    for rec in records:
+        bindings = {k: _get_term(v, BLDG) for k, v in rec.fields.items()}
+        templates[rec.rtype].evaluate_many([bindings], into=expected)
+    ingress = TemplateIngressWithChooser(
+        lambda rec: templates[rec.rtype], None, _OneByOneIngress(records), workers=3
+    )
+    assert isomorphic(ingress.graph(BLDG), expected)
+    assert len(pools) == 1
@@ -0,0 +1,129 @@
+from rdflib import Graph, Namespace
+
+from buildingmotif import BuildingMOTIF
+from buildingmotif import ontology_closure as closure_module
+from buildingmotif.dataclasses import Library
+from buildingmotif.namespaces import OWL, RDFS, A
+from buildingmotif.ontology_closure import OntologyClosure, hierarchy_hash
+
+EX = Namespace("urn:ex/")
+
+
+def _ontology() -> Graph:
+    g = Graph()
+    for cls in ("A", "B", "C"):
+        g.add((EX[cls], A, OWL.Class))
+    g.add((EX.C, RDFS.subClassOf, EX.B))
+    g.add((EX.B, RDFS.subClassOf, EX.A))
+    g.add((EX.p2, RDFS.subPropertyOf, EX.p1))
+    g.add((EX.D, OWL.equivalentClass, EX.C))
+    g.add((EX.E, OWL.equivalentClass, EX.D))
+    return g
+
+
+def test_ontology_closure(bm: BuildingMOTIF):
+    g = _ontology()
+    closure = OntologyClosure.load(g)
+
+    assert closure.parents(EX.C) == {EX.C, EX.B, EX.A}
+    assert closure.parents(EX.A) == {EX.A}
+    assert closure.parents(EX.D) == {EX.D}
+    assert closure.children(EX.A) == {EX.A, EX.B, EX.C}
+    assert closure.children(EX.C) == {EX.C}
+    assert closure.equivalents(EX.C) == {EX.C, EX.D, EX.E}
+    assert closure.parent_properties(EX.p2) == {EX.p2, EX.p1}
+    assert closure.is_class(EX.B) and not closure.is_class(EX.p1)
+
+    # looking up a closure does not write to the database
+    assert bm.table_connection.get_db_ontology_closure(hierarchy_hash(g)) is None
+
+    # a persisted closure is stored under the hash of the hierarchy
+    assert OntologyClosure.load(g, persist=True) is closure
+    db_closure = bm.table_connection.get_db_ontology_closure(hierarchy_hash(g))
+    assert db_closure is not None
+
+    # a different graph with the same hierarchy is served from the database
+    closure_module._closures.clear()
+    copy = _ontology()
+    copy.add((EX.C, RDFS.label, EX.unrelated))
+    assert hierarchy_hash(copy) == hierarchy_hash(g)
+    assert OntologyClosure.load(copy) == closure
+
+    # the closure of several graphs is the closure of their union
+    extra = Graph()
+    extra.add((EX.A, RDFS.subClassOf, EX.Root))
+    assert OntologyClosure.load(g, extra).parents(EX.C) == {
+        EX.C,
+        EX.B,
+        EX.A,
+        EX.Root,
+    }
+
+
+def test_prune_ontology_closures(bm: BuildingMOTIF):
+    lib = Library.create("urn:ex/library")
+    lib.get_shape_collection().add_graph(_ontology())
+    OntologyClosure.load(lib.get_shape_collection().graph, persist=True)
+    stale = Graph()
+    stale.add((EX.A, RDFS.subClassOf, EX.Root))
+    OntologyClosure.load(stale, persist=True)
+
+    # only the closure of the library's shape collection is kept
+    assert OntologyClosure.prune() == 1
+    assert bm.table_connection.get_db_ontology_closure(hierarchy_hash(stale)) is None
+    assert (
+        bm.table_connection.get_db_ontology_closure(hierarchy_hash(_ontology()))
+        is not None
+    )
+
+
+def test_compose_ontology_closures(bm: BuildingMOTIF, monkeypatch):
+    g = _ontology()
+    extra = Graph()
+    extra.add((EX.A, RDFS.subClassOf, EX.Root))
+    extra.add((EX.p1, RDFS.subPropertyOf, EX.p0))
+    extra.add((EX.F, OWL.equivalentClass, EX.E))
+    expected = OntologyClosure.compute(g, extra)
+    OntologyClosure.load(g, persist=True)
+    OntologyClosure.load(extra, persist=True)
+    closure_module._closures.clear()
+
+    # the closure of a union is composed from the persisted closures of its
+    # parts, without reading their hierarchies again
+    def compute(*graphs):
+        raise AssertionError("closure was recomputed")
+
+    monkeypatch.setattr(OntologyClosure, "compute", compute)
+    closure = OntologyClosure.load(g, extra)
+    assert closure == expected
+    assert closure.parents(EX.C) == {EX.C, EX.B, EX.A, EX.Root}
+    assert closure.parent_properties(EX.p2) == {EX.p2, EX.p1, EX.p0}
+    assert closure.equivalents(EX.F) == {EX.C, EX.D, EX.E, EX.F}
+
+
+def test_reload_library_discards_closure(bm: BuildingMOTIF):
+    def ontology(*triples) -> Graph:
+        g = _ontology()
+        g.add((EX.ont, A, OWL.Ontology))
+        for triple in triples:
+            g.add(triple)
+        return g
+
+    other = Library.create("urn:ex/other")
+    other.get_shape_collection().add_graph(_ontology())
+    OntologyClosure.load(other.get_shape_collection().graph, persist=True)
+
+    lib = Library.load(ontology_graph=ontology((EX.A, RDFS.subClassOf, EX.Root)))
+    before = hierarchy_hash(lib.get_shape_collection().graph)
+    assert bm.table_connection.get_db_ontology_closure(before) is not None
+
+    # reloading the library replaces only its own closure
+    lib = Library.load(ontology_graph=ontology((EX.Root, RDFS.subClassOf, EX.Top)))
+    after = hierarchy_hash(lib.get_shape_collection().graph)
+    assert after != before
+    assert bm.table_connection.get_db_ontology_closure(before) is None
+    assert bm.table_connection.get_db_ontology_closure(after) is not None
+    assert (
+        bm.table_connection.get_db_ontology_closure(hierarchy_hash(_ontology()))
+        is not None
+    )
@@ -0,0 +1,130 @@
+from pyshacl.rules.sparql import SPARQLRule
+from rdflib import Graph, Literal, Namespace
+from rdflib.store import TripleAddedEvent
+
+from buildingmotif import rule_engine
+from buildingmotif.namespaces import A
+from buildingmotif.rule_engine import (
+    PreparedOntology,
+    RuleEngine,
+    _addition_listeners,
+    _apply_sparql_rule,
+)
+
+EX = Namespace("urn:ex/")
+
+SHAPES = """
+@prefix ex: <urn:ex/> .
+@prefix owl: <http://www.w3.org/2002/07/owl#> .
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+
+ex:Marked a owl:Class, sh:NodeShape ;
+    sh:rule [
+        a sh:SPARQLRule ;
+        sh:construct "CONSTRUCT { ?next a <urn:ex/Marked> } WHERE { $this <urn:ex/next> ?next }" ;
+    ] .
+
+ex:TagShape a sh:NodeShape ;
+    sh:targetClass ex:Marked ;
+    sh:rule [
+        a sh:TripleRule ;
+        sh:subject sh:this ;
+        sh:predicate ex:tagged ;
+        sh:object true ;
+    ] .
+
+ex:OtherShape a sh:NodeShape ;
+    sh:targetClass ex:Other ;
+    sh:rule [
+        a sh:TripleRule ;
+        sh:subject sh:this ;
+        sh:predicate ex:other ;
+        sh:object true ;
+    ] .
+"""
+
+
+def test_rule_engine_fixed_point():
+    shapes = Graph().parse(data=SHAPES, format="turtle")
+    data = Graph()
+    chain = [EX[f"n{i}"] for i in range(8)]
+    for a, b in zip(chain, chain[1:]):
+        data.add((a, EX.next, b))
+    data.add((chain[0], A, EX.Marked))
+    data.add((EX.o, A, EX.Other))
+
+    rounds = RuleEngine(shapes).run(data)
+
+    # marking propagates one node per round, which takes more rounds than
+    # the previous limit of four
+    for node in chain:
+        assert (node, A, EX.Marked) in data
+        assert (node, EX.tagged, Literal(True)) in data
+    assert len(rounds) > 4
+    assert rounds[-1].triples_added == 0
+    assert sum(r.triples_added for r in rounds) == 16
+
+    # the unrelated rule is only applied in the first round
+    other = next(r.rule for r in rounds[0].rules if r.shape == EX.OtherShape)
+    assert all(r.rule != other for rnd in rounds[1:] for r in rnd.rules)
+    assert (EX.o, EX.other, Literal(True)) in data
+
+
+def test_rule_engine_detaches_addition_log():
+    shapes = Graph().parse(data=SHAPES, format="turtle")
+    engine = RuleEngine(shapes)
+    data = Graph()
+    data.add((EX.a, EX.next, EX.b))
+    data.add((EX.a, A, EX.Marked))
+
+    for _ in range(3):
+        engine.run(data)
+    # the runs share a single listener on the store, with no open logs
+    listener = _addition_listeners[data.store]
+    assert listener.logs == []
+    assert data.store.dispatcher.get_map()[TripleAddedEvent].count(listener) == 1
+
+
+def test_compile_stops_at_round_cap(monkeypatch):
+    shapes = Graph().parse(data=SHAPES, format="turtle")
+    data = Graph()
+    chain = [EX[f"n{i}"] for i in range(8)]
+    for a, b in zip(chain, chain[1:]):
+        data.add((a, EX.next, b))
+    data.add((chain[0], A, EX.Marked))
+
+    monkeypatch.setattr(rule_engine, "_COMPILE_MAX_ROUNDS", 2)
+    prepared = PreparedOntology((), shapes, RuleEngine(shapes))
+    compiled, rounds = prepared.compile(data)
+    assert len(rounds) == 2
+    assert (chain[-1], A, EX.Marked) not in compiled
+
+
+def test_apply_sparql_rule_uses_pyshacl_internals():
+    # _apply_sparql_rule reads these private attributes of SPARQLRule; if a
+    # pySHACL upgrade removes them, rules silently fall back to being applied
+    # to all focus nodes
+    shapes = Graph().parse(data=SHAPES, format="turtle")
+    rule = next(
+        p.rule for p in RuleEngine(shapes)._plans if isinstance(p.rule, SPARQLRule)
+    )
+    assert rule._constructs
+    assert hasattr(rule._qh, "apply_prefixes")
+
+
+def test_apply_sparql_rule_without_internals(monkeypatch):
+    shapes = Graph().parse(data=SHAPES, format="turtle")
+    data = Graph()
+    data.add((EX.a, EX.next, EX.b))
+    data.add((EX.a, A, EX.Marked))
+    rule = next(
+        p.rule for p in RuleEngine(shapes)._plans if isinstance(p.rule, SPARQLRule)
+    )
+
+    # as if another pySHACL version stored the queries elsewhere, the rule
+    # is applied to all focus nodes
+    applied = []
+    monkeypatch.delattr(rule, "_constructs")
+    monkeypatch.setattr(SPARQLRule, "apply", lambda self, g: applied.append(g))
+    _apply_sparql_rule(rule, data, {EX.a})
+    assert applied == [data]
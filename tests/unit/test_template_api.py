@@ -1,15 +1,46 @@
+from itertools import count, permutations
+from types import SimpleNamespace
+
 import pytest
-from rdflib import Graph, Namespace
+from networkx.algorithms.isomorphism import DiGraphMatcher  # type: ignore
+from rdflib import BNode, Graph, Namespace
+from rdflib.compare import isomorphic
+from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
 
-from buildingmotif import BuildingMOTIF
+from buildingmotif import BuildingMOTIF, template_matcher
 from buildingmotif.dataclasses import Library, Model, Template
 from buildingmotif.namespaces import BRICK, PARAM, A
-from buildingmotif.template_matcher import TemplateMatcher
+from buildingmotif.ontology_closure import OntologyClosure
+from buildingmotif.template_matcher import (
+    TemplateMatcher,
+    TemplatePattern,
+    _ontology_lookup_cache,
+    digraph_to_rdflib,
+    generate_all_subgraphs,
+    get_semantic_feasibility,
+)
 from buildingmotif.utils import graph_size
 
 BLDG = Namespace("urn:building/")
 
 
+class _VF2SemanticMatcher(DiGraphMatcher):
+    """
+    Matches a template graph T into a building graph G with VF2, checking
+    node semantics against the ontology. Used as the reference for the
+    TemplateMatcher search.
+    """
+
+    def __init__(self, T: Graph, G: Graph, ontology: Graph):
+        super().__init__(rdflib_to_networkx_digraph(T), rdflib_to_networkx_digraph(G))
+        self._semantic_feasibility = get_semantic_feasibility(
+            T, G, ontology, _ontology_lookup_cache(OntologyClosure.load(ontology))
+        )
+
+    def semantic_feasibility(self, g1, g2) -> bool:
+        return self._semantic_feasibility(g1, g2)
+
+
 def test_template_evaluate(bm: BuildingMOTIF):
     """
     Test the Template.evaluate() method.
@@ -167,6 +198,45 @@ def test_template_inline_dependencies(bm: BuildingMOTIF):
     }
 
 
+def test_template_inline_dependencies_cache(bm: BuildingMOTIF):
+    """
+    Test that inlined templates are memoized and invalidated when
+    dependencies or bodies change.
+    """
+    lib = Library.create("my_library")
+    parent = lib.create_template("parent")
+    parent.body.add((PARAM["name"], A, BRICK["AHU"]))
+    parent.body.add((PARAM["name"], BRICK.hasPart, PARAM["dep"]))
+    dep = lib.create_template("dep")
+    dep.body.add((PARAM["name"], A, BRICK["Supply_Fan"]))
+    parent.add_dependency(dep, {"name": "dep"})
+
+    first = parent.inline_dependencies()
+    assert first.parameters == {"name", "dep"}
+    cached = bm.table_connection.template_inline_cache[parent.id]
+    second = parent.inline_dependencies()
+    assert bm.table_connection.template_inline_cache[parent.id] is cached
+    # callers always get their own copy
+    assert second is not first
+    second.body.add((PARAM["name"], BRICK.hasPoint, PARAM["extra"]))
+    assert parent.inline_dependencies().parameters == {"name", "dep"}
+
+    # editing the body of a dependency invalidates the cache
+    dep.body.add((PARAM["name"], BRICK.hasPoint, PARAM["speed"]))
+    assert parent.inline_dependencies().parameters == {"name", "dep", "dep-speed"}
+
+    # adding and removing dependencies invalidates the cache
+    other = lib.create_template("other")
+    other.body.add((PARAM["name"], A, BRICK["Damper"]))
+    parent.body.add((PARAM["name"], BRICK.hasPart, PARAM["dmp"]))
+    parent.add_dependency(other, {"name": "dmp"})
+    inlined = parent.inline_dependencies()
+    assert (PARAM["dmp"], A, BRICK["Damper"]) in inlined.body
+    parent.remove_dependency(other)
+    inlined = parent.inline_dependencies()
+    assert (PARAM["dmp"], A, BRICK["Damper"]) not in inlined.body
+
+
 def test_template_evaluate_with_optional(bm: BuildingMOTIF):
     """
     Test that template evaluation works with optional parameters.
@@ -202,6 +272,119 @@ def test_template_evaluate_with_optional(bm: BuildingMOTIF):
     assert t.parameters == {"occ"}
 
 
+def test_template_compile(bm: BuildingMOTIF):
+    """
+    Test that compiled templates evaluate like the template body and are
+    rebuilt when the body changes.
+    """
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    zone = lib.get_template_by_name("zone")
+    compiled = zone.compile()
+    assert compiled.parameters == {"name", "cav"}
+    # the plan is cached until the body changes
+    assert zone.compile() is compiled
+
+    triples = set(compiled.fill({"name": BLDG["zone1"], "cav": BLDG["cav1"]}))
+    assert (BLDG["zone1"], BRICK.isFedBy, BLDG["cav1"]) in triples
+    assert len(triples) == 3
+    # triples with unbound parameters are skipped unless asked for
+    assert len(list(compiled.fill({"name": BLDG["zone1"]}))) == 1
+    partial = set(compiled.fill({"name": BLDG["zone1"]}, keep_unbound=True))
+    assert (BLDG["zone1"], BRICK.isFedBy, PARAM["cav"]) in partial
+
+    zone.body.add((PARAM["name"], BRICK.hasPoint, PARAM["sensor"]))
+    recompiled = zone.compile()
+    assert recompiled is not compiled
+    assert recompiled.parameters == {"name", "cav", "sensor"}
+    assert zone.parameters == {"name", "cav", "sensor"}
+
+    # the plan of the inlined template is cached as well
+    vav = lib.get_template_by_name("single-zone-vav-ahu")
+    inlined = vav.compile(inline=True)
+    assert vav.compile(inline=True) is inlined
+    assert inlined.parameters == vav.inline_dependencies().parameters
+
+
+def test_template_evaluate_renames_blank_nodes(bm: BuildingMOTIF):
+    """
+    Test that each evaluation of a template gets its own blank nodes.
+    """
+    lib = Library.create("bnode-lib")
+    body = Graph()
+    node = BNode()
+    body.add((PARAM["name"], BRICK.hasPoint, node))
+    body.add((node, A, BRICK.Sensor))
+    templ = lib.create_template("bnode-templ", body)
+
+    g1 = templ.evaluate({"name": BLDG["a"]})
+    g2 = templ.evaluate({"name": BLDG["b"]})
+    assert isinstance(g1, Graph) and isinstance(g2, Graph)
+    bnode1 = g1.value(BLDG["a"], BRICK.hasPoint)
+    bnode2 = g2.value(BLDG["b"], BRICK.hasPoint)
+    assert isinstance(bnode1, BNode) and isinstance(bnode2, BNode)
+    assert bnode1 != bnode2
+    assert (bnode1, A, BRICK.Sensor) in g1
+
+
+def test_template_evaluate_many(bm: BuildingMOTIF):
+    """
+    Test that evaluating a template over many bindings puts all of the
+    results into one graph.
+    """
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    templ = lib.get_template_by_name("opt-vav")
+    bindings = [
+        {"name": BLDG["vav1"], "zone": BLDG["zone1"], "occ": BLDG["occ1"]},
+        {"name": BLDG["vav2"], "zone": BLDG["zone2"]},
+    ]
+    target = Graph()
+    g = templ.evaluate_many(bindings, into=target)
+    assert g is target
+    assert (BLDG["occ1"], BRICK.isPointOf, BLDG["zone1"]) in g
+    assert (BLDG["vav2"], A, BRICK.VAV) in g
+    # the unbound optional 'occ' of the second binding is pruned
+    assert graph_size(g) == 4 + 1
+
+    batches = list(templ.evaluate_batches(bindings, batch_size=1))
+    assert len(batches) == 2
+
+    with pytest.raises(ValueError):
+        templ.evaluate_many([{"name": BLDG["vav3"]}])
+
+
+def test_template_evaluate_columns(bm: BuildingMOTIF):
+    """
+    Test that evaluating a template over columns of bindings gives the same
+    graph as evaluating it over each row.
+    """
+    lib = Library.load(directory="tests/unit/fixtures/templates")
+    templ = lib.get_template_by_name("opt-vav")
+    columns = {
+        "name": [BLDG["vav1"], BLDG["vav2"]],
+        "zone": [BLDG["zone1"], BLDG["zone2"]],
+        "occ": [BLDG["occ1"], None],
+    }
+    g = templ.evaluate_columns(columns)
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    assert isomorphic(g, templ.evaluate_many(rows))
+
+    with pytest.raises(ValueError):
+        templ.evaluate_columns({"name": [BLDG["vav3"]], "zone": [None]})
+    with pytest.raises(ValueError):
+        templ.evaluate_columns({"name": [BLDG["vav3"]], "zone": []})
+
+    # each row gets its own blank nodes
+    body = Graph()
+    node = BNode()
+    body.add((PARAM["name"], BRICK.hasPoint, node))
+    body.add((node, A, BRICK.Sensor))
+    bnode_templ = Library.create("bnode-columns").create_template("bnode", body)
+    g = bnode_templ.evaluate_columns({"name": [BLDG["a"], BLDG["b"]]})
+    points = {g.value(BLDG[name], BRICK.hasPoint) for name in "ab"}
+    assert len(points) == 2
+    assert all((point, A, BRICK.Sensor) in g for point in points)
+
+
 def test_template_matching(bm: BuildingMOTIF):
     EX = Namespace("urn:ex/")
     brick = Library.load(ontology_graph="tests/unit/fixtures/matching/brick.ttl")
@@ -223,6 +406,60 @@ def test_template_matching(bm: BuildingMOTIF):
     assert isinstance(remaining_template, Template)
     assert remaining_template.parameters == {"sen", "pos"}
 
+    # a matcher can be given the body and parameters of a template alone
+    pattern = TemplatePattern(damper.name, damper.body, damper.parameters)
+    pattern_matcher = TemplateMatcher(
+        bldg.graph, pattern, brick.get_shape_collection().graph
+    )
+    assert list(pattern_matcher.mappings_iter()) == list(matcher.mappings_iter())
+    with pytest.raises(TypeError):
+        pattern_matcher.remaining_template(mapping)
+
+
+def test_template_matching_partial_optional(bm: BuildingMOTIF):
+    EX = Namespace("urn:ex/")
+    brick = Library.load(ontology_graph="tests/unit/fixtures/matching/brick.ttl")
+    lib = Library.create("partial_optional")
+    body = Graph().parse(
+        data="""
+@prefix P: <urn:___param___#> .
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+P:name a brick:Outside_Air_Damper ;
+  brick:hasPoint P:pos, P:sen .
+P:pos a brick:Damper_Position_Command .
+P:sen a brick:Damper_Position_Sensor .
+    """
+    )
+    damper = lib.create_template("opt-damper", body, optional_args=["pos", "sen"])
+
+    bldg = Model.create("https://example.com")
+    bldg.add_graph(
+        Graph().parse(
+            data="""
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix : <urn:ex/> .
+:damper1 a brick:Outside_Air_Damper ; brick:hasPoint :pos1 .
+:pos1 a brick:Damper_Position_Command .
+    """
+        )
+    )
+
+    # binding only some of the optional args leaves a template
+    matcher = TemplateMatcher(bldg.graph, damper, brick.get_shape_collection().graph)
+    mapping, _ = next(matcher.building_mapping_subgraphs_iter())
+    assert mapping[EX["damper1"]] == PARAM["name"]
+    assert mapping[EX["pos1"]] == PARAM["pos"]
+    remaining_template = matcher.remaining_template(mapping)
+    assert isinstance(remaining_template, Template)
+    assert remaining_template.parameters == {"sen"}
+
+    mapping, _, remaining_template = next(
+        damper.find_subgraphs(bldg, brick.get_shape_collection().graph)
+    )
+    assert mapping[EX["pos1"]] == PARAM["pos"]
+    assert isinstance(remaining_template, Template)
+    assert remaining_template.parameters == {"sen"}
+
 
 def test_template_matcher_with_graph_target(bm: BuildingMOTIF):
     BLDG = Namespace("urn:template-match-test/")
@@ -274,3 +511,181 @@ def test_template_matcher_with_graph_target(bm: BuildingMOTIF):
     assert graph is not None
     assert mapping[BLDG["sf1"]] == PARAM["name"]
     assert mapping[BRICK["Fan"]] == BRICK["Supply_Fan"]
+
+
+def test_template_matcher_candidates(bm: BuildingMOTIF):
+    BLDG = Namespace("urn:template-match-candidates/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    templ_lib = Library.load(directory="tests/unit/fixtures/templates")
+    sf_templ = templ_lib.get_template_by_name("supply-fan")
+
+    data = """
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix : <urn:template-match-candidates/> .
+:sf1 a brick:Fan .
+:room1 a brick:Room .
+:ahu1 a brick:AHU ; brick:hasPart :sf1 .
+    """
+    model = Model.create(BLDG)
+    model.add_graph(Graph().parse(data=data))
+    matcher = TemplateMatcher(model.graph, sf_templ, brick.get_shape_collection().graph)
+
+    # nodes whose types do not fit any template node are never candidates
+    _, candidates = matcher._candidates(PARAM["name"], frozenset({BRICK["Supply_Fan"]}))
+    assert BLDG["sf1"] in candidates
+    assert BLDG["room1"] not in candidates
+    assert BLDG["ahu1"] not in candidates
+
+    # the points of the template have no candidates in the building
+    assert not matcher._candidates(
+        PARAM["spd"], frozenset({BRICK["Fan_Speed_Command"]})
+    )[1]
+
+    mapping, _ = next(matcher.building_mapping_subgraphs_iter())
+    assert mapping[BLDG["sf1"]] == PARAM["name"]
+
+
+def test_template_matcher_lattice(bm: BuildingMOTIF):
+    BLDG = Namespace("urn:template-match-lattice/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    ontology = brick.get_shape_collection().graph
+    templ_lib = Library.load(directory="tests/unit/fixtures/templates")
+    sf_templ = templ_lib.get_template_by_name("supply-fan")
+
+    data = """
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix : <urn:template-match-lattice/> .
+:sf1 a brick:Supply_Fan ; brick:hasPoint :spd1, :st1, :temp1 .
+:sf2 a brick:Fan ; brick:hasPoint :st2 .
+:spd1 a brick:Fan_Speed_Command .
+:st1 a brick:Fan_Status .
+:st2 a brick:Fan_Status .
+:temp1 a brick:Temperature_Sensor .
+:room1 a brick:Room .
+    """
+    model = Model.create(BLDG)
+    model.add_graph(Graph().parse(data=data))
+    matcher = TemplateMatcher(model.graph, sf_templ, ontology)
+
+    # mappings stream out largest first
+    sizes = [len(mapping) for mapping in matcher.mappings_iter()]
+    assert sizes == sorted(sizes, reverse=True)
+    assert matcher.largest_mapping_size == sizes[0]
+
+    # the lattice search finds the same mappings as matching every subgraph
+    # of the template with VF2
+    expected = set()
+    for template_subgraph in generate_all_subgraphs(matcher.template_graph):
+        vf2 = _VF2SemanticMatcher(model.graph, template_subgraph, ontology)
+        for mapping in vf2.subgraph_monomorphisms_iter():
+            if set(mapping.values()) & matcher.template_parameters:
+                expected.add(frozenset(mapping.items()))
+    found = [frozenset(mapping.items()) for mapping in matcher.mappings_iter()]
+    assert len(found) == len(set(found))
+    assert set(found) == expected
+
+    # subgraphs are cut from the digraphs held by the matcher
+    building_digraph = rdflib_to_networkx_digraph(model.graph)
+    template_digraph = rdflib_to_networkx_digraph(matcher.template_graph)
+    for mapping in matcher.mappings_iter():
+        building_sg = matcher.building_subgraph_from_mapping(mapping)
+        expected_sg = digraph_to_rdflib(
+            building_digraph.edge_subgraph(permutations(mapping.keys(), 2))
+        )
+        assert isomorphic(building_sg, expected_sg)
+        template_sg = matcher.template_subgraph_from_mapping(mapping)
+        expected_sg = digraph_to_rdflib(template_digraph.subgraph(mapping.values()))
+        assert isomorphic(template_sg, expected_sg)
+
+
+def test_template_matcher_degrees(bm: BuildingMOTIF):
+    BLDG = Namespace("urn:template-match-degrees/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    ontology = brick.get_shape_collection().graph
+    templ_lib = Library.load(directory="tests/unit/fixtures/templates")
+    sf_templ = templ_lib.get_template_by_name("supply-fan")
+
+    data = """
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix : <urn:template-match-degrees/> .
+:sf1 a brick:Supply_Fan ; brick:hasPoint :spd1 .
+:spd1 a brick:Fan_Speed_Command .
+    """
+    model = Model.create(BLDG)
+    model.add_graph(Graph().parse(data=data))
+    # fans without points have too few edges to match a fan with a point
+    for i in range(20):
+        model.graph.add((BLDG[f"fan{i}"], A, BRICK["Supply_Fan"]))
+    matcher = TemplateMatcher(model.graph, sf_templ, ontology)
+
+    # the fan is assigned first, before any of its neighbors
+    subset = frozenset({PARAM["name"], PARAM["spd"], BRICK["Supply_Fan"]})
+    list(matcher._assignments(subset))
+    assert matcher.stats.candidates_tried < 20
+
+    expected = set()
+    for template_subgraph in generate_all_subgraphs(matcher.template_graph):
+        vf2 = _VF2SemanticMatcher(model.graph, template_subgraph, ontology)
+        for mapping in vf2.subgraph_monomorphisms_iter():
+            if set(mapping.values()) & matcher.template_parameters:
+                expected.add(frozenset(mapping.items()))
+    found = {frozenset(mapping.items()) for mapping in matcher.mappings_iter()}
+    assert found == expected
+
+
+def test_template_matcher_bounds(bm: BuildingMOTIF, monkeypatch):
+    BLDG = Namespace("urn:template-match-bounds/")
+    brick = Library.load(
+        ontology_graph="tests/unit/fixtures/Brick1.3rc1-equip-only.ttl"
+    )
+    ontology = brick.get_shape_collection().graph
+    templ_lib = Library.load(directory="tests/unit/fixtures/templates")
+    sf_templ = templ_lib.get_template_by_name("supply-fan")
+
+    data = """
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix : <urn:template-match-bounds/> .
+:sf1 a brick:Supply_Fan ; brick:hasPoint :spd1, :st1 .
+:sf2 a brick:Fan ; brick:hasPoint :st2 .
+:spd1 a brick:Fan_Speed_Command .
+:st1 a brick:Fan_Status .
+:st2 a brick:Fan_Status .
+    """
+    model = Model.create(BLDG)
+    model.add_graph(Graph().parse(data=data))
+    unbounded = TemplateMatcher(model.graph, sf_templ, ontology)
+    everything = list(unbounded.mappings_iter())
+    assert unbounded.stats.complete
+    assert unbounded.stats.mappings == len(everything)
+
+    # the budget keeps the largest mappings
+    matcher = TemplateMatcher(model.graph, sf_templ, ontology, max_mappings=3)
+    assert list(matcher.mappings_iter()) == everything[:3]
+    assert matcher.stats.budget_exhausted
+    assert not matcher.stats.complete
+    assert list(matcher.mappings_iter()) == everything[:3]
+
+    matcher = TemplateMatcher(model.graph, sf_templ, ontology, min_size=4)
+    assert list(matcher.mappings_iter()) == [m for m in everything if len(m) >= 4]
+
+    # a clock which advances by one second each time it is read
+    clock = count()
+    monkeypatch.setattr(
+        template_matcher, "time", SimpleNamespace(monotonic=lambda: next(clock))
+    )
+    matcher = TemplateMatcher(model.graph, sf_templ, ontology, timeout=40)
+    found = list(matcher.mappings_iter())
+    assert matcher.stats.timed_out
+    assert matcher.stats.subsets_searched < unbounded.stats.subsets_searched
+    # the matches found before the deadline are kept
+    assert found
+    assert all(mapping in everything for mapping in found)
+
+    with pytest.raises(ValueError):
+        TemplateMatcher(model.graph, sf_templ, ontology, max_mappings=0)
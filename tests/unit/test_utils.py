@@ -1,18 +1,28 @@
+import os
+
 import pyshacl  # type: ignore
 import pytest
-from rdflib import Graph, Namespace, URIRef
+from rdflib import BNode, Graph, Literal, Namespace, URIRef
 
 from buildingmotif import BuildingMOTIF
 from buildingmotif.dataclasses import Model, ShapeCollection
 from buildingmotif.namespaces import BRICK, SH, XSD, A
 from buildingmotif.utils import (
     PARAM,
+    BlankNodeRenamer,
+    LRUCache,
+    OverlayGraph,
     _param_name,
     get_parameters,
     get_template_parts_from_shape,
+    graph_hash,
+    graph_version,
     replace_nodes,
+    rewrite_nodes,
     rewrite_shape_graph,
     skip_uri,
+    triples_hash,
+    worker_count,
 )
 
 PREAMBLE = """@prefix bacnet: <http://data.ashrae.org/bacnet/2020#> .
@@ -99,6 +109,30 @@ def test_replace_nodes():
     assert len(list(g.triples((None, None, None)))) == 1
 
 
+def test_rewrite_nodes():
+    g = Graph()
+    g.parse(
+        data=PREAMBLE
+        + """
+    :a :b :c .
+    :a :e :f .
+    :d :e :c .
+    :x :y :z .
+    """
+    )
+    rewrite_nodes(
+        g,
+        replace={MODEL["a"]: MODEL["a1"], MODEL["c"]: MODEL["c1"]},
+        remove=[MODEL["f"]],
+    )
+
+    assert set(g) == {
+        (MODEL["a1"], MODEL["b"], MODEL["c1"]),
+        (MODEL["d"], MODEL["e"], MODEL["c1"]),
+        (MODEL["x"], MODEL["y"], MODEL["z"]),
+    }
+
+
 def test_get_parameters():
     body = Graph()
     body.parse(
@@ -278,3 +312,137 @@ def test_skip_uri():
     assert skip_uri(XSD.integer)
     assert skip_uri(SH.NodeShape)
     assert not skip_uri(BRICK.Sensor)
+
+
+def test_overlay_graph():
+    base = Graph()
+    base.bind("model", MODEL)
+    base.bind("brick", BRICK)
+    base.add((MODEL["a"], A, BRICK.VAV))
+    base.add((MODEL["a"], BRICK.hasPoint, MODEL["b"]))
+    base_triples = set(base)
+
+    overlay = OverlayGraph(base)
+    overlay.add((MODEL["b"], A, BRICK.Temperature_Sensor))
+    overlay.remove((MODEL["a"], BRICK.hasPoint, None))
+    # adding a triple of the base graph changes nothing
+    overlay.add((MODEL["a"], A, BRICK.VAV))
+
+    assert set(base) == base_triples
+    assert len(overlay) == 2
+    assert (MODEL["a"], BRICK.hasPoint, MODEL["b"]) not in overlay
+    assert set(overlay.subjects(A, None)) == {MODEL["a"], MODEL["b"]}
+    assert overlay.removed == {(MODEL["a"], BRICK.hasPoint, MODEL["b"])}
+    assert len(overlay.added) == 1
+    assert dict(overlay.namespaces())["model"] == URIRef(MODEL)
+    rows = overlay.query("SELECT ?s WHERE { ?s a brick:Temperature_Sensor }")
+    assert [row[0] for row in rows] == [MODEL["b"]]
+
+    # re-adding a removed triple restores it
+    overlay.add((MODEL["a"], BRICK.hasPoint, MODEL["b"]))
+    assert not overlay.removed
+    copy = overlay.materialize()
+    assert not isinstance(copy, OverlayGraph)
+    assert set(copy) == base_triples | {(MODEL["b"], A, BRICK.Temperature_Sensor)}
+
+    # the length is counted as triples are added and removed
+    overlay.add((MODEL["b"], A, BRICK.Temperature_Sensor))
+    assert len(overlay) == len(list(overlay)) == 3
+    overlay.remove((MODEL["b"], None, None))
+    overlay.remove((MODEL["c"], None, None))
+    assert len(overlay) == len(list(overlay)) == 2
+    overlay.remove((MODEL["a"], A, BRICK.VAV))
+    overlay.add((MODEL["c"], A, BRICK.VAV))
+    assert len(overlay) == len(list(overlay)) == 2
+
+
+def test_blank_node_renamer():
+    g = Graph()
+    g.bind("model", MODEL)
+    g.add((MODEL["a"], BRICK.hasPoint, BNode("p")))
+    g.add((BNode("p"), A, BRICK.Temperature_Sensor))
+    g.add((MODEL["a"], A, BRICK.VAV))
+
+    renamer = BlankNodeRenamer(g)
+    first, second = renamer.copy(), renamer.copy()
+    for copy in (first, second):
+        assert len(copy) == 3
+        assert (MODEL["a"], A, BRICK.VAV) in copy
+        assert dict(copy.namespaces())["model"] == URIRef(MODEL)
+        # the blank node is renamed consistently within a copy
+        (point,) = copy.objects(MODEL["a"], BRICK.hasPoint)
+        assert isinstance(point, BNode) and point != BNode("p")
+        assert (point, A, BRICK.Temperature_Sensor) in copy
+    # each copy gets its own blank nodes
+    assert set(first.objects(MODEL["a"], BRICK.hasPoint)) != set(
+        second.objects(MODEL["a"], BRICK.hasPoint)
+    )
+
+
+def test_graph_hash():
+    def graph():
+        g = Graph()
+        g.add((MODEL["a"], A, BRICK.VAV))
+        g.add((MODEL["a"], BRICK.hasPoint, MODEL["p"]))
+        return g
+
+    g1, g2 = graph(), graph()
+    # graphs with the same triples have the same hash, but not the same version
+    assert graph_hash(g1) == graph_hash(g2)
+    assert graph_version(g1) != graph_version(g2)
+
+    digest = graph_hash(g1)
+    g1.add((MODEL["p"], A, BRICK.Temperature_Sensor))
+    assert graph_hash(g1) != digest
+    g1.remove((MODEL["p"], A, BRICK.Temperature_Sensor))
+    assert graph_hash(g1) == digest
+
+    # the terms and triples are delimited unambiguously: this literal spells
+    # out the two triples with the term separators of a naive encoding
+    s, p = URIRef("s"), URIRef("p")
+    two = [(s, p, Literal("a")), (s, p, Literal("b"))]
+    one = [(s, p, Literal("a\x01\x01\nURIRef\x01s\x00URIRef\x01p\x00Literal\x01b"))]
+    assert triples_hash(two) != triples_hash(one)
+    assert triples_hash(two) == triples_hash(reversed(two))
+
+    # the versions of a new store never repeat those of an old one, even if
+    # the new store reuses the memory (and id) of the old one
+    versions = set()
+    for _ in range(100):
+        versions.add(graph_version(Graph(identifier=MODEL["g"])))
+    assert len(versions) == 100
+
+
+def test_lru_cache():
+    cache: LRUCache[str, int] = LRUCache(2)
+    computed = []
+
+    def compute(value):
+        def compute_value():
+            computed.append(value)
+            return value
+
+        return compute_value
+
+    assert cache.get("a", compute(1)) == 1
+    assert cache.get("b", compute(2)) == 2
+    # cached values are not computed again, and using "a" keeps it
+    assert cache.get("a", compute(3)) == 1
+    assert cache.get("c", compute(4)) == 4
+    assert cache.get("a", compute(5)) == 1
+    assert cache.get("b", compute(6)) == 6
+    assert computed == [1, 2, 4, 6]
+
+    cache.discard("b")
+    assert cache.get("b", compute(7)) == 7
+    cache.clear()
+    assert cache.get("b", compute(8)) == 8
+
+
+def test_worker_count():
+    assert worker_count(3) == 3
+    assert worker_count(None) == (os.cpu_count() or 1)
+    # zero workers is an error rather than the number of CPUs
+    for workers in (0, -1):
+        with pytest.raises(ValueError):
+            worker_count(workers)